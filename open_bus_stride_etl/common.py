@@ -1,10 +1,17 @@
 import datetime
+from pprint import pprint
 from contextlib import contextmanager
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 
 import pytz
 import psutil
 
 
+# upper limit for the number of concurrent workers, each worker holds its own DB connection
+MAX_WORKERS = 8
+
+
 def parse_siri_snapshot_id(snapshot_id):
     return datetime.datetime.strptime(snapshot_id + 'z+0000', '%Y/%m/%d/%H/%Mz%z')
 
@@ -66,6 +73,57 @@ def print_memory_usage(start_msg, end_msg="Done"):
     print("{}. Resident memory: {}mb".format(end_msg, psutil.Process().memory_info().rss / (1024 * 1024)))
 
 
+def iterate_chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def israel_hour_to_utc_hour(hour):
     hour = int(hour)
     return pytz.timezone('Israel').localize(datetime.datetime.now().replace(hour=hour)).astimezone(pytz.utc).hour
+
+
+def _process_unit(process_unit_function, unit):
+    unit_stats = defaultdict(int)
+    process_unit_function(unit, unit_stats)
+    return unit_stats
+
+
+def process_units(units, process_unit_function, stats, workers=1):
+    """Calls process_unit_function(unit, stats) for each unit.
+    if workers > 1, units are processed concurrently by a thread pool, each unit opens its own DB session
+    and gets its own stats which are added to the given stats when the unit is done.
+    The number of queued units is bounded, so units are consumed from the iterator only as workers are available."""
+    workers = int(workers or 1)
+    if workers > MAX_WORKERS:
+        print(f'Limiting workers from {workers} to {MAX_WORKERS}')
+        workers = MAX_WORKERS
+    if workers <= 1:
+        for unit in units:
+            process_unit_function(unit, stats)
+            pprint(dict(stats))
+        return
+    print(f'Processing units using {workers} workers')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = set()
+
+        def wait_futures(return_when):
+            nonlocal futures
+            done, futures = wait(futures, return_when=return_when)
+            for future in done:
+                for k, v in future.result().items():
+                    stats[k] += v
+            if done:
+                pprint(dict(stats))
+
+        for unit in units:
+            if len(futures) >= workers * 2:
+                wait_futures(FIRST_COMPLETED)
+            futures.add(executor.submit(_process_unit, process_unit_function, unit))
+        wait_futures(ALL_COMPLETED)
@@ -12,6 +12,11 @@ def gtfs():
 @click.option('--date-to', help='If provided, will process a date range from date to date-to')
 @click.option('--idempotent', is_flag=True, help='If set, will ensure all dates are processed.')
 @click.option('--check-missing-dates', is_flag=True, help='If set, will verify missing dates before processing.')
+@click.option('--mode', type=click.Choice(['set-based', 'orm']), default='set-based', show_default=True,
+              help='set-based - update all rides of a date with a single windowed query, '
+                   'orm - load and update each ride using the ORM (the previous behavior)')
+@click.option('--workers', type=int, default=1, show_default=True,
+              help='With --idempotent, number of dates to process concurrently.')
 def update_ride_aggregations(**kwargs):
     """update aggregations on gtfs_ride data"""
     from .update_ride_aggregations import main
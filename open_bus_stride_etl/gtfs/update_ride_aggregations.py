@@ -1,4 +1,5 @@
 import datetime
+import functools
 from pprint import pprint
 from textwrap import dedent
 from collections import defaultdict
@@ -8,7 +9,71 @@ from open_bus_stride_db import model, db
 from .. import common, idempotent_process_gtfs_data
 
 
-def _process_date_range(from_date, to_date):
+MODE_SET_BASED = 'set-based'
+MODE_ORM = 'orm'
+MODES = [MODE_SET_BASED, MODE_ORM]
+
+TASK_NAME = 'stride-etl-gtfs-update-ride-aggregations'
+
+# a date is considered missing if less than this percent of its rides have start/end times
+MIN_COMPLETE_PERCENT = 90
+
+# the completeness of each processed date is recorded as a gtfs_data_task row of this task name, with success = complete,
+# it's valid only if it was recorded after the gtfs data of the date was processed (reprocessing the date invalidates it)
+COMPLETENESS_TASK_NAME = f'{TASK_NAME}-completeness'
+
+# first/last ride stops are ordered by stop_sequence (and by id for identical stop sequences),
+# rides without any ride stops get null values
+SET_BASED_UPDATE_SQL_TEMPLATE = dedent("""
+    with date_ride_stops as (
+        select
+            gtfs_ride_stop.gtfs_ride_id,
+            row_number() over w as row_number,
+            first_value(gtfs_ride_stop.id) over w as first_gtfs_ride_stop_id,
+            last_value(gtfs_ride_stop.id) over w as last_gtfs_ride_stop_id,
+            first_value(gtfs_ride_stop.departure_time) over w as start_time,
+            last_value(gtfs_ride_stop.arrival_time) over w as end_time
+        from gtfs_ride_stop, gtfs_ride, gtfs_route
+        where gtfs_ride_stop.gtfs_ride_id = gtfs_ride.id
+        and gtfs_ride.gtfs_route_id = gtfs_route.id
+        and gtfs_route.date = '{date}'
+        window w as (
+            partition by gtfs_ride_stop.gtfs_ride_id
+            order by gtfs_ride_stop.stop_sequence, gtfs_ride_stop.id
+            rows between unbounded preceding and unbounded following
+        )
+    ), date_rides as (
+        select
+            gtfs_ride.id as gtfs_ride_id,
+            date_ride_stops.first_gtfs_ride_stop_id,
+            date_ride_stops.last_gtfs_ride_stop_id,
+            date_ride_stops.start_time,
+            date_ride_stops.end_time
+        from gtfs_ride
+        join gtfs_route on gtfs_ride.gtfs_route_id = gtfs_route.id
+        left join date_ride_stops on date_ride_stops.gtfs_ride_id = gtfs_ride.id and date_ride_stops.row_number = 1
+        where gtfs_route.date = '{date}'
+    ), updated_rides as (
+        update gtfs_ride
+        set first_gtfs_ride_stop_id = date_rides.first_gtfs_ride_stop_id,
+            last_gtfs_ride_stop_id = date_rides.last_gtfs_ride_stop_id,
+            start_time = date_rides.start_time,
+            end_time = date_rides.end_time
+        from date_rides
+        where gtfs_ride.id = date_rides.gtfs_ride_id
+        returning gtfs_ride.first_gtfs_ride_stop_id, gtfs_ride.last_gtfs_ride_stop_id, gtfs_ride.start_time, gtfs_ride.end_time
+    )
+    select
+        count(1) as total_rides,
+        count(1) filter (where first_gtfs_ride_stop_id = last_gtfs_ride_stop_id) as same_first_last_stop,
+        count(1) filter (where first_gtfs_ride_stop_id != last_gtfs_ride_stop_id) as valid_first_last_stops,
+        count(1) filter (where first_gtfs_ride_stop_id is null) as without_first_last_stops,
+        count(1) filter (where start_time is not null and end_time is not null) as with_start_end_time
+    from updated_rides
+""")
+
+
+def _process_date_range(from_date, to_date, mode=MODE_SET_BASED):
     from_date = common.parse_date_str(from_date)
     to_date = common.parse_date_str(to_date, num_days=5)
     if to_date > from_date:
@@ -19,16 +84,44 @@ def _process_date_range(from_date, to_date):
         min_dt = to_date
     print("Processing date range from {} to {}".format(dt, min_dt))
     while dt >= min_dt:
-        _process_date(dt, silent=True)
+        _process_date(dt, silent=True, mode=mode)
         dt = dt - datetime.timedelta(days=1)
 
 
-@db.session_decorator
-def _process_date(session: db.Session, date, stats=None, silent=False):
+def _process_date(date, stats=None, silent=False, mode=MODE_SET_BASED):
+    assert mode in MODES, f'invalid mode: {mode}'
     date = common.parse_date_str(date)
-    print("Updating ride aggregations for date {}".format(date))
+    print("Updating ride aggregations for date {} (mode={})".format(date, mode))
     if stats is None:
         stats = defaultdict(int)
+    start_time = common.now()
+    date_stats = defaultdict(int)
+    if mode == MODE_SET_BASED:
+        _process_date_set_based(date, date_stats)
+    else:
+        _process_date_orm(date, date_stats)
+    _set_date_complete(date, _is_complete(date_stats['total rides'], date_stats['rides with start/end time']))
+    for k, v in date_stats.items():
+        stats[k] += v
+    stats['process date seconds'] += (common.now() - start_time).total_seconds()
+    if not silent:
+        pprint(dict(stats))
+    return stats
+
+
+@db.session_decorator
+def _process_date_set_based(session: db.Session, date, stats):
+    row = session.execute(SET_BASED_UPDATE_SQL_TEMPLATE.format(date=date.strftime("%Y-%m-%d"))).one()
+    session.commit()
+    stats['total rides'] += row.total_rides
+    stats['rides with same first/last stop'] += row.same_first_last_stop
+    stats['rides with valid first/last stops'] += row.valid_first_last_stops
+    stats['rides without first/last stops'] += row.without_first_last_stops
+    stats['rides with start/end time'] += row.with_start_end_time
+
+
+@db.session_decorator
+def _process_date_orm(session: db.Session, date, stats):
     for gtfs_ride in session.query(model.GtfsRide).join(model.GtfsRoute.gtfs_rides).where(model.GtfsRoute.date == date):
         stats['total rides'] += 1
         gtfs_ride_stops = sorted(gtfs_ride.gtfs_ride_stops,
@@ -43,6 +136,8 @@ def _process_date(session: db.Session, date, stats=None, silent=False):
             gtfs_ride.start_time = session.query(model.GtfsRideStop).get(
                 gtfs_ride.first_gtfs_ride_stop_id).departure_time
             gtfs_ride.end_time = session.query(model.GtfsRideStop).get(gtfs_ride.last_gtfs_ride_stop_id).arrival_time
+            if gtfs_ride.start_time is not None and gtfs_ride.end_time is not None:
+                stats['rides with start/end time'] += 1
         else:
             stats['rides without first/last stops'] += 1
             gtfs_ride.first_gtfs_ride_stop_id = None
@@ -50,48 +145,93 @@ def _process_date(session: db.Session, date, stats=None, silent=False):
             gtfs_ride.start_time = None
             gtfs_ride.end_time = None
     session.commit()
-    if not silent:
-        pprint(dict(stats))
-    return stats
+
+
+def _is_complete(total_rides, complete_rides):
+    percent = complete_rides * 100 / total_rides if total_rides else 0
+    return percent >= MIN_COMPLETE_PERCENT
 
 
 @db.session_decorator
-def _is_date_missing(session, date):
-    return session.execute(dedent(f"""
-        select case b.cnt when 0 then 0 else a.cnt / b.cnt * 100 end as percent from (
-        select count(1) as cnt
-        from gtfs_ride, gtfs_route
-        where gtfs_ride.gtfs_route_id = gtfs_route.id
-        and gtfs_route.date = '{date.strftime("%Y-%m-%d")}'
-        and gtfs_ride.start_time is not null
-        and gtfs_ride.end_time is not null
-    ) a,
-    (
-        select count(1) as cnt
+def _set_date_complete(session, date, complete):
+    """records the completeness of the date, if the date has no successfully processed gtfs data it's not recorded"""
+    gtfs_data = session.query(model.GtfsData).filter(
+        model.GtfsData.date == date,
+        model.GtfsData.processing_success == True
+    ).one_or_none()
+    if gtfs_data is None:
+        return
+    gtfs_data_task = session.query(model.GtfsDataTask).filter(
+        model.GtfsDataTask.gtfs_data_id == gtfs_data.id,
+        model.GtfsDataTask.task_name == COMPLETENESS_TASK_NAME
+    ).one_or_none()
+    if gtfs_data_task is None:
+        gtfs_data_task = model.GtfsDataTask(gtfs_data_id=gtfs_data.id, task_name=COMPLETENESS_TASK_NAME)
+        session.add(gtfs_data_task)
+    gtfs_data_task.completed_at = datetime.datetime.now(datetime.timezone.utc)
+    gtfs_data_task.success = complete
+    session.commit()
+
+
+@db.session_decorator
+def _get_date_complete(session, date):
+    """returns the recorded completeness of the date, or None if it was not recorded since the gtfs data was processed"""
+    row = session.execute(dedent(f"""
+        select gtfs_data_task.success
+        from gtfs_data, gtfs_data_task
+        where gtfs_data_task.gtfs_data_id = gtfs_data.id
+        and gtfs_data_task.task_name = '{COMPLETENESS_TASK_NAME}'
+        and gtfs_data.date = '{date.strftime("%Y-%m-%d")}'
+        and gtfs_data.processing_success is true
+        and gtfs_data_task.completed_at >= gtfs_data.processing_completed_at
+    """)).one_or_none()
+    return None if row is None else row.success
+
+
+@db.session_decorator
+def _count_date_completeness(session, date):
+    """returns a tuple of (total_rides, complete_rides) of the date using a single scan"""
+    row = session.execute(dedent(f"""
+        select
+            count(1) as total_rides,
+            count(1) filter (where gtfs_ride.start_time is not null and gtfs_ride.end_time is not null) as complete_rides
         from gtfs_ride, gtfs_route
         where gtfs_ride.gtfs_route_id = gtfs_route.id
         and gtfs_route.date = '{date.strftime("%Y-%m-%d")}'
-    ) b""")).one().percent < 90
+    """)).one()
+    return row.total_rides, row.complete_rides
+
+
+def _is_date_missing(date):
+    """uses the recorded completeness of the date, if it was not recorded since the gtfs data was processed
+    (e.g. dates processed before the completeness was recorded) the rides are counted and the completeness is recorded"""
+    complete = _get_date_complete(date)
+    if complete is None:
+        complete = _is_complete(*_count_date_completeness(date))
+        _set_date_complete(date, complete)
+    return not complete
 
 
-def _process_idempotent(check_missing_dates):
+def _process_idempotent(check_missing_dates, mode, workers):
     idempotent_process_gtfs_data.main(
-        'stride-etl-gtfs-update-ride-aggregations',
-        _process_date,
-        _is_date_missing if check_missing_dates else None
+        TASK_NAME,
+        functools.partial(_process_date, mode=mode),
+        _is_date_missing if check_missing_dates else None,
+        workers=workers
     )
 
 
-def main(date=None, date_to=None, idempotent=False, check_missing_dates=False):
+def main(date=None, date_to=None, idempotent=False, check_missing_dates=False, mode=MODE_SET_BASED,
+         workers=1):
     date = common.parse_None(date)
     date_to = common.parse_None(date_to)
     idempotent = common.parse_None(idempotent)
     if idempotent:
         assert not date and not date_to
-        _process_idempotent(check_missing_dates)
+        _process_idempotent(check_missing_dates, mode, workers)
     else:
         assert not check_missing_dates
         if date_to is None:
-            _process_date(date)
+            _process_date(date, mode=mode)
         else:
-            _process_date_range(date, date_to)
+            _process_date_range(date, date_to, mode=mode)
@@ -7,87 +7,56 @@ from collections import defaultdict
 from open_bus_stride_db.db import get_session
 from open_bus_stride_db.model import GtfsData, GtfsDataTask
 
-
-def gtfs_data_task_processing_started(date, task_name):
-    with get_session() as session:
-        gtfs_data = session.query(GtfsData).filter(
-            GtfsData.date == date,
-            GtfsData.processing_success == True
-        ).one_or_none()
-        assert gtfs_data
-        gtfs_data_task = session.query(GtfsDataTask).filter(
-            GtfsDataTask.gtfs_data_id == gtfs_data.id,
-            GtfsDataTask.task_name == task_name
-        ).one_or_none()
-        if gtfs_data_task is None:
-            gtfs_data_task = GtfsDataTask(
-                gtfs_data_id=gtfs_data.id,
-                task_name=task_name,
-                started_at=datetime.datetime.now(datetime.timezone.utc),
-            )
-            session.add(gtfs_data_task)
-            session.commit()
-            return gtfs_data_task.id
-        else:
-            gtfs_data_task.started_at = datetime.datetime.now(datetime.timezone.utc)
-            gtfs_data_task.completed_at = None
-            gtfs_data_task.error = None
-            gtfs_data_task.success = None
-            session.commit()
-            return gtfs_data_task.id
+from .common import process_units
 
 
-def update_gtfs_data_task(gtfs_data_task_id, error=None, success=None):
-    with get_session() as session:
-        gtfs_data_task = session.query(GtfsDataTask).filter(GtfsDataTask.id == gtfs_data_task_id).one_or_none()
-        assert gtfs_data_task
-        gtfs_data_task.completed_at = datetime.datetime.now(datetime.timezone.utc)
-        if success:
-            assert not error
-            gtfs_data_task.success = True
-        else:
-            assert error
-            gtfs_data_task.error = error
-            gtfs_data_task.success = False
+def get_gtfs_data_task_id(session, date, task_name):
+    """returns the id of the date task row, creates it if it doesn't exist"""
+    gtfs_data = session.query(GtfsData).filter(
+        GtfsData.date == date,
+        GtfsData.processing_success == True
+    ).one_or_none()
+    assert gtfs_data
+    gtfs_data_task = session.query(GtfsDataTask).filter(
+        GtfsDataTask.gtfs_data_id == gtfs_data.id,
+        GtfsDataTask.task_name == task_name
+    ).one_or_none()
+    if gtfs_data_task is None:
+        gtfs_data_task = GtfsDataTask(
+            gtfs_data_id=gtfs_data.id,
+            task_name=task_name,
+        )
+        session.add(gtfs_data_task)
         session.commit()
+    return gtfs_data_task.id
 
 
-def gtfs_data_task_set_success(date, task_name):
-    with get_session() as session:
-        gtfs_data = session.query(GtfsData).filter(
-            GtfsData.date == date,
-            GtfsData.processing_success == True
-        ).one_or_none()
-        assert gtfs_data
-        gtfs_data_task = session.query(GtfsDataTask).filter(
-            GtfsDataTask.gtfs_data_id == gtfs_data.id,
-            GtfsDataTask.task_name == task_name
-        ).one_or_none()
-        if gtfs_data_task is None:
-            session.add(GtfsDataTask(
-                gtfs_data_id=gtfs_data.id,
-                task_name=task_name,
-                success=True
-            ))
-            session.commit()
-        else:
-            gtfs_data_task.started_at = None
-            gtfs_data_task.completed_at = None
-            gtfs_data_task.error = None
-            gtfs_data_task.success = True
-            session.commit()
+def lock_gtfs_data_task(session, gtfs_data_task_id):
+    """locks the date task row until the session transaction ends, returns None if it's locked by another run.
+    The row is reloaded after the lock is acquired, so it has the status committed by other runs."""
+    return session.query(GtfsDataTask).filter(
+        GtfsDataTask.id == gtfs_data_task_id
+    ).with_for_update(skip_locked=True).populate_existing().one_or_none()
 
 
-def process_date(date, task_name, process_date_function, stats):
+def process_date(session, gtfs_data_task, date, process_date_function, stats):
     stats['process dates'] += 1
-    gtfs_data_task_id = gtfs_data_task_processing_started(date, task_name)
+    gtfs_data_task.started_at = datetime.datetime.now(datetime.timezone.utc)
+    gtfs_data_task.completed_at = None
+    gtfs_data_task.error = None
+    gtfs_data_task.success = None
     try:
         process_date_function(date, stats)
     except:
-        update_gtfs_data_task(gtfs_data_task_id, error=traceback.format_exc())
+        gtfs_data_task.completed_at = datetime.datetime.now(datetime.timezone.utc)
+        gtfs_data_task.error = traceback.format_exc()
+        gtfs_data_task.success = False
+        session.commit()
         raise
     else:
-        update_gtfs_data_task(gtfs_data_task_id, success=True)
+        gtfs_data_task.completed_at = datetime.datetime.now(datetime.timezone.utc)
+        gtfs_data_task.success = True
+        session.commit()
 
 
 def iterate_missing_dates(task_name):
@@ -110,23 +79,37 @@ def iterate_missing_dates(task_name):
             yield row.date
 
 
-def process_missing_dates(task_name, process_date_function, stats, is_date_missing_function):
-    for date in iterate_missing_dates(task_name):
-        if is_date_missing_function:
-            if is_date_missing_function(date):
-                process_date(date, task_name, process_date_function, stats)
-                return True
-            else:
-                gtfs_data_task_set_success(date, task_name)
+def process_missing_date(date, task_name, process_date_function, stats, is_date_missing_function):
+    """the date is processed while its task row is locked by a dedicated session, the same session updates and commits
+    the task status, so if its connection is lost (which releases the lock) the commit fails and the date stays pending.
+    The lock session is idle in transaction while process_date_function processes the date using its own sessions,
+    the task row must not be updated by other sessions of this run while it's locked."""
+    with get_session() as session:
+        gtfs_data_task = lock_gtfs_data_task(session, get_gtfs_data_task_id(session, date, task_name))
+        if gtfs_data_task is None:
+            print(f'date {date} is locked by another run, skipping')
+            stats['locked dates'] += 1
+        elif gtfs_data_task.success:
+            stats['dates processed by another run'] += 1
+        elif is_date_missing_function and not is_date_missing_function(date):
+            gtfs_data_task.started_at = None
+            gtfs_data_task.completed_at = None
+            gtfs_data_task.error = None
+            gtfs_data_task.success = True
+            session.commit()
+            stats['dates not missing'] += 1
         else:
-            process_date(date, task_name, process_date_function, stats)
-            return True
-    return False
+            process_date(session, gtfs_data_task, date, process_date_function, stats)
 
 
-def main(task_name, process_date_function, is_date_missing_function):
+def main(task_name, process_date_function, is_date_missing_function, workers=1):
     stats = defaultdict(int)
-    while process_missing_dates(task_name, process_date_function, stats, is_date_missing_function):
-        pprint(dict(stats))
+    missing_dates = list(iterate_missing_dates(task_name))
+    print(f'{len(missing_dates)} missing dates')
+    process_units(
+        missing_dates,
+        lambda date, unit_stats: process_missing_date(date, task_name, process_date_function, unit_stats, is_date_missing_function),
+        stats, workers
+    )
     pprint(dict(stats))
     print('OK')
@@ -27,7 +27,9 @@ def packagers():
 @click.option('--timedelta-units', type=str)
 @click.option('--timedelta-amount', type=int)
 @click.option('--output-path', type=str)
-def siri_save_package(start_time, end_time, timedelta_units, timedelta_amount, output_path):
+@click.option('--engine', type=click.Choice(['typed', 'dataflows']), default='typed', show_default=True,
+              help='typed - convert rows in batches and write the csv directly, dataflows - the previous row by row conversion')
+def siri_save_package(start_time, end_time, timedelta_units, timedelta_amount, output_path, engine):
     """Package SIRI data"""
     assert start_time
     if not output_path:
@@ -36,7 +38,7 @@ def siri_save_package(start_time, end_time, timedelta_units, timedelta_amount, o
     if end_time:
         assert not timedelta_units
         assert not timedelta_amount
-        siri.save_package(stats, parse_time(start_time), parse_time(end_time), output_path)
+        siri.save_package(stats, parse_time(start_time), parse_time(end_time), output_path, engine=engine)
     else:
         assert timedelta_units
         assert timedelta_amount
@@ -50,7 +52,15 @@ def siri_save_package(start_time, end_time, timedelta_units, timedelta_amount, o
 @click.option('--verbose', is_flag=True)
 @click.option('--max-packages-per-type', type=int)
 @click.option('--start-date-hour', type=str)
+@click.option('--workers', type=int, default=1, show_default=True, help='Number of hours to process concurrently')
+@click.option('--db-limit', type=int, help='Max number of concurrent DB queries (default: no limit)')
+@click.option('--s3-limit', type=int, help='Max number of concurrent S3 operations (default: no limit)')
+@click.option('--ignore-manifest', is_flag=True, help='Update packages without checking or storing the hour manifests')
+@click.option('--parquet', is_flag=True, help='Upload a parquet file alongside each updated package')
+@click.option('--engine', type=click.Choice(['typed', 'dataflows']), default='typed', show_default=True,
+              help='typed - convert rows in batches and write the csv directly, dataflows - the previous row by row conversion')
 def siri_hourly_update_packages(**kwargs):
+    kwargs['check_manifest'] = not kwargs.pop('ignore_manifest')
     start_date_hour = kwargs.pop('start_date_hour', None)
     if start_date_hour:
         date, hour = start_date_hour.split(' ')
@@ -64,14 +74,46 @@ def siri_hourly_update_packages(**kwargs):
 @click.argument('HOUR', type=int)
 @click.option('--force-update', is_flag=True)
 @click.option('--verbose', is_flag=True)
-def siri_update_package(date, hour, force_update, verbose):
+@click.option('--engine', type=click.Choice(['typed', 'dataflows']), default='typed', show_default=True,
+              help='typed - convert rows in batches and write the csv directly, dataflows - the previous row by row conversion')
+@click.option('--ignore-manifest', is_flag=True, help='Update the package without checking or storing the hour manifest')
+@click.option('--parquet', is_flag=True, help='Upload a parquet file alongside the package')
+def siri_update_package(date, hour, force_update, verbose, engine, ignore_manifest, parquet):
     stats = defaultdict(int)
     start_datetimehour = datetime.datetime.combine(parse_date_str(date), datetime.datetime.min.time().replace(hour=hour))
-    siri.update_package(stats, start_datetimehour, force_update, verbose)
+    siri.update_package(stats, start_datetimehour, force_update, verbose, engine, check_manifest=not ignore_manifest, parquet=parquet)
     pprint(dict(stats))
     print("OK")
 
 
+@packagers.command()
+@click.option('--num-rows', type=int, default=200000, show_default=True)
+def siri_benchmark_package_engines(num_rows):
+    """Compare the rows/sec of the package engines on generated rows"""
+    assert siri.benchmark_engines(num_rows), 'engines wrote different csv files'
+    print("OK")
+
+
+@packagers.command()
+@click.option('--num-rows', type=int, default=200000, show_default=True)
+def siri_benchmark_parquet(num_rows):
+    """Compare file size and read time of the csv zip and parquet formats on generated rows"""
+    siri.benchmark_parquet(num_rows)
+    print("OK")
+
+
+@packagers.command()
+@click.option('--start-date', help='Date string (%Y-%m-%d) of the last day to update. Defaults to today.')
+@click.option('--num-days', type=int, default=35, show_default=True, help='Number of days to update daily rollups for')
+@click.option('--rollup-type', 'rollup_types', type=click.Choice(['daily', 'monthly']), multiple=True,
+              help='Rollup types to update, can be specified multiple times (default: all)')
+@click.option('--verbose', is_flag=True)
+def siri_update_rollups(rollup_types, **kwargs):
+    """Update daily and monthly packages built from the hourly SIRI packages"""
+    from .siri_rollups import update_rollups
+    update_rollups(rollup_types=rollup_types or None, **kwargs)
+
+
 # we already created the index, no need to create it again
 # @packagers.command()
 # @click.option('--only-keys', type=str)
@@ -82,5 +124,42 @@ def siri_update_package(date, hour, force_update, verbose):
 
 @packagers.command()
 @click.option('--index-from-path', is_flag=True)
+@click.option('--engine', type=click.Choice(['external-sort', 'plyvel']), default='external-sort', show_default=True,
+              help='external-sort - sort the rows in binary runs on disk, plyvel - use a temporary LevelDB (the previous behavior)')
+@click.option('--prefetch-workers', type=int, default=2, show_default=True,
+              help='Number of legacy files downloaded concurrently while a file is processed, 0 to download each file only when needed')
+@click.option('--prefetch-max-mb', type=int, default=2048, show_default=True,
+              help='Max total size of downloaded legacy files waiting to be processed')
+@click.option('--decoder', type=click.Choice(['fast', 'dataflows']), default='fast', show_default=True,
+              help='fast - read the legacy files with the csv module and cached timezone offsets, dataflows - use DF.load (the previous behavior)')
+@click.option('--planner', type=click.Choice(['components', 'expand']), default='expand', show_default=True,
+              help='expand - expand batches from the keys hours 4 times (the previous behavior), '
+                   'components - batches of connected keys and hours limited by --max-batch-rows, required for --workers > 1, '
+                   'its batch ids depend on --max-batch-rows and don\'t match the expand batch ids, so completed batches are redone')
+@click.option('--max-batch-rows', type=int, default=50000000, show_default=True,
+              help='Max estimated rows of the keys loaded by a batch, based on the index num_rows')
+@click.option('--plan-only', is_flag=True, help='Print the batches plan without processing')
+@click.option('--workers', type=int, default=1, show_default=True,
+              help='Number of batches processed in parallel, each in a separate process')
+@click.option('--max-disk-mb', type=int, default=51200, show_default=True,
+              help='Max estimated scratch disk usage of the batches processed in parallel')
 def siri_legacy_update_packages_from_index(**kwargs):
     siri.legacy_update_packages_from_index(**kwargs)
+
+
+@packagers.command()
+@click.option('--num-rows', type=int, default=2000000, show_default=True)
+@click.option('--num-hours', type=int, default=48, show_default=True)
+def siri_benchmark_legacy_engines(num_rows, num_hours):
+    """Compare wall time, disk usage and peak RSS of the legacy packages engines on generated rows"""
+    assert siri.benchmark_legacy_engines(num_rows, num_hours), 'engines returned different rows'
+    print("OK")
+
+
+@packagers.command()
+@click.argument('FILENAMES', nargs=-1)
+@click.option('--num-rows', type=int, default=200000, show_default=True, help='Number of generated rows if no filenames are given')
+def siri_benchmark_legacy_decoders(filenames, num_rows):
+    """Compare rows/sec of the legacy decoders on the given legacy csv.gz files or on a generated file"""
+    assert siri.benchmark_legacy_decoders(filenames, num_rows), 'decoders returned different rows'
+    print("OK")
@@ -1,6 +1,11 @@
 import os
+import json
 import time
+import threading
 import traceback
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import datetime
@@ -11,13 +16,30 @@ ENDPOINT_URL = 'https://s3.eu-west-2.wasabisys.com'
 BUCKET_NAME = 'stride'
 
 
+class ConcurrencyLimits:
+    """context managers which limit the number of concurrent DB queries and S3 operations across worker threads,
+    a limit of None or 0 means no limit"""
+
+    def __init__(self, db=None, s3=None):
+        self.db = threading.BoundedSemaphore(int(db)) if db else nullcontext()
+        self.s3 = threading.BoundedSemaphore(int(s3)) if s3 else nullcontext()
+
+
+_thread_local = threading.local()
+
+
 def get_s3():
-    return boto3.client(
-        's3',
-        endpoint_url=ENDPOINT_URL,
-        aws_access_key_id=os.environ['WASABI_ACCESS_KEY_ID'],
-        aws_secret_access_key=os.environ['WASABI_SECRET_ACCESS_KEY'],
-    )
+    """returns an s3 client of the current thread, the boto3 default session is not thread-safe so each thread
+    creates its client from its own session (the packagers process units and prefetch files in worker threads)"""
+    s3 = getattr(_thread_local, 's3', None)
+    if s3 is None:
+        s3 = _thread_local.s3 = boto3.session.Session().client(
+            's3',
+            endpoint_url=ENDPOINT_URL,
+            aws_access_key_id=os.environ['WASABI_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['WASABI_SECRET_ACCESS_KEY'],
+        )
+    return s3
 
 
 def get_file_last_modified(name) -> datetime.datetime:
@@ -39,6 +61,21 @@ def download_file(key, filename):
     get_s3().download_file(BUCKET_NAME, key, filename)
 
 
+def download_json(key):
+    """returns the parsed json object stored in key, or None if the key does not exist"""
+    try:
+        return json.loads(get_s3().get_object(Bucket=BUCKET_NAME, Key=key)['Body'].read())
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+            return None
+        else:
+            raise
+
+
+def upload_json(data, key):
+    get_s3().put_object(Bucket=BUCKET_NAME, Key=key, Body=json.dumps(data).encode('utf-8'), ContentType='application/json')
+
+
 def download_legacy_file(bucket_name, key, filename, retries=None):
     if retries is None:
         try:
@@ -62,10 +99,85 @@ def download_legacy_file(bucket_name, key, filename, retries=None):
         return False
 
 
-def iterate_keys(bucket_name, key_prefix):
+def get_legacy_file_size(bucket_name, key):
+    """returns the size in bytes of the legacy file, or None if it does not exist"""
+    try:
+        return get_s3().head_object(Bucket=bucket_name, Key=key)['ContentLength']
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == "404":
+            return None
+        else:
+            raise
+
+
+def _download_legacy_file_timed(bucket_name, key, filename, retries):
+    start_time = time.time()
+    res = download_legacy_file(bucket_name, key, filename, retries=retries)
+    return res, time.time() - start_time
+
+
+def iterate_prefetched_legacy_files(bucket_name, keys, tmpdir, stats, workers=2, max_prefetch_bytes=2 * 1024 * 1024 * 1024, retries=5):
+    """keys is a list of (key_id, key) tuples, yields a tuple of (key_id, key, filename, downloaded) for each key, in order.
+    Upcoming keys are downloaded by a pool of workers while the current key is processed, the total size of downloaded
+    files which were not processed yet is limited to max_prefetch_bytes (but the next key is always downloaded).
+    Each file is deleted when the next key is requested. With workers=0 the keys are downloaded one by one when requested.
+    The download workers and the calling thread (which gets the file sizes) each use their own s3 client, see get_s3."""
+    workers = int(workers or 0)
+    max_prefetch_bytes = int(max_prefetch_bytes)
+    keys = list(keys)
+    next_key_num = 0
+    pending = deque()
+    pending_bytes = 0
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+
+        def submit_downloads():
+            nonlocal next_key_num, pending_bytes
+            while next_key_num < len(keys) and (not pending or len(pending) <= workers):
+                key_id, key = keys[next_key_num]
+                size = get_legacy_file_size(bucket_name, key) or 0
+                if pending and pending_bytes + size > max_prefetch_bytes:
+                    stats['legacy_prefetch_disk_limit_waits'] += 1
+                    break
+                filename = os.path.join(tmpdir, f'prefetch_{next_key_num}.csv.gz')
+                pending.append((key_id, key, filename, size, executor.submit(_download_legacy_file_timed, bucket_name, key, filename, retries)))
+                pending_bytes += size
+                next_key_num += 1
+
+        while True:
+            submit_downloads()
+            if not pending:
+                break
+            key_id, key, filename, size, future = pending.popleft()
+            wait_start_time = time.time()
+            downloaded, download_seconds = future.result()
+            wait_seconds = time.time() - wait_start_time
+            if workers:
+                # downloads of the following keys continue while the current key is processed
+                submit_downloads()
+            process_start_time = time.time()
+            yield key_id, key, filename, downloaded
+            process_seconds = time.time() - process_start_time
+            print(f'key {key_id}: {size} bytes, download {download_seconds:.1f}s, waited {wait_seconds:.1f}s, processed {process_seconds:.1f}s')
+            stats['legacy_keys'] += 1
+            stats['legacy_download_bytes'] += size
+            stats['legacy_download_seconds'] += download_seconds
+            stats['legacy_download_wait_seconds'] += wait_seconds
+            stats['legacy_process_seconds'] += process_seconds
+            if os.path.exists(filename):
+                os.remove(filename)
+            pending_bytes -= size
+
+
+def iterate_objects(bucket_name, key_prefix):
+    """yields the list_objects_v2 object dicts (Key, ETag, Size, LastModified...) of non-empty objects"""
     paginator = get_s3().get_paginator('list_objects_v2')
     for page in paginator.paginate(Bucket=bucket_name, Prefix=key_prefix):
         if 'Contents' in page:
             for obj in page['Contents']:
                 if obj['Size'] > 0:
-                    yield obj['Key']
+                    yield obj
+
+
+def iterate_keys(bucket_name, key_prefix):
+    for obj in iterate_objects(bucket_name, key_prefix):
+        yield obj['Key']
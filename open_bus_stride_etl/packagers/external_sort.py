@@ -0,0 +1,122 @@
+import io
+import os
+import gzip
+import heapq
+import struct
+from operator import itemgetter
+
+
+# max number of records kept in memory before they are sorted and written to a run file
+RUN_SIZE = 500000
+READ_BUFFER_SIZE = 1024 * 1024
+# run files are gzip compressed with the fastest level, the encoded rows have many repeated values
+RUNS_COMPRESS_LEVEL = 1
+
+RECORD_LENGTH = struct.Struct('<I')
+FIELDS_SEPARATOR = '\x00'
+NONE_VALUE = '\x01'
+
+
+def encode_record(record):
+    """record is a tuple of strings or None values (the first one is the sort key), encoded as a length prefixed utf-8 payload"""
+    payload = FIELDS_SEPARATOR.join(NONE_VALUE if value is None else value for value in record).encode('utf-8')
+    return RECORD_LENGTH.pack(len(payload)) + payload
+
+
+def decode_record(payload):
+    return tuple(None if value == NONE_VALUE else value for value in payload.decode('utf-8').split(FIELDS_SEPARATOR))
+
+
+def iterate_run_file(filename):
+    with open(filename, 'rb', buffering=READ_BUFFER_SIZE) as raw_file, gzip.GzipFile(fileobj=raw_file) as gzip_file, \
+            io.BufferedReader(gzip_file, READ_BUFFER_SIZE) as f:
+        while True:
+            length = f.read(RECORD_LENGTH.size)
+            if not length:
+                break
+            yield decode_record(f.read(RECORD_LENGTH.unpack(length)[0]))
+
+
+class ExternalSorter:
+    """Sorts records which don't fit in memory: records are added in any order, and are written to disk in sorted runs
+    of up to run_size records, iterate() merges the runs and yields all the records sorted by their first field.
+    Records are tuples of strings or None values, strings may not contain FIELDS_SEPARATOR or be equal to NONE_VALUE."""
+
+    def __init__(self, path, run_size=RUN_SIZE):
+        self.path = path
+        self.run_size = run_size
+        self.run_filenames = []
+        self.num_records = 0
+        self._records = []
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, record):
+        # records are kept in memory encoded, which takes much less memory than the tuples of strings
+        self._records.append((record[0], encode_record(record)))
+        self.num_records += 1
+        if len(self._records) >= self.run_size:
+            self._write_run()
+
+    def _write_run(self):
+        self._records.sort(key=itemgetter(0))
+        filename = os.path.join(self.path, f'run_{len(self.run_filenames)}.bin')
+        with gzip.open(filename, 'wb', compresslevel=RUNS_COMPRESS_LEVEL) as f:
+            f.writelines(encoded_record for _, encoded_record in self._records)
+        self.run_filenames.append(filename)
+        self._records = []
+
+    def get_disk_usage_bytes(self):
+        return sum(os.path.getsize(filename) for filename in self.run_filenames)
+
+    def iterate(self):
+        if not self.run_filenames:
+            self._records.sort(key=itemgetter(0))
+            for _, encoded_record in self._records:
+                yield decode_record(encoded_record[RECORD_LENGTH.size:])
+        else:
+            if self._records:
+                self._write_run()
+            yield from heapq.merge(*[iterate_run_file(filename) for filename in self.run_filenames], key=itemgetter(0))
+
+
+class _PeekableIterator:
+
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self._next = None
+        self._has_next = False
+
+    def peek(self):
+        if not self._has_next:
+            self._next = next(self._iterator, None)
+            self._has_next = True
+        return self._next
+
+    def pop(self):
+        record = self.peek()
+        self._has_next = False
+        return record
+
+
+def iterate_key_ranges(sorted_records, key_ranges):
+    """sorted_records is an iterator of records sorted by key (the first field),
+    key_ranges is a list of (start_key, stop_key) ranges sorted by start_key which don't overlap.
+    yields a tuple of (key_range, range_records_iterator) for each range, including ranges without records,
+    records outside of all the ranges are skipped, each range_records_iterator must be consumed before the next one"""
+    records = _PeekableIterator(iter(sorted_records))
+
+    def iterate_range_records(start_key, stop_key):
+        while True:
+            record = records.peek()
+            if record is None or record[0] >= stop_key:
+                break
+            records.pop()
+            if record[0] >= start_key:
+                yield record
+
+    for start_key, stop_key in key_ranges:
+        range_records = iterate_range_records(start_key, stop_key)
+        yield (start_key, stop_key), range_records
+        # skip any records which were not consumed
+        for _ in range_records:
+            pass
@@ -0,0 +1,119 @@
+from collections import namedtuple
+
+
+# hours - the hours which the batch creates packages for, keys - all the keys which have rows in these hours,
+# estimated_rows - sum of the keys num_rows (each key file is fully loaded, even if some of its rows are in other batches)
+LegacyBatch = namedtuple('LegacyBatch', ['batch_id', 'hours', 'keys', 'estimated_rows'])
+
+
+class UnionFind:
+
+    def __init__(self):
+        self._parents = {}
+
+    def find(self, item):
+        parent = self._parents.setdefault(item, item)
+        if parent != item:
+            root = item
+            while self._parents[root] != root:
+                root = self._parents[root]
+            # path compression
+            while self._parents[item] != root:
+                self._parents[item], item = root, self._parents[item]
+            parent = root
+        return parent
+
+    def union(self, item, other_item):
+        root, other_root = self.find(item), self.find(other_item)
+        if root != other_root:
+            self._parents[other_root] = root
+
+    def iterate_groups(self):
+        groups = {}
+        for item in self._parents:
+            groups.setdefault(self.find(item), []).append(item)
+        yield from groups.values()
+
+
+def get_components(hour_keys):
+    """returns a list of (hours, keys) tuples of the connected components of the key-hour graph, sorted by first hour,
+    all the keys which have rows in a component hour are in the same component, so the components are independent"""
+    keys_union_find = UnionFind()
+    for keys in hour_keys.values():
+        keys = iter(keys)
+        first_key = next(keys)
+        keys_union_find.find(first_key)
+        for key in keys:
+            keys_union_find.union(first_key, key)
+    key_component_ids = {}
+    for component_id, keys in enumerate(keys_union_find.iterate_groups()):
+        for key in keys:
+            key_component_ids[key] = component_id
+    components_hours = {}
+    for hour, keys in hour_keys.items():
+        components_hours.setdefault(key_component_ids[next(iter(keys))], set()).add(hour)
+    return sorted(
+        ((hours, set.union(*(set(hour_keys[hour]) for hour in hours))) for hours in components_hours.values()),
+        key=lambda component: min(component[0])
+    )
+
+
+def get_batch_id(hours):
+    return f'{min(hours):%Y%m%d%H}-{max(hours):%Y%m%d%H}-{len(hours)}'
+
+
+def plan_batches(hour_keys, keys_num_rows, max_batch_rows):
+    """plans the batches so that the estimated rows of each batch are at most max_batch_rows:
+    small components are merged with the following components, and large components are split by hour ranges,
+    keys of a split component are loaded by all the batches which have one of their hours.
+    A single hour which exceeds max_batch_rows is planned as its own batch.
+    Batch ids depend only on the batch hours, so they are stable between runs with the same index and max_batch_rows."""
+    batches = []
+    batch_hours, batch_keys, batch_rows = [], set(), 0
+
+    def flush():
+        nonlocal batch_hours, batch_keys, batch_rows
+        if batch_hours:
+            batches.append(LegacyBatch(get_batch_id(batch_hours), set(batch_hours), batch_keys, batch_rows))
+        batch_hours, batch_keys, batch_rows = [], set(), 0
+
+    for hours, keys in get_components(hour_keys):
+        component_rows = sum(keys_num_rows[key] for key in keys)
+        if component_rows <= max_batch_rows:
+            if batch_rows + component_rows > max_batch_rows:
+                flush()
+            batch_hours += hours
+            batch_keys |= keys
+            batch_rows += component_rows
+        else:
+            flush()
+            for hour in sorted(hours):
+                new_keys = set(hour_keys[hour]) - batch_keys
+                new_rows = sum(keys_num_rows[key] for key in new_keys)
+                if batch_rows + new_rows > max_batch_rows:
+                    flush()
+                    new_keys, new_rows = set(hour_keys[hour]), sum(keys_num_rows[key] for key in hour_keys[hour])
+                batch_hours.append(hour)
+                batch_keys |= new_keys
+                batch_rows += new_rows
+            flush()
+    flush()
+    return batches
+
+
+def print_plan(batches, keys_num_rows, max_batch_rows):
+    """prints the batches with their estimated cost, and a summary of the plan"""
+    keys_num_batches = {}
+    for batch in batches:
+        print(f'batch {batch.batch_id}: {len(batch.keys)} keys, {len(batch.hours)} hours, {batch.estimated_rows} estimated rows'
+              f'{" (over max batch rows)" if batch.estimated_rows > max_batch_rows else ""}')
+        for key in batch.keys:
+            keys_num_batches[key] = keys_num_batches.get(key, 0) + 1
+    total_rows = sum(keys_num_rows[key] for key in keys_num_batches)
+    total_loaded_rows = sum(batch.estimated_rows for batch in batches)
+    print(f'Planned {len(batches)} batches (max batch rows: {max_batch_rows})')
+    print(f'{len(keys_num_batches)} keys, {total_rows} rows, '
+          f'{sum(1 for num_batches in keys_num_batches.values() if num_batches > 1)} keys loaded by more than one batch '
+          f'({total_loaded_rows} estimated loaded rows)')
+    for batch in sorted(batches, key=lambda batch: batch.estimated_rows, reverse=True)[:5]:
+        print(f'largest batch {batch.batch_id}: {len(batch.keys)} keys, {len(batch.hours)} hours, {batch.estimated_rows} estimated rows')
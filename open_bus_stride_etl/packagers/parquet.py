@@ -0,0 +1,144 @@
+import os
+import csv
+import time
+import zipfile
+import tempfile
+
+
+# number of rows buffered before writing a parquet row group
+ROW_GROUP_SIZE = 100000
+
+ARROW_TYPE_INT = 'int'
+ARROW_TYPE_FLOAT = 'float'
+ARROW_TYPE_DATETIME = 'datetime'
+ARROW_TYPE_STRING = 'string'
+# low cardinality strings, stored as dictionary columns (categorical when loaded with pandas)
+ARROW_TYPE_DICTIONARY = 'dictionary'
+
+# types of the packagers.siri.SQL_TEMPLATE columns, unknown columns are stored as strings
+FIELD_TYPES = {
+    'id': ARROW_TYPE_INT,
+    'bearing': ARROW_TYPE_FLOAT,
+    'distance_from_journey_start': ARROW_TYPE_FLOAT,
+    'distance_from_siri_ride_stop_meters': ARROW_TYPE_FLOAT,
+    'lat': ARROW_TYPE_FLOAT,
+    'lon': ARROW_TYPE_FLOAT,
+    'recorded_at_time': ARROW_TYPE_DATETIME,
+    'velocity': ARROW_TYPE_FLOAT,
+    'siri_stop_order': ARROW_TYPE_INT,
+    'siri_scheduled_start_time': ARROW_TYPE_DATETIME,
+    'siri_duration_minutes': ARROW_TYPE_FLOAT,
+    'siri_journey_ref': ARROW_TYPE_STRING,
+    'siri_vehicle_ref': ARROW_TYPE_DICTIONARY,
+    'siri_stop_code': ARROW_TYPE_INT,
+    'siri_operator_ref': ARROW_TYPE_INT,
+    'siri_line_ref': ARROW_TYPE_INT,
+    'siri_snapshot_id': ARROW_TYPE_DICTIONARY,
+    'gtfs_journey_ref': ARROW_TYPE_STRING,
+    'gtfs_start_time': ARROW_TYPE_DATETIME,
+    'gtfs_end_time': ARROW_TYPE_DATETIME,
+    'gtfs_stop_code': ARROW_TYPE_INT,
+    'gtfs_stop_lat': ARROW_TYPE_FLOAT,
+    'gtfs_stop_lon': ARROW_TYPE_FLOAT,
+    'gtfs_stop_city': ARROW_TYPE_DICTIONARY,
+    'gtfs_stop_name': ARROW_TYPE_DICTIONARY,
+    'gtfs_arrival_time': ARROW_TYPE_DATETIME,
+    'gtfs_departure_time': ARROW_TYPE_DATETIME,
+    'gtfs_drop_off_type': ARROW_TYPE_INT,
+    'gtfs_pickup_type': ARROW_TYPE_INT,
+    'gtfs_shape_dist_traveled': ARROW_TYPE_FLOAT,
+    'gtfs_stop_sequence': ARROW_TYPE_INT,
+    'gtfs_line_ref': ARROW_TYPE_INT,
+    'gtfs_operator_ref': ARROW_TYPE_INT,
+    'gtfs_agency_name': ARROW_TYPE_DICTIONARY,
+    'gtfs_route_short_name': ARROW_TYPE_DICTIONARY,
+    'gtfs_route_long_name': ARROW_TYPE_DICTIONARY,
+    'gtfs_route_type': ARROW_TYPE_DICTIONARY,
+    'gtfs_route_alternative': ARROW_TYPE_DICTIONARY,
+    'gtfs_route_direction': ARROW_TYPE_DICTIONARY,
+    'gtfs_route_mkt': ARROW_TYPE_DICTIONARY,
+}
+
+
+def get_arrow_type(field_name):
+    import pyarrow as pa
+    field_type = FIELD_TYPES.get(field_name, ARROW_TYPE_STRING)
+    if field_type == ARROW_TYPE_INT:
+        return pa.int64()
+    elif field_type == ARROW_TYPE_FLOAT:
+        return pa.float64()
+    elif field_type == ARROW_TYPE_DATETIME:
+        # DB datetimes are naive UTC values
+        return pa.timestamp('us', tz='UTC')
+    elif field_type == ARROW_TYPE_DICTIONARY:
+        return pa.dictionary(pa.int32(), pa.string())
+    else:
+        return pa.string()
+
+
+class ParquetWriter:
+    """Writes rows (sequences of DB values in field_names order) to a parquet file,
+    rows are buffered and written in row groups of up to row_group_size rows, so memory is bounded"""
+
+    def __init__(self, filename, field_names, row_group_size=ROW_GROUP_SIZE):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self._pa = pa
+        self.schema = pa.schema([(field_name, get_arrow_type(field_name)) for field_name in field_names])
+        self.row_group_size = row_group_size
+        self.num_rows = 0
+        self._rows = []
+        self._writer = pq.ParquetWriter(filename, self.schema, compression='zstd')
+
+    def _write_row_group(self):
+        if self._rows:
+            columns = zip(*self._rows)
+            self._writer.write_table(self._pa.Table.from_arrays([
+                self._pa.array(values, type=field.type.value_type).dictionary_encode()
+                if self._pa.types.is_dictionary(field.type) else self._pa.array(values, type=field.type)
+                for field, values in zip(self.schema, columns)
+            ], schema=self.schema))
+            self.num_rows += len(self._rows)
+            self._rows = []
+
+    def write_rows(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= self.row_group_size:
+            self._write_row_group()
+
+    def close(self):
+        self._write_row_group()
+        self._writer.close()
+
+
+def benchmark(field_names, rows, write_csv_package):
+    """compares file size and read time of a zipped csv package and a parquet file of the given rows,
+    write_csv_package(output_path) should write the csv package of the same rows"""
+    import pyarrow.parquet as pq
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_csv_package(os.path.join(tmpdir, 'package'))
+        zip_filename = os.path.join(tmpdir, 'package.zip')
+        with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.write(os.path.join(tmpdir, 'package', 'res_1.csv'), 'res_1.csv')
+        parquet_filename = os.path.join(tmpdir, 'package.parquet')
+        start_time = time.time()
+        writer = ParquetWriter(parquet_filename, field_names)
+        writer.write_rows(rows)
+        writer.close()
+        parquet_write_seconds = time.time() - start_time
+        start_time = time.time()
+        with zipfile.ZipFile(zip_filename) as zf:
+            with zf.open('res_1.csv') as f:
+                num_csv_rows = sum(1 for _ in csv.reader(line.decode('utf-8') for line in f)) - 1
+        csv_read_seconds = time.time() - start_time
+        start_time = time.time()
+        num_parquet_rows = pq.read_table(parquet_filename).num_rows
+        parquet_read_seconds = time.time() - start_time
+        start_time = time.time()
+        pq.read_table(parquet_filename, columns=['lat', 'lon'])
+        parquet_read_columns_seconds = time.time() - start_time
+        assert num_csv_rows == num_parquet_rows == len(rows)
+        print(f'parquet write: {parquet_write_seconds:.2f}s')
+        print(f'csv zip: {os.path.getsize(zip_filename)} bytes, read: {csv_read_seconds:.2f}s')
+        print(f'parquet: {os.path.getsize(parquet_filename)} bytes, read: {parquet_read_seconds:.2f}s, '
+              f'read lat/lon columns: {parquet_read_columns_seconds:.2f}s')
@@ -1,5 +1,10 @@
 import os
+import csv
+import gzip
 import json
+import time
+import random
+import hashlib
 import shutil
 import zipfile
 import datetime
@@ -10,12 +15,15 @@ from textwrap import dedent
 from collections import defaultdict
 
 import pytz
-import plyvel
 import dataflows as DF
 
-from ..common import now
+from . import parquet, external_sort, legacy_planner
+from ..common import now, process_units
 from open_bus_stride_db import db
-from .common import get_file_last_modified, upload_file, download_file, download_legacy_file, iterate_keys
+from .common import (
+    get_file_last_modified, upload_file, download_file, download_legacy_file, iterate_keys, ConcurrencyLimits,
+    download_json, upload_json, iterate_prefetched_legacy_files
+)
 
 # can use this to force update after code changes
 FORCE_UPDATE_IF_FILE_LAST_MODIFIED_BEFORE = None
@@ -23,6 +31,13 @@ FORCE_UPDATE_IF_FILE_LAST_MODIFIED_BEFORE = None
 UPDATE_PACKAGE_RES_PACKAGE_EXISTS = 'package_exists'
 UPDATE_PACKAGE_RES_SAME_HASH = 'same_hash'
 UPDATE_PACKAGE_RES_LEGACY_NOT_EXISTS = 'legacy_not_exists'
+UPDATE_PACKAGE_RES_SAME_FINGERPRINT = 'same_fingerprint'
+# typed - converts rows in batches with per-column formatters and writes the csv directly
+# dataflows - converts each row with get_row and writes using dataflows (the previous behavior)
+ENGINE_TYPED = 'typed'
+ENGINE_DATAFLOWS = 'dataflows'
+ENGINES = [ENGINE_TYPED, ENGINE_DATAFLOWS]
+SQL_FETCH_BATCH_SIZE = 10000
 STRIDE_FIRST_DATETIME = datetime.datetime(2022, 3, 15, 0).astimezone(pytz.timezone('israel'))
 SQL_TEMPLATE = dedent('''
     select
@@ -66,6 +81,62 @@ SQL_TEMPLATE = dedent('''
         sr.id, svl.recorded_at_time
 ''')
 
+# cheap summary of the source rows of a package, if it didn't change since the package was created the package is skipped
+# instead of joining all the package tables per vehicle location, the vehicle locations ids are aggregated once and the
+# related rides / ride stops / gtfs rides are aggregated per distinct row, it covers new / deleted vehicle locations,
+# the updates made by the siri etl tasks after the vehicle locations were added (max updated timestamp of the rides and
+# the gtfs ids matched to the rides and ride stops) and the gtfs ride start/end times set by gtfs update_ride_aggregations,
+# the other joined gtfs rows are only changed by reloading the gtfs data which also changes the matched gtfs ids
+FINGERPRINT_SQL_TEMPLATE = dedent('''
+    with svl as (
+        select id, siri_ride_stop_id, distance_from_siri_ride_stop_meters
+        from siri_vehicle_location
+        where recorded_at_time >= '{min_time_utc}' and recorded_at_time < '{max_time_utc}'
+    ), srs as (
+        select id, siri_ride_id, gtfs_stop_id
+        from siri_ride_stop
+        where id in (select siri_ride_stop_id from svl)
+    ), sr as (
+        select id, gtfs_ride_id, updated_duration_minutes
+        from siri_ride
+        where id in (select siri_ride_id from srs)
+    ), gr as (
+        select id, start_time, end_time
+        from gtfs_ride
+        where id in (select gtfs_ride_id from sr)
+    )
+    select
+        svl_agg.*, srs_agg.*, sr_agg.*, gr_agg.*
+    from
+        (
+            select
+                count(1) num_rows, max(id) max_id, sum(id) sum_id,
+                count(distance_from_siri_ride_stop_meters) num_distances,
+                sum(distance_from_siri_ride_stop_meters) sum_distances
+            from svl
+        ) svl_agg,
+        (
+            select
+                count(1) num_ride_stops, sum(id) sum_ride_stop_id,
+                count(gtfs_stop_id) num_gtfs_stops, sum(gtfs_stop_id) sum_gtfs_stop_id
+            from srs
+        ) srs_agg,
+        (
+            select
+                count(1) num_rides, sum(id) sum_ride_id,
+                count(updated_duration_minutes) num_updated_duration_minutes,
+                max(updated_duration_minutes) max_updated_duration_minutes,
+                count(gtfs_ride_id) num_gtfs_rides, sum(gtfs_ride_id) sum_gtfs_ride_id
+            from sr
+        ) sr_agg,
+        (
+            select
+                count(start_time) num_gtfs_start_times, sum(extract(epoch from start_time)) sum_gtfs_start_times,
+                count(end_time) num_gtfs_end_times, sum(extract(epoch from end_time)) sum_gtfs_end_times
+            from gr
+        ) gr_agg
+''')
+
 
 def get_row(row):
     for k, v in row.items():
@@ -80,6 +151,58 @@ def get_row(row):
     return row
 
 
+# columns of SQL_TEMPLATE which contain datetime values, all other columns are converted to strings
+SQL_DATETIME_FIELDS = {
+    'recorded_at_time', 'siri_scheduled_start_time', 'gtfs_start_time', 'gtfs_end_time',
+    'gtfs_arrival_time', 'gtfs_departure_time',
+}
+
+
+class IsraelDatetimeFormatter:
+    """formats UTC datetimes the same as get_row, but caches the Israel timezone offset per UTC hour
+    (timezone offset changes always happen on a whole hour), avoiding pytz conversion for each value"""
+
+    def __init__(self):
+        self._hour_offsets = {}
+
+    def _get_hour_offset(self, hour_key):
+        hour_offset = self._hour_offsets.get(hour_key)
+        if hour_offset is None:
+            israel_dt = datetime.datetime(*hour_key, tzinfo=pytz.UTC).astimezone(pytz.timezone('israel'))
+            offset = israel_dt.utcoffset()
+            hour_offset = self._hour_offsets[hour_key] = (offset, israel_dt.isoformat()[19:])
+        return hour_offset
+
+    def __call__(self, value):
+        if value is None:
+            return ''
+        if value.tzinfo is not None:
+            value = value.replace(tzinfo=None)
+        offset, offset_str = self._get_hour_offset((value.year, value.month, value.day, value.hour))
+        return (value + offset).isoformat() + offset_str
+
+
+def format_value(value):
+    if value is None:
+        return ''
+    elif isinstance(value, str):
+        return value
+    else:
+        return str(value)
+
+
+def get_field_formatters(field_names):
+    datetime_formatter = IsraelDatetimeFormatter()
+    return [
+        datetime_formatter if field_name in SQL_DATETIME_FIELDS else format_value
+        for field_name in field_names
+    ]
+
+
+def format_rows(formatters, rows):
+    return [[formatter(value) for formatter, value in zip(formatters, row)] for row in rows]
+
+
 def db_datetime(dt):
     return dt.astimezone(pytz.UTC).replace(tzinfo=None).strftime('%Y-%m-%d %H:%M:%S')
 
@@ -109,6 +232,109 @@ def sql_iterator(stats, min_time: datetime.datetime, max_time: datetime.datetime
         print(f'{(now() - start_time).total_seconds()}s: finished processing last row from DB ({stats["rows"]} rows)')
 
 
+def typed_sql_iterator(stats, min_time: datetime.datetime, max_time: datetime.datetime, verbose=False, parquet_filename=None):
+    """yields the field names and then batches of rows as lists of formatted strings, in the same format as sql_iterator
+    if parquet_filename is set, the typed rows are also written to this parquet file"""
+    start_time = now()
+    if verbose:
+        print(f'{start_time} iterating over sql from {min_time} to {max_time}')
+    sql = SQL_TEMPLATE.format(
+        min_date_utc=db_date(min_time - datetime.timedelta(days=2)),
+        max_date_utc=db_date(max_time + datetime.timedelta(days=2)),
+        min_time_utc=db_datetime(min_time),
+        max_time_utc=db_datetime(max_time),
+    )
+    with db.get_session() as session:
+        result = session.execute(sql, execution_options={'stream_results': True})
+        field_names = list(result.keys())
+        formatters = get_field_formatters(field_names)
+        parquet_writer = parquet.ParquetWriter(parquet_filename, field_names) if parquet_filename else None
+        yield field_names
+        while True:
+            rows = result.fetchmany(SQL_FETCH_BATCH_SIZE)
+            if not rows:
+                break
+            if verbose and stats['rows'] == 0:
+                print(f'{(now()-start_time).total_seconds()}s: got first rows from DB')
+            stats['rows'] += len(rows)
+            if parquet_writer:
+                parquet_writer.write_rows(rows)
+            yield format_rows(formatters, rows)
+        if parquet_writer:
+            parquet_writer.close()
+    if verbose:
+        print(f'{(now() - start_time).total_seconds()}s: finished processing last row from DB ({stats["rows"]} rows)')
+
+
+def write_package(output_path, field_names, rows_batches):
+    """writes a package in the same layout as DF.dump_to_path (res_1.csv + datapackage.json) with a declared schema,
+    all fields are declared as strings, same as the schema inferred by dataflows from the get_row values"""
+    os.makedirs(output_path, exist_ok=True)
+    num_rows = 0
+    with open(os.path.join(output_path, 'res_1.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(field_names)
+        for rows in rows_batches:
+            writer.writerows(rows)
+            num_rows += len(rows)
+    write_datapackage(output_path, field_names, num_rows)
+    return num_rows
+
+
+def get_file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def write_datapackage(output_path, field_names, num_rows):
+    """writes the datapackage.json for an existing res_1.csv in output_path"""
+    csv_filename = os.path.join(output_path, 'res_1.csv')
+    csv_hash, csv_bytes = get_file_md5(csv_filename), os.path.getsize(csv_filename)
+    with open(os.path.join(output_path, 'datapackage.json'), 'w') as f:
+        json.dump({
+            'profile': 'data-package',
+            'resources': [{
+                'name': 'res_1',
+                'path': 'res_1.csv',
+                'profile': 'tabular-data-resource',
+                'format': 'csv',
+                'mediatype': 'text/csv',
+                'encoding': 'utf-8',
+                'schema': {
+                    'fields': [{'name': field_name, 'type': 'string', 'format': 'default'} for field_name in field_names],
+                    'missingValues': [''],
+                },
+                'bytes': csv_bytes,
+                'hash': csv_hash,
+            }],
+            'bytes': csv_bytes,
+            'count_of_rows': num_rows,
+            'hash': csv_hash,
+        }, f, indent=2)
+
+
+def save_package_typed(stats, start_time, end_time, output_path, verbose=False, parquet_filename=None):
+    iterator = typed_sql_iterator(stats, start_time, end_time, verbose, parquet_filename)
+    field_names = next(iterator)
+    write_package(output_path, field_names, iterator)
+
+
+def get_fingerprint(min_time: datetime.datetime, max_time: datetime.datetime):
+    with db.get_session() as session:
+        row = session.execute(FINGERPRINT_SQL_TEMPLATE.format(
+            min_time_utc=db_datetime(min_time),
+            max_time_utc=db_datetime(max_time),
+        )).one()
+    return get_row(dict(row))
+
+
+def get_manifest_path(start_datetimehour: datetime.datetime):
+    return start_datetimehour.strftime('stride-etl-packages/siri/manifests/%Y/%m/%Y-%m-%d.%H.json')
+
+
 def sql_iterator_timedelta(stats, start_time: datetime.datetime, timedelta_units, timedelta_amount):
     end_time = start_time + datetime.timedelta(**{timedelta_units: timedelta_amount})
     time = start_time
@@ -128,13 +354,85 @@ def save_package_timedelta(stats, start_time, timedelta_units, timedelta_amount,
     ).process()
 
 
-def save_package(stats, start_time, end_time, output_path, verbose=False):
+def save_package(stats, start_time, end_time, output_path, verbose=False, engine=ENGINE_TYPED, parquet_filename=None):
+    assert engine in ENGINES, f'invalid engine: {engine}'
+    assert not parquet_filename or engine == ENGINE_TYPED, f'parquet output is supported only by the {ENGINE_TYPED} engine'
     if verbose:
-        print(f'Packaging siri data {start_time} -> {end_time} -> {output_path}')
-    DF.Flow(
-        sql_iterator(stats, start_time, end_time, verbose),
-        DF.dump_to_path(output_path),
-    ).process()
+        print(f'Packaging siri data {start_time} -> {end_time} -> {output_path} (engine={engine})')
+    if engine == ENGINE_TYPED:
+        save_package_typed(stats, start_time, end_time, output_path, verbose, parquet_filename)
+    else:
+        DF.Flow(
+            sql_iterator(stats, start_time, end_time, verbose),
+            DF.dump_to_path(output_path),
+        ).process()
+
+
+def get_benchmark_rows(num_rows, seed=1):
+    rnd = random.Random(seed)
+    start_time = datetime.datetime(2023, 3, 24, 20)
+    field_values = {
+        'id': lambda i: i,
+        'bearing': lambda i: rnd.randint(0, 359),
+        'distance_from_journey_start': lambda i: rnd.randint(0, 50000),
+        'distance_from_siri_ride_stop_meters': lambda i: rnd.choice([None, rnd.randint(0, 1000)]),
+        'lat': lambda i: 31 + rnd.random(),
+        'lon': lambda i: 34 + rnd.random(),
+        'recorded_at_time': lambda i: start_time + datetime.timedelta(seconds=i * 3600 * 12 / num_rows),
+        'velocity': lambda i: rnd.randint(0, 100),
+        'siri_stop_order': lambda i: rnd.randint(1, 60),
+        'siri_scheduled_start_time': lambda i: start_time,
+        'siri_journey_ref': lambda i: f'2023-03-24-{rnd.randint(10000000, 99999999)}',
+        'siri_operator_ref': lambda i: rnd.randint(1, 40),
+        'gtfs_stop_name': lambda i: 'תחנה מרכזית',
+        'gtfs_arrival_time': lambda i: rnd.choice([None, start_time]),
+    }
+    field_names = list(field_values.keys())
+    return field_names, [tuple(get_value(i) for get_value in field_values.values()) for i in range(num_rows)]
+
+
+def benchmark_engines(num_rows=200000):
+    """compares the rows conversion and csv writing rate of both engines on generated rows,
+    and verifies that both engines write identical csv files"""
+    field_names, rows = get_benchmark_rows(int(num_rows))
+    print(f'Benchmarking {len(rows)} rows')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start_time = time.time()
+        DF.Flow(
+            (get_row(dict(zip(field_names, row))) for row in rows),
+            DF.dump_to_path(os.path.join(tmpdir, ENGINE_DATAFLOWS)),
+        ).process()
+        dataflows_seconds = time.time() - start_time
+        start_time = time.time()
+        formatters = get_field_formatters(field_names)
+        write_package(os.path.join(tmpdir, ENGINE_TYPED), field_names, (
+            format_rows(formatters, rows[i:i + SQL_FETCH_BATCH_SIZE])
+            for i in range(0, len(rows), SQL_FETCH_BATCH_SIZE)
+        ))
+        typed_seconds = time.time() - start_time
+        csv_contents = {}
+        for engine in ENGINES:
+            with open(os.path.join(tmpdir, engine, 'res_1.csv'), encoding='utf-8') as f:
+                csv_contents[engine] = f.read()
+        identical = csv_contents[ENGINE_TYPED] == csv_contents[ENGINE_DATAFLOWS]
+    print(f'{ENGINE_DATAFLOWS}: {dataflows_seconds:.2f}s ({len(rows) / dataflows_seconds:.0f} rows/sec)')
+    print(f'{ENGINE_TYPED}: {typed_seconds:.2f}s ({len(rows) / typed_seconds:.0f} rows/sec)')
+    print(f'speedup: {dataflows_seconds / typed_seconds:.1f}x, identical csv: {identical}')
+    return identical
+
+
+def benchmark_parquet(num_rows=200000):
+    """compares file size and read time of the zipped csv package and the parquet file on generated rows"""
+    field_names, rows = get_benchmark_rows(int(num_rows))
+    print(f'Benchmarking {len(rows)} rows')
+    formatters = get_field_formatters(field_names)
+    parquet.benchmark(field_names, rows, lambda output_path: write_package(output_path, field_names, [format_rows(formatters, rows)]))
+
+
+def get_package_resource_hash(descriptor):
+    """the resource hash is the md5 of the csv file, which is the same for both engines,
+    unlike the package hash which dataflows calculates from the full descriptor"""
+    return descriptor['resources'][0]['hash']
 
 
 def get_existing_package_hash(package_path, base_filename):
@@ -144,10 +442,10 @@ def get_existing_package_hash(package_path, base_filename):
         download_file(package_path, filename)
         with zipfile.ZipFile(filename, 'r') as zf:
             with zf.open(f'{base_filename}-metadata.json') as f:
-                return json.load(f)['hash']
+                return get_package_resource_hash(json.load(f))
 
 
-def upload_package(tmpdir, package_path, base_filename, verbose=False):
+def upload_package(tmpdir, package_path, base_filename, verbose=False, limits=None):
     if verbose:
         print(f"Uploading package {tmpdir} -> {package_path}")
         print(f'Creating package file...')
@@ -157,16 +455,29 @@ def upload_package(tmpdir, package_path, base_filename, verbose=False):
     filename = os.path.join(tmpdir, f'{base_filename}.zip')
     if verbose:
         print(f"Uploading package file {filename} -> {package_path}")
-    return upload_file(filename, package_path)
+    with (limits or ConcurrencyLimits()).s3:
+        return upload_file(filename, package_path)
 
 
-def update_package(stats, start_datetimehour: datetime.datetime, force_update=False, verbose=False):
+def update_package(stats, start_datetimehour: datetime.datetime, force_update=False, verbose=False, engine=ENGINE_TYPED,
+                   limits=None, check_manifest=True, parquet=False):
+    """a manifest is stored for each package with the csv resource hash and the source rows fingerprint,
+    when forcing update of an existing package, it is skipped if the fingerprint didn't change,
+    the fingerprint is only computed when forcing update of an existing package which has a manifest
+    (new packages store a manifest without a fingerprint, it's added on the next forced update)
+    if parquet is True, a parquet file of the same rows is uploaded alongside the csv package"""
     assert start_datetimehour.minute == 0 and start_datetimehour.second == 0 and start_datetimehour.microsecond == 0
+    if limits is None:
+        limits = ConcurrencyLimits()
     stats['all_packages'] += 1
     base_filename = start_datetimehour.strftime('%Y-%m-%d.%H')
     package_path = start_datetimehour.strftime('stride-etl-packages/siri/%Y/%m/') + base_filename + '.zip'
-    file_last_modified = get_file_last_modified(package_path)
+    parquet_path = start_datetimehour.strftime('stride-etl-packages/siri-parquet/%Y/%m/') + base_filename + '.parquet'
+    with limits.s3:
+        file_last_modified = get_file_last_modified(package_path)
+        parquet_missing = parquet and get_file_last_modified(parquet_path) is None
     package_exists = file_last_modified is not None
+    check_manifest_fingerprint = False
     if package_exists:
         if FORCE_UPDATE_IF_FILE_LAST_MODIFIED_BEFORE and file_last_modified < FORCE_UPDATE_IF_FILE_LAST_MODIFIED_BEFORE:
             if verbose:
@@ -176,6 +487,7 @@ def update_package(stats, start_datetimehour: datetime.datetime, force_update=Fa
             if verbose:
                 print(f'Package exists, but forcing update: {package_path}')
             stats['package_forced_update'] += 1
+            check_manifest_fingerprint = check_manifest
         else:
             if verbose:
                 print(f'Package already exists: {package_path}')
@@ -185,58 +497,113 @@ def update_package(stats, start_datetimehour: datetime.datetime, force_update=Fa
         if verbose:
             print(f'Package does not exist: {package_path}')
         stats['package_create'] += 1
+    end_datetimehour = start_datetimehour + datetime.timedelta(hours=1)
+    manifest_path = get_manifest_path(start_datetimehour)
+    manifest = None
+    fingerprint = None
+    if check_manifest and package_exists:
+        with limits.s3:
+            manifest = download_json(manifest_path)
+        if manifest and check_manifest_fingerprint:
+            # the fingerprint is taken before the package is created, so changes made while creating it will be detected next time
+            with limits.db:
+                fingerprint = get_fingerprint(start_datetimehour, end_datetimehour)
+            stats['computed_fingerprints'] += 1
+            if not parquet_missing and manifest.get('fingerprint') == fingerprint:
+                if verbose:
+                    print(f'Package source rows fingerprint is the same, skipping update: {fingerprint}')
+                stats['skipped_same_fingerprint_packages'] += 1
+                return UPDATE_PACKAGE_RES_SAME_FINGERPRINT
     if verbose:
         print(f"Updating package {package_path} (force_update={force_update})")
     with tempfile.TemporaryDirectory() as tmpdir:
-        save_package(stats, start_datetimehour, start_datetimehour + datetime.timedelta(hours=1), os.path.join(tmpdir, 'package'), verbose=verbose)
+        parquet_filename = os.path.join(tmpdir, f'{base_filename}.parquet') if parquet else None
+        with limits.db:
+            save_package(stats, start_datetimehour, end_datetimehour, os.path.join(tmpdir, 'package'),
+                         verbose=verbose, engine=engine, parquet_filename=parquet_filename)
         if verbose:
             pprint(dict(stats))
+        with open(os.path.join(tmpdir, 'package', 'datapackage.json')) as f:
+            new_package_hash = get_package_resource_hash(json.load(f))
+        res = None
         if package_exists:
-            with open(os.path.join(tmpdir, 'package', 'datapackage.json')) as f:
-                new_package_hash = json.load(f)['hash']
-            existing_package_hash = get_existing_package_hash(package_path, base_filename)
+            if manifest and manifest.get('resource_hash'):
+                existing_package_hash = manifest['resource_hash']
+            else:
+                with limits.s3:
+                    existing_package_hash = get_existing_package_hash(package_path, base_filename)
             if new_package_hash == existing_package_hash:
                 if verbose:
                     print(f'Package hash is the same, skipping upload: {new_package_hash}')
                 stats['skipped_upload_packages'] += 1
-                return UPDATE_PACKAGE_RES_SAME_HASH
-        return upload_package(tmpdir, package_path, base_filename, verbose=verbose)
+                res = UPDATE_PACKAGE_RES_SAME_HASH
+        if parquet and (res is None or parquet_missing):
+            if verbose:
+                print(f'Uploading parquet file {parquet_filename} -> {parquet_path}')
+            with limits.s3:
+                upload_file(parquet_filename, parquet_path)
+            stats['uploaded_parquet_files'] += 1
+        if res is None:
+            res = upload_package(tmpdir, package_path, base_filename, verbose=verbose, limits=limits)
+        if check_manifest:
+            with limits.s3:
+                upload_json({'resource_hash': new_package_hash, 'fingerprint': fingerprint, 'updated_at': now().isoformat()}, manifest_path)
+        return res
+
+
+def update_hourly_package(current_datehour, force_update, stats, verbose, engine, limits, check_manifest, parquet):
+    print(f'{datetime.datetime.now()} Updating package: {current_datehour} (force_update={force_update})')
+    update_package_res = update_package(stats, current_datehour, force_update, verbose, engine, limits, check_manifest, parquet)
+    if update_package_res in [UPDATE_PACKAGE_RES_PACKAGE_EXISTS, UPDATE_PACKAGE_RES_LEGACY_NOT_EXISTS, UPDATE_PACKAGE_RES_SAME_FINGERPRINT]:
+        pass
+    else:
+        stats_str = ','.join([f'{k}={stats[k]}' for k in sorted(stats.keys())])
+        if update_package_res == UPDATE_PACKAGE_RES_SAME_HASH:
+            print(f'No change {current_datehour} ({stats_str})')
+        else:
+            print(f'Uploaded {current_datehour} ({stats_str}): {update_package_res}')
 
 
-def hourly_update_packages(stats=None, verbose=False, max_packages_per_type=None, start_datehour=None):
+def hourly_update_packages(stats=None, verbose=False, max_packages_per_type=None, start_datehour=None, engine=ENGINE_TYPED,
+                           workers=1, db_limit=None, s3_limit=None, check_manifest=True, parquet=False):
+    """with workers > 1, hours are processed concurrently so the DB query, csv writing, compression and upload
+    of different hours overlap, db_limit / s3_limit limit the number of concurrent DB queries / S3 operations"""
     if stats is None:
         stats = defaultdict(int)
     start_time = datetime.datetime.now()
     if not start_datehour:
         start_datehour = now().replace(minute=0, second=0, microsecond=0).astimezone(pytz.timezone('israel'))
     end_datehour = STRIDE_FIRST_DATETIME
-    print(f'Updating packages from {start_datehour} to {end_datehour} for up to 10 hours')
-    current_datehour = start_datehour + datetime.timedelta(hours=1)
-    num_is_stride_force, num_is_stride = 0, 0
-    while current_datehour >= end_datehour and (datetime.datetime.now() - start_time).total_seconds() < 60 * 60 * 10:
-        current_datehour -= datetime.timedelta(hours=1)
-        force_update = current_datehour > (start_datehour - datetime.timedelta(days=5))
-        if max_packages_per_type not in [None, 'None', 0, '0']:
-            max_packages_per_type = int(max_packages_per_type)
-            if (
+    limits = ConcurrencyLimits(db=db_limit, s3=s3_limit)
+    if max_packages_per_type in [None, 'None', 0, '0']:
+        max_packages_per_type = None
+    else:
+        max_packages_per_type = int(max_packages_per_type)
+    print(f'Updating packages from {start_datehour} to {end_datehour} for up to 10 hours (workers={workers}, db_limit={db_limit}, s3_limit={s3_limit})')
+
+    def iterate_hours():
+        # hours are yielded only as workers become available, so the time limit applies to starting new hours
+        current_datehour = start_datehour + datetime.timedelta(hours=1)
+        num_is_stride_force, num_is_stride = 0, 0
+        while current_datehour >= end_datehour and (datetime.datetime.now() - start_time).total_seconds() < 60 * 60 * 10:
+            current_datehour -= datetime.timedelta(hours=1)
+            force_update = current_datehour > (start_datehour - datetime.timedelta(days=5))
+            if max_packages_per_type is not None and (
                 (force_update and num_is_stride_force >= max_packages_per_type)
                 or (not force_update and num_is_stride >= max_packages_per_type)
             ):
                 continue
-        print(f'{datetime.datetime.now()} Updating package: {current_datehour} (force_update={force_update})')
-        update_package_res = update_package(stats, current_datehour, force_update, verbose)
-        if update_package_res in [UPDATE_PACKAGE_RES_PACKAGE_EXISTS, UPDATE_PACKAGE_RES_LEGACY_NOT_EXISTS]:
-            pass
-        else:
-            stats_str = ','.join([f'{k}={stats[k]}' for k in sorted(stats.keys())])
-            if update_package_res == UPDATE_PACKAGE_RES_SAME_HASH:
-                print(f'No change ({stats_str})')
+            yield current_datehour, force_update
+            if force_update:
+                num_is_stride_force += 1
             else:
-                print(f'Uploaded ({stats_str}): {update_package_res}')
-        if force_update:
-            num_is_stride_force += 1
-        else:
-            num_is_stride += 1
+                num_is_stride += 1
+
+    process_units(
+        iterate_hours(),
+        lambda unit, unit_stats: update_hourly_package(*unit, unit_stats, verbose, engine, limits, check_manifest, parquet),
+        stats, workers
+    )
     pprint(dict(stats))
 
 
@@ -262,17 +629,55 @@ def legacy_get_siri_journey_ref(date, service_id):
     return f'{date}-{service_id}'
 
 
-def legacy_process_row(key, i, row, with_recorded_at_time=True, packages_index_key_row_id=None):
+class LegacyDatetimeDecoder:
+    """Fast replacement of legacy_get_datetime_field, values in the fixed %Y-%m-%d / %H:%M:%S formats are
+    concatenated with the Israel UTC offset which is cached per date and hour (DST changes on whole hours),
+    any other value is handled by legacy_get_datetime_field so the output / errors are the same"""
+
+    def __init__(self):
+        self._offsets = {}
+
+    def _get_offset(self, date_value, hour_value):
+        offset = self._offsets.get((date_value, hour_value))
+        if offset is None:
+            offset = self._offsets[(date_value, hour_value)] = pytz.timezone('israel').localize(
+                datetime.datetime.strptime(f'{date_value} {hour_value}', '%Y-%m-%d %H')
+            ).isoformat()[19:]
+        return offset
+
+    def __call__(self, row, date_fields=None, time_fields=None):
+        date_value = None
+        time_value = None
+        for date_field in date_fields or []:
+            date_value = row.get(date_field)
+            if date_value:
+                break
+        for time_field in time_fields or []:
+            time_value = row.get(time_field)
+            if time_value:
+                break
+        if (
+            date_value and time_value and len(date_value) == 10 and len(time_value) == 8
+            and date_value[4] == '-' and date_value[7] == '-' and time_value[2] == ':' and time_value[5] == ':'
+            and time_value[3] <= '5' and time_value[6] <= '5' and (time_value[3:5] + time_value[6:8]).isdigit()
+        ):
+            # date and hour are validated by strptime when the offset is not cached yet
+            return f'{date_value}T{time_value}{self._get_offset(date_value, time_value[:2])}'
+        return legacy_get_datetime_field(row, date_fields, time_fields)
+
+
+def legacy_process_row(key, i, row, with_recorded_at_time=True, packages_index_key_row_id=None,
+                       get_datetime_field=legacy_get_datetime_field):
     key = str(packages_index_key_row_id) if packages_index_key_row_id else key
     return {
         'id': f'{key}-{i}',
         'lat': row['lat'],
         'lon': row['lon'],
         **(
-            {'recorded_at_time': legacy_get_datetime_field(row, ['date_recorded', 'date'], ['time_recorded'])}
+            {'recorded_at_time': get_datetime_field(row, ['date_recorded', 'date'], ['time_recorded'])}
             if with_recorded_at_time else {}
         ),
-        'siri_scheduled_start_time': legacy_get_datetime_field(row, ['planned_start_date', 'date'], ['planned_start_time']),
+        'siri_scheduled_start_time': get_datetime_field(row, ['planned_start_date', 'date'], ['planned_start_time']),
         'siri_journey_ref': legacy_get_siri_journey_ref(row['date'], row.get('service_id')),
         'siri_vehicle_ref': row['bus_id'],
         'siri_stop_code': row.get('stop_point_ref') or '',
@@ -280,7 +685,7 @@ def legacy_process_row(key, i, row, with_recorded_at_time=True, packages_index_k
         'siri_line_ref': row['route_id'],
         'siri_snapshot_id': key,
         'gtfs_route_short_name': row['route_short_name'],
-        'predicted_end_time': legacy_get_datetime_field(row, ['predicted_end_date', 'date'], ['predicted_end_time']),
+        'predicted_end_time': get_datetime_field(row, ['predicted_end_date', 'date'], ['predicted_end_time']),
         'date': row['date'],
         'num_duplicates': row.get('num_duplicates') or '',
     }
@@ -418,86 +823,430 @@ def extrapolate_hour_keys_hours(keys, keys_hours):
     return hours
 
 
-def legacy_update_packages_batch(hours, keys, batch_id):
-    print(f'legacy_update_packages_batch: batch_id: {batch_id}, {len(hours)} hours')
-    if str(batch_id) in ('1', '2', '3') or get_file_last_modified(f'stride-etl-packages/siri/hours_reports/{batch_id}.json'):
-        print(f'Already exists')
+LEGACY_ENGINE_EXTERNAL_SORT = 'external-sort'
+LEGACY_ENGINE_PLYVEL = 'plyvel'
+LEGACY_ENGINES = [LEGACY_ENGINE_EXTERNAL_SORT, LEGACY_ENGINE_PLYVEL]
+# number of legacy files downloaded concurrently while a file is processed (0 - download each file when it's needed)
+LEGACY_PREFETCH_WORKERS = 2
+# max total size of downloaded legacy files waiting to be processed
+LEGACY_PREFETCH_MAX_MB = 2048
+# fast - read the csv with the csv module and decode the datetimes with LegacyDatetimeDecoder
+# dataflows - read the csv with DF.load and decode each datetime with legacy_get_datetime_field (the previous behavior)
+LEGACY_DECODER_FAST = 'fast'
+LEGACY_DECODER_DATAFLOWS = 'dataflows'
+LEGACY_DECODERS = [LEGACY_DECODER_FAST, LEGACY_DECODER_DATAFLOWS]
+# components - union-find connected components of the key-hour graph, merged or split to at most max_batch_rows
+# expand - expand each batch from an hour to the hours of its keys 4 times (the previous behavior)
+LEGACY_PLANNER_COMPONENTS = 'components'
+LEGACY_PLANNER_EXPAND = 'expand'
+LEGACY_PLANNERS = [LEGACY_PLANNER_COMPONENTS, LEGACY_PLANNER_EXPAND]
+# max sum of the index num_rows of the keys loaded by a batch, this bounds the batch scratch disk usage
+LEGACY_MAX_BATCH_ROWS = 50000000
+# estimated scratch disk usage of a batch row (external sort runs and the hour package), in addition to the prefetched files
+LEGACY_SCRATCH_BYTES_PER_ROW = 64
+# max estimated scratch disk usage of all the batches running in parallel
+LEGACY_MAX_DISK_MB = 51200
+
+
+def legacy_iterate_file_rows_fast(filename):
+    """yields the rows of a legacy csv.gz file the same as DF.load with CAST_TO_STRINGS / INFER_STRINGS:
+    header and values are stripped, short rows are missing the last fields and long rows are truncated"""
+    with gzip.open(filename, 'rt', encoding='utf-8-sig', newline='') as f:
+        reader = csv.reader(f)
+        field_names = [field_name.strip() for field_name in next(reader, [])]
+        for values in reader:
+            yield dict(zip(field_names, [value.strip() for value in values]))
+
+
+def legacy_iterate_file_rows_dataflows(filename):
+    for res in DF.Flow(
+        DF.load(filename, cast_strategy=DF.load.CAST_TO_STRINGS, infer_strategy=DF.load.INFER_STRINGS, encoding='utf-8'),
+    ).datastream().res_iter.get_iterator():
+        yield from res
+
+
+def legacy_iterate_file_processed_rows(key, key_id, filename, decoder=LEGACY_DECODER_FAST, stats=None):
+    """yields the processed rows of a legacy file, rows which fail processing are skipped"""
+    assert decoder in LEGACY_DECODERS, f'invalid decoder: {decoder}'
+    if decoder == LEGACY_DECODER_FAST:
+        rows, get_datetime_field = legacy_iterate_file_rows_fast(filename), LegacyDatetimeDecoder()
     else:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            pdb = plyvel.DB(os.path.join(tmpdir, 'db'), create_if_missing=True)
-            try:
+        rows, get_datetime_field = legacy_iterate_file_rows_dataflows(filename), legacy_get_datetime_field
+    num_rows, num_row_errors = 0, 0
+    for row in rows:
+        num_rows += 1
+        outrow = None
+        # noinspection PyBroadException
+        try:
+            outrow = legacy_process_row(key, num_rows, row, packages_index_key_row_id=key_id, get_datetime_field=get_datetime_field)
+        except Exception:
+            num_row_errors += 1
+            traceback.print_exc()
+            print(f'Error legacy processing row {num_rows}: {row}')
+        if outrow:
+            yield outrow
+    print(f'loaded {num_rows} rows with {num_row_errors} errors')
+    if stats is not None:
+        stats['legacy_rows'] += num_rows
+        stats['legacy_row_errors'] += num_row_errors
+
+
+def legacy_iterate_keys_rows(keys, stats, prefetch_workers=LEGACY_PREFETCH_WORKERS, prefetch_max_mb=LEGACY_PREFETCH_MAX_MB,
+                             decoder=LEGACY_DECODER_FAST, scratch_path=None):
+    """downloads the legacy files and yields the processed rows, upcoming files are downloaded while a file is processed"""
+    with tempfile.TemporaryDirectory(dir=scratch_path) as tmpdir_:
+        for key_id, key, filename, downloaded in iterate_prefetched_legacy_files(
+            'obus-do1', keys.items(), tmpdir_, stats,
+            workers=prefetch_workers, max_prefetch_bytes=int(prefetch_max_mb) * 1024 * 1024
+        ):
+            print(f'Loading key {key_id}: {key}')
+            assert downloaded, f'Failed to download: {key}'
+            yield from legacy_iterate_file_processed_rows(key, key_id, filename, decoder, stats)
+
+
+def legacy_iterate_hours_plyvel(tmpdir, hours, rows):
+    """loads the rows to a temporary LevelDB and yields a tuple of (hour, hour_rows_iterator) for each hour"""
+    import plyvel
+    pdb = plyvel.DB(os.path.join(tmpdir, 'db'), create_if_missing=True)
+    try:
+        pdb_write_batch, pdb_write_batch_size = pdb.write_batch(), 0
+        for outrow in rows:
+            pdb_write_batch.put(f"{outrow.pop('recorded_at_time')}_{outrow.pop('id')}".encode('utf-8'), json.dumps(outrow).encode('utf-8'))
+            pdb_write_batch_size += 1
+            if pdb_write_batch_size >= 100000:
+                print(f'Writing {pdb_write_batch_size} rows to pdb')
+                pdb_write_batch.write()
                 pdb_write_batch, pdb_write_batch_size = pdb.write_batch(), 0
-                for key_id, key in keys.items():
-                    print(f'Loading key {key_id}: {key}')
-                    with tempfile.TemporaryDirectory() as tmpdir_:
-                        assert download_legacy_file('obus-do1', key, os.path.join(tmpdir_, 'file.csv.gz'), retries=5), f'Failed to download: {key}'
-                        num_rows, num_row_errors = 0, 0
-                        for res in DF.Flow(
-                            DF.load(os.path.join(tmpdir_, 'file.csv.gz'), cast_strategy=DF.load.CAST_TO_STRINGS, infer_strategy=DF.load.INFER_STRINGS, encoding='utf-8'),
-                        ).datastream().res_iter.get_iterator():
-                            for row in res:
-                                num_rows += 1
-                                outrow = None
-                                # noinspection PyBroadException
-                                try:
-                                    outrow = legacy_process_row(key, num_rows, row, packages_index_key_row_id=key_id)
-                                except Exception:
-                                    num_row_errors += 1
-                                    traceback.print_exc()
-                                    print(f'Error legacy processing row {num_rows}: {row}')
-                                if outrow:
-                                    pdb_write_batch.put(f"{outrow.pop('recorded_at_time')}_{outrow.pop('id')}".encode('utf-8'), json.dumps(outrow).encode('utf-8'))
-                                    pdb_write_batch_size += 1
-                                    if pdb_write_batch_size >= 100000:
-                                        print(f'Writing {pdb_write_batch_size} rows to pdb')
-                                        pdb_write_batch.write()
-                                        pdb_write_batch, pdb_write_batch_size = pdb.write_batch(), 0
-                    if pdb_write_batch_size > 0:
-                        print(f'Writing {pdb_write_batch_size} rows to pdb')
-                        pdb_write_batch.write()
-                        pdb_write_batch, pdb_write_batch_size = pdb.write_batch(), 0
-                    print(f'loaded {num_rows} rows with {num_row_errors} errors')
-                hours_report = {}
-                for hour in hours:
-                    hours_report_hour = hours_report[hour.isoformat()] = {
-                        'num_rows': 0,
-                        'min_recorded_at_time': None,
-                        'max_recorded_at_time': None,
-                        'url': None,
+        if pdb_write_batch_size > 0:
+            print(f'Writing {pdb_write_batch_size} rows to pdb')
+            pdb_write_batch.write()
+        for hour in hours:
+
+            def iterator():
+                for k, v in pdb.iterator(start=hour.isoformat().encode('utf-8'), stop=(hour + datetime.timedelta(hours=1)).isoformat().encode('utf-8')):
+                    recorded_at_time, id = k.decode('utf-8').split('_')
+                    yield {
+                        'id': id, 'recorded_at_time': recorded_at_time,
+                        **json.loads(v.decode('utf-8'))
                     }
-                    base_filename = hour.strftime('%Y-%m-%d.%H')
-                    package_path = hour.strftime('stride-etl-packages/siri/%Y/%m/') + base_filename + '.zip'
-
-                    def iterator():
-                        for k, v in pdb.iterator(start=hour.isoformat().encode('utf-8'), stop=(hour + datetime.timedelta(hours=1)).isoformat().encode('utf-8')):
-                            recorded_at_time, id = k.decode('utf-8').split('_')
-                            hours_report_hour['num_rows'] += 1
-                            if hours_report_hour['min_recorded_at_time'] is None or recorded_at_time < hours_report_hour['min_recorded_at_time']:
-                                hours_report_hour['min_recorded_at_time'] = recorded_at_time
-                            if hours_report_hour['max_recorded_at_time'] is None or recorded_at_time > hours_report_hour['max_recorded_at_time']:
-                                hours_report_hour['max_recorded_at_time'] = recorded_at_time
-                            yield {
-                                'id': id, 'recorded_at_time': recorded_at_time,
-                                **json.loads(v.decode('utf-8'))
-                            }
-
-                    with tempfile.TemporaryDirectory() as tmpdir_:
-                        DF.Flow(
-                            iterator(),
-                            DF.dump_to_path(os.path.join(tmpdir_, 'package'))
-                        ).process()
-                        print(f'Uploading {package_path}')
-                        hours_report_hour['url'] = upload_package(tmpdir_, package_path, base_filename)
-            finally:
-                pdb.close()
+
+            yield hour, iterator()
+    finally:
+        pdb.close()
+
+
+def legacy_iterate_hours_external_sort(tmpdir, hours, rows):
+    """sorts the rows with an external merge sort using the same keys as the plyvel engine,
+    and yields a tuple of (hour, hour_rows_iterator) for each hour, ordered by the hour keys"""
+    sorter = external_sort.ExternalSorter(os.path.join(tmpdir, 'runs'))
+    field_names = None
+    for outrow in rows:
+        recorded_at_time, id = outrow.pop('recorded_at_time'), outrow.pop('id')
+        if field_names is None:
+            field_names = list(outrow.keys())
+        sorter.add((f'{recorded_at_time}_{id}', *(outrow[field_name] for field_name in field_names)))
+    print(f'Sorted {sorter.num_records} rows into {len(sorter.run_filenames)} runs ({sorter.get_disk_usage_bytes()} bytes)')
+    hours_by_start_key = {hour.isoformat(): hour for hour in hours}
+    for (start_key, _), records in external_sort.iterate_key_ranges(
+        sorter.iterate(),
+        [(start_key, (hour + datetime.timedelta(hours=1)).isoformat()) for start_key, hour in sorted(hours_by_start_key.items())]
+    ):
+
+        def iterator():
+            for record in records:
+                recorded_at_time, id = record[0].split('_')
+                yield {
+                    'id': id, 'recorded_at_time': recorded_at_time,
+                    **dict(zip(field_names, record[1:]))
+                }
+
+        yield hours_by_start_key[start_key], iterator()
+
+
+def get_legacy_benchmark_rows(num_rows, hours, seed=1):
+    rnd = random.Random(seed)
+    for i in range(num_rows):
+        hour = rnd.choice(hours)
+        yield {
+            'id': f'{rnd.randint(1, 100)}-{i}',
+            'lat': f'{31 + rnd.random():.6f}',
+            'lon': f'{34 + rnd.random():.6f}',
+            'recorded_at_time': (hour + datetime.timedelta(seconds=rnd.randint(0, 3599))).isoformat(),
+            'siri_scheduled_start_time': hour.isoformat(),
+            'siri_journey_ref': f'{hour.date()}-{rnd.randint(10000000, 99999999)}',
+            'siri_vehicle_ref': str(rnd.randint(1000000, 9999999)),
+            'siri_stop_code': rnd.choice(['', str(rnd.randint(10000, 99999))]),
+            'siri_operator_ref': str(rnd.randint(1, 40)),
+            'siri_line_ref': str(rnd.randint(1, 30000)),
+            'siri_snapshot_id': 'SiriForSplunk/2020/06/16/siri_rt_data_v2.2020-06-16.6.csv.gz',
+            'gtfs_route_short_name': rnd.choice([None, str(rnd.randint(1, 500))]),
+            'predicted_end_time': hour.isoformat(),
+            'date': str(hour.date()),
+            'num_duplicates': '',
+        }
+
+
+def get_directory_size(path):
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+            except FileNotFoundError:
+                # files may be removed while walking if the directory is in use
+                pass
+    return size
+
+
+def benchmark_legacy_engine(engine, num_rows, num_hours):
+    """runs the load and per hour iteration of the given legacy engine on generated rows (without downloading / uploading),
+    should run in a separate process so that the peak RSS is of this engine only"""
+    import resource
+    hours = [STRIDE_FIRST_DATETIME.replace(year=2020) + datetime.timedelta(hours=i) for i in range(num_hours)]
+    iterate_hours = legacy_iterate_hours_external_sort if engine == LEGACY_ENGINE_EXTERNAL_SORT else legacy_iterate_hours_plyvel
+    start_time = time.time()
+    disk_usage_bytes, num_rows_per_hour, ids_md5 = None, {}, hashlib.md5()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for hour, hour_rows in iterate_hours(tmpdir, hours, get_legacy_benchmark_rows(num_rows, hours)):
+            if disk_usage_bytes is None:
+                disk_usage_bytes = get_directory_size(tmpdir)
+            num_rows_per_hour[hour.isoformat()] = 0
+            for row in hour_rows:
+                num_rows_per_hour[hour.isoformat()] += 1
+                ids_md5.update(json.dumps(row).encode('utf-8'))
+    return {
+        'seconds': time.time() - start_time,
+        'disk_usage_mb': (disk_usage_bytes or 0) / 1024 / 1024,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'rows_md5': ids_md5.hexdigest(),
+        'num_rows_per_hour': num_rows_per_hour,
+    }
+
+
+def benchmark_legacy_engines(num_rows=2000000, num_hours=48):
+    """compares wall time, scratch disk usage and peak RSS of the legacy engines, each engine runs in a new process"""
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    results = {}
+    for engine in LEGACY_ENGINES:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results[engine] = executor.submit(benchmark_legacy_engine, engine, int(num_rows), int(num_hours)).result()
+        print(f'{engine}: {results[engine]["seconds"]:.2f}s, '
+              f'disk usage: {results[engine]["disk_usage_mb"]:.1f}mb, '
+              f'peak RSS: {results[engine]["peak_rss_mb"]:.1f}mb')
+    identical = len(set(
+        json.dumps([result['rows_md5'], sorted(result['num_rows_per_hour'].items())]) for result in results.values()
+    )) == 1
+    print(f'identical hours rows: {identical}')
+    return identical
+
+
+LEGACY_BENCHMARK_FIELD_NAMES = [
+    'date', 'date_recorded', 'time_recorded', 'agency_id', 'route_id', 'route_short_name', 'service_id',
+    'planned_start_date', 'planned_start_time', 'bus_id', 'predicted_end_date', 'predicted_end_time',
+    'lon', 'lat', 'stop_point_ref', 'num_duplicates',
+]
+
+
+def write_legacy_benchmark_file(filename, num_rows, seed=1):
+    """writes a legacy csv.gz file with generated rows, includes some rows which are handled by the slow path
+    (times without leading zero, missing planned start date, DST changes) and some invalid rows"""
+    rnd = random.Random(seed)
+    dates = ['2020-03-26', '2020-03-27', '2020-10-24', '2020-10-25', '2021-06-16']
+    with gzip.open(filename, 'wt', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(LEGACY_BENCHMARK_FIELD_NAMES)
+        for i in range(num_rows):
+            date = rnd.choice(dates)
+            time_recorded = f'{rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}:{rnd.randint(0, 59):02d}'
+            if i % 1000 == 1:
+                time_recorded = time_recorded.lstrip('0')
+            elif i % 10000 == 2:
+                time_recorded = ''
+            writer.writerow([
+                date, date, time_recorded, str(rnd.randint(1, 40)), str(rnd.randint(1, 30000)), str(rnd.randint(1, 500)),
+                rnd.choice(['', str(rnd.randint(10000000, 99999999))]),
+                '' if i % 100 == 3 else date, f'{rnd.randint(5, 23):02d}:{rnd.choice(["00", "15", "30", "45"])}:00',
+                str(rnd.randint(1000000, 9999999)), date, f'{rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}:00',
+                f'{34 + rnd.random():.6f}', f'{31 + rnd.random():.6f}',
+                rnd.choice(['', str(rnd.randint(10000, 99999))]), rnd.choice(['', str(rnd.randint(1, 3))]),
+            ])
+
+
+def benchmark_legacy_decoders(filenames=None, num_rows=200000):
+    """compares rows/sec of the legacy decoders on the given legacy csv.gz files (or a generated file),
+    returns True if all decoders returned identical rows"""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if not filenames:
+            filenames = [os.path.join(tmpdir, 'legacy.csv.gz')]
+            write_legacy_benchmark_file(filenames[0], int(num_rows))
+        for decoder in LEGACY_DECODERS:
+            start_time, rows_md5, num_rows_ = time.time(), hashlib.md5(), 0
+            for key_id, filename in enumerate(filenames, 1):
+                for outrow in legacy_iterate_file_processed_rows(filename, str(key_id), filename, decoder):
+                    num_rows_ += 1
+                    rows_md5.update(json.dumps(outrow).encode('utf-8'))
+            seconds = time.time() - start_time
+            results[decoder] = rows_md5.hexdigest()
+            print(f'{decoder}: {num_rows_} rows in {seconds:.2f}s ({num_rows_ / seconds:.0f} rows/sec)')
+    identical = len(set(results.values())) == 1
+    print(f'identical rows: {identical}')
+    return identical
+
+
+def is_legacy_batch_completed(batch_id):
+    """the hours report is uploaded after all the batch hours packages were uploaded"""
+    return get_file_last_modified(f'stride-etl-packages/siri/hours_reports/{batch_id}.json')
+
+
+def legacy_update_packages_batch(hours, keys, batch_id, engine=LEGACY_ENGINE_EXTERNAL_SORT,
+                                 prefetch_workers=LEGACY_PREFETCH_WORKERS, prefetch_max_mb=LEGACY_PREFETCH_MAX_MB,
+                                 decoder=LEGACY_DECODER_FAST, scratch_path=None):
+    assert engine in LEGACY_ENGINES, f'invalid engine: {engine}'
+    assert decoder in LEGACY_DECODERS, f'invalid decoder: {decoder}'
+    print(f'legacy_update_packages_batch: batch_id: {batch_id}, {len(hours)} hours (engine={engine}, decoder={decoder})')
+    if is_legacy_batch_completed(batch_id):
+        print(f'Already exists')
+    else:
+        with tempfile.TemporaryDirectory(dir=scratch_path) as tmpdir:
+            iterate_hours = legacy_iterate_hours_external_sort if engine == LEGACY_ENGINE_EXTERNAL_SORT else legacy_iterate_hours_plyvel
+            hours_report = {}
+            stats = defaultdict(int)
+            for hour, hour_rows in iterate_hours(tmpdir, hours, legacy_iterate_keys_rows(keys, stats, prefetch_workers, prefetch_max_mb, decoder, scratch_path)):
+                hours_report_hour = hours_report[hour.isoformat()] = {
+                    'num_rows': 0,
+                    'min_recorded_at_time': None,
+                    'max_recorded_at_time': None,
+                    'url': None,
+                }
+                base_filename = hour.strftime('%Y-%m-%d.%H')
+                package_path = hour.strftime('stride-etl-packages/siri/%Y/%m/') + base_filename + '.zip'
+
+                def iterator():
+                    for row in hour_rows:
+                        recorded_at_time = row['recorded_at_time']
+                        hours_report_hour['num_rows'] += 1
+                        if hours_report_hour['min_recorded_at_time'] is None or recorded_at_time < hours_report_hour['min_recorded_at_time']:
+                            hours_report_hour['min_recorded_at_time'] = recorded_at_time
+                        if hours_report_hour['max_recorded_at_time'] is None or recorded_at_time > hours_report_hour['max_recorded_at_time']:
+                            hours_report_hour['max_recorded_at_time'] = recorded_at_time
+                        yield row
+
+                with tempfile.TemporaryDirectory(dir=scratch_path) as tmpdir_:
+                    DF.Flow(
+                        iterator(),
+                        DF.dump_to_path(os.path.join(tmpdir_, 'package'))
+                    ).process()
+                    print(f'Uploading {package_path}')
+                    hours_report_hour['url'] = upload_package(tmpdir_, package_path, base_filename)
+            pprint(dict(stats))
             with open(os.path.join(tmpdir, 'hours_report.json'), 'w') as f:
                 json.dump(hours_report, f)
             upload_file(os.path.join(tmpdir, 'hours_report.json'), f'stride-etl-packages/siri/hours_reports/{batch_id}.json')
 
 
-def legacy_update_packages_from_index(index_from_path=False):
+# batches of the expand planner which were already processed, they are skipped as they don't have an hours report
+LEGACY_EXPAND_SKIP_BATCH_IDS = ('1', '2', '3')
+
+
+def legacy_plan_batches_expand(hour_keys, keys_hours, keys_num_rows):
+    """expands each batch from an hour to the hours of its keys 4 times, batch ids are sequential,
+    these are the batch ids of the existing hours reports, so completed batches are skipped when a run is restarted"""
+    hour_batches = []
+    all_added_hours = set()
+    for hour in sorted(hour_keys.keys()):
+        if hour not in all_added_hours:
+            hours = set()
+            hours.add(hour)
+            for _ in range(4):
+                for hour_ in sorted(list(hours)):
+                    for hour__ in sorted(extrapolate_hour_keys_hours(hour_keys[hour_], keys_hours)):
+                        hours.add(hour__)
+            keys = set()
+            for hour_ in hours:
+                keys.update(hour_keys[hour_])
+            hour_batches.append(legacy_planner.LegacyBatch(
+                str(len(hour_batches) + 1), hours, keys, sum(keys_num_rows[key] for key in keys)
+            ))
+            all_added_hours.update(hours)
+    return [batch for batch in hour_batches if batch.batch_id not in LEGACY_EXPAND_SKIP_BATCH_IDS]
+
+
+def legacy_update_packages_batch_process(batch, keys, scratch_path, engine, prefetch_workers, prefetch_max_mb, decoder):
+    """runs in a worker process, the batch scratch files are in its own directory under scratch_path"""
+    batch_scratch_path = os.path.join(scratch_path, batch.batch_id)
+    os.makedirs(batch_scratch_path)
+    try:
+        legacy_update_packages_batch(batch.hours, keys, batch.batch_id, engine, prefetch_workers, prefetch_max_mb, decoder,
+                                     batch_scratch_path)
+    finally:
+        shutil.rmtree(batch_scratch_path, ignore_errors=True)
+
+
+def get_legacy_batch_estimated_disk_mb(batch, prefetch_max_mb):
+    return int(prefetch_max_mb) + batch.estimated_rows * LEGACY_SCRATCH_BYTES_PER_ROW / 1024 / 1024
+
+
+def legacy_update_packages_batches_parallel(hour_batches, packages_index_key_row_ids, workers, max_disk_mb, engine,
+                                            prefetch_workers, prefetch_max_mb, decoder):
+    """runs the batches in worker processes, batches are independent because each hour is created by a single batch.
+    A batch is started only if the estimated disk usage of the running batches (or the actual usage, if higher)
+    together with the batch estimated disk usage is under max_disk_mb, so at least one batch is always running.
+    Completed batches are skipped based on the hours reports, failed batches are retried on the next run."""
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    import multiprocessing
+    pending_batches = [batch for batch in hour_batches if not is_legacy_batch_completed(batch.batch_id)]
+    print(f'{len(hour_batches) - len(pending_batches)} batches already completed, '
+          f'processing {len(pending_batches)} batches with {workers} workers (max disk: {max_disk_mb}mb)')
+    num_batches, failed_batch_ids = len(pending_batches), []
+    with tempfile.TemporaryDirectory() as scratch_path:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            running = {}
+            while pending_batches or running:
+                while pending_batches and len(running) < workers:
+                    batch = pending_batches[0]
+                    estimated_disk_mb = get_legacy_batch_estimated_disk_mb(batch, prefetch_max_mb)
+                    used_disk_mb = max(
+                        sum(batch_disk_mb for _, batch_disk_mb in running.values()),
+                        get_directory_size(scratch_path) / 1024 / 1024
+                    )
+                    if running and used_disk_mb + estimated_disk_mb > max_disk_mb:
+                        break
+                    pending_batches.pop(0)
+                    print(f'Starting batch {batch.batch_id} ({num_batches - len(pending_batches)} / {num_batches}, '
+                          f'estimated disk: {estimated_disk_mb:.0f}mb, used disk: {used_disk_mb:.0f}mb)')
+                    running[executor.submit(
+                        legacy_update_packages_batch_process, batch, {packages_index_key_row_ids[key]: key for key in batch.keys},
+                        scratch_path, engine, prefetch_workers, prefetch_max_mb, decoder
+                    )] = (batch, estimated_disk_mb)
+                done, _ = wait(running, timeout=60, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch, _ = running.pop(future)
+                    # noinspection PyBroadException
+                    try:
+                        future.result()
+                        print(f'Completed batch {batch.batch_id}')
+                    except Exception:
+                        traceback.print_exc()
+                        print(f'Failed batch {batch.batch_id}')
+                        failed_batch_ids.append(batch.batch_id)
+    assert not failed_batch_ids, f'{len(failed_batch_ids)} batches failed: {failed_batch_ids}'
+
+
+def legacy_update_packages_from_index(index_from_path=False, engine=LEGACY_ENGINE_EXTERNAL_SORT,
+                                      prefetch_workers=LEGACY_PREFETCH_WORKERS, prefetch_max_mb=LEGACY_PREFETCH_MAX_MB,
+                                      decoder=LEGACY_DECODER_FAST, planner=LEGACY_PLANNER_EXPAND,
+                                      max_batch_rows=LEGACY_MAX_BATCH_ROWS, plan_only=False, workers=1,
+                                      max_disk_mb=LEGACY_MAX_DISK_MB):
+    # the components planner batch ids are based on the batch hours and depend on max_batch_rows, they don't match
+    # the hours reports of the expand planner batches, so switching planners redoes all the completed batches
+    assert planner in LEGACY_PLANNERS, f'invalid planner: {planner}'
+    # batches of the expand planner may have the same hours, so they can't run in parallel
+    assert int(workers) <= 1 or planner == LEGACY_PLANNER_COMPONENTS, 'parallel workers require the components planner'
     hour_keys = {}
     keys_hours = {}
+    keys_num_rows = {}
     if index_from_path:
         index_path = os.path.join('.data', 'legacy_packages_index', 'datapackage.json')
     else:
@@ -507,6 +1256,7 @@ def legacy_update_packages_from_index(index_from_path=False):
         if row['key_processing_error']:
             continue
         packages_index_key_row_ids[row['key']] = str(row['keynum'])
+        keys_num_rows[row['key']] = int(row['num_rows'] or 0)
         min_recorded_at_time = datetime.datetime.fromisoformat(row['min_recorded_at_time'])
         max_recorded_at_time = datetime.datetime.fromisoformat(row['max_recorded_at_time'])
         current_hour = min_recorded_at_time.replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=1)
@@ -515,31 +1265,21 @@ def legacy_update_packages_from_index(index_from_path=False):
             current_hour += datetime.timedelta(hours=1)
             hour_keys.setdefault(current_hour, set()).add(row['key'])
             keys_hours.setdefault(row['key'], set()).add(current_hour)
-    print(f'Processing {len(keys_hours)} keys, {len(hour_keys)} hours')
-    hour_batches = []
-    all_added_hours = set()
-    largest_batch_hours, largest_batch_keys = 0, 0
-    for hour in sorted(hour_keys.keys()):
-        if hour not in all_added_hours:
-            hours = set()
-            hours.add(hour)
-            for _ in range(4):
-                for hour_ in sorted(list(hours)):
-                    for hour__ in sorted(extrapolate_hour_keys_hours(hour_keys[hour_], keys_hours)):
-                        hours.add(hour__)
-            keys = set()
-            for hour_ in hours:
-                keys.update(hour_keys[hour_])
-            hour_batches.append((hours, keys))
-            if len(keys) > largest_batch_keys:
-                largest_batch_keys = len(keys)
-            if len(hours) > largest_batch_hours:
-                largest_batch_hours = len(hours)
-            all_added_hours.update(hours)
-    print(f'Found {len(hour_batches)} batches (largest batches: {largest_batch_keys} keys, {largest_batch_hours} hours)')
-    batch_num = 0
-    for hours, keys in hour_batches:
-        batch_num += 1
+    print(f'Processing {len(keys_hours)} keys, {len(hour_keys)} hours (planner={planner})')
+    if planner == LEGACY_PLANNER_COMPONENTS:
+        hour_batches = legacy_planner.plan_batches(hour_keys, keys_num_rows, int(max_batch_rows))
+    else:
+        hour_batches = legacy_plan_batches_expand(hour_keys, keys_hours, keys_num_rows)
+    legacy_planner.print_plan(hour_batches, keys_num_rows, int(max_batch_rows))
+    if plan_only:
+        return
+    if int(workers) > 1:
+        legacy_update_packages_batches_parallel(hour_batches, packages_index_key_row_ids, int(workers), int(max_disk_mb), engine,
+                                                prefetch_workers, prefetch_max_mb, decoder)
+        print("ALL GOOD!")
+        return
+    for batch_num, batch in enumerate(hour_batches, 1):
         print(f'Processing batch #{batch_num} / {len(hour_batches)}')
-        legacy_update_packages_batch(hours, {packages_index_key_row_ids[key]: key for key in keys}, str(batch_num))
+        legacy_update_packages_batch(batch.hours, {packages_index_key_row_ids[key]: key for key in batch.keys}, batch.batch_id, engine,
+                                     prefetch_workers, prefetch_max_mb, decoder)
     print("ALL GOOD!")
@@ -0,0 +1,211 @@
+import os
+import csv
+import json
+import hashlib
+import zipfile
+import datetime
+import tempfile
+from pprint import pprint
+from collections import defaultdict
+
+import pytz
+
+from .. import common
+from .siri import upload_package, write_datapackage
+from .common import BUCKET_NAME, iterate_objects, download_file, download_json, upload_json
+
+ROLLUP_TYPE_DAILY = 'daily'
+ROLLUP_TYPE_MONTHLY = 'monthly'
+ROLLUP_TYPES = [ROLLUP_TYPE_DAILY, ROLLUP_TYPE_MONTHLY]
+HOURLY_PACKAGES_PATH_PREFIX = 'stride-etl-packages/siri/'
+ROLLUPS_PATH_PREFIX = 'stride-etl-packages/siri/rollups/'
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class PackageHashMismatch(Exception):
+    pass
+
+
+class PackageHeaderMismatch(Exception):
+    pass
+
+
+def get_rollup_base_filename(rollup_type, period_date: datetime.date):
+    return period_date.strftime('%Y-%m-%d' if rollup_type == ROLLUP_TYPE_DAILY else '%Y-%m')
+
+
+def get_rollup_package_path(rollup_type, period_date: datetime.date):
+    return period_date.strftime(f'{ROLLUPS_PATH_PREFIX}{rollup_type}/%Y/') + get_rollup_base_filename(rollup_type, period_date) + '.zip'
+
+
+def get_rollup_manifest_path(rollup_type, period_date: datetime.date):
+    return period_date.strftime(f'{ROLLUPS_PATH_PREFIX}manifests/{rollup_type}/%Y/') + get_rollup_base_filename(rollup_type, period_date) + '.json'
+
+
+def get_packages_etags(prefix, base_filename_prefix=''):
+    """returns a dict of package base filename to its S3 ETag for all the packages under prefix, using a single listing,
+    the ETag changes whenever the package is replaced"""
+    etags = {}
+    for obj in iterate_objects(BUCKET_NAME, prefix):
+        filename = obj['Key'].split('/')[-1]
+        if filename.endswith('.zip') and filename.startswith(base_filename_prefix):
+            etags[filename[:-4]] = obj['ETag'].strip('"')
+    return etags
+
+
+def get_month_hourly_packages_etags(month_date: datetime.date):
+    """returns the ETags of the hourly packages of the month, keyed by base filename (e.g. 2023-01-15.08)"""
+    return get_packages_etags(month_date.strftime(f'{HOURLY_PACKAGES_PATH_PREFIX}%Y/%m/'))
+
+
+def get_month_daily_rollups_etags(month_date: datetime.date):
+    """returns the ETags of the daily rollups of the month, keyed by base filename (e.g. 2023-01-15)"""
+    return get_packages_etags(month_date.strftime(f'{ROLLUPS_PATH_PREFIX}{ROLLUP_TYPE_DAILY}/%Y/'), month_date.strftime('%Y-%m-'))
+
+
+def get_rollup_input_package_path(rollup_type, input_base_filename):
+    """daily rollups are built from the hourly packages, monthly rollups are built from the daily rollups"""
+    if rollup_type == ROLLUP_TYPE_DAILY:
+        return f'{HOURLY_PACKAGES_PATH_PREFIX}{input_base_filename[:4]}/{input_base_filename[5:7]}/{input_base_filename}.zip'
+    else:
+        return get_rollup_package_path(ROLLUP_TYPE_DAILY, datetime.date.fromisoformat(input_base_filename))
+
+
+def is_rollup_partial(rollup_type, period_date: datetime.date, today: datetime.date = None):
+    """a rollup is partial if its period did not end yet (today is in Israel time, like the hourly packages),
+    partial rollups are marked in the manifest and rebuilt once the period ends"""
+    if today is None:
+        today = common.now().astimezone(pytz.timezone('israel')).date()
+    if rollup_type == ROLLUP_TYPE_DAILY:
+        period_end_date = period_date + datetime.timedelta(days=1)
+    else:
+        period_end_date = (period_date.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+    return period_end_date > today
+
+
+def get_rollup_inputs(rollup_type, period_date: datetime.date, month_etags):
+    prefix = get_rollup_base_filename(rollup_type, period_date)
+    return {base_filename: etag for base_filename, etag in sorted(month_etags.items()) if base_filename.startswith(prefix)}
+
+
+def append_package(output_file, zip_filename, base_filename, header):
+    """appends the csv rows of the package (hourly package or daily rollup) to output_file while verifying its hash
+    against the package metadata, the csv is streamed in chunks so memory is bounded, returns a tuple of (header, num_rows)"""
+    with zipfile.ZipFile(zip_filename) as zf:
+        with zf.open(f'{base_filename}-metadata.json') as f:
+            metadata = json.load(f)
+        resource = metadata['resources'][0]
+        md5 = hashlib.md5()
+        with zf.open(f'{base_filename}.csv') as f:
+            package_header = f.readline()
+            md5.update(package_header)
+            num_rows = metadata.get('count_of_rows')
+            if num_rows == 0 or not package_header.strip():
+                # dataflows packages without rows may not have a header
+                md5.update(f.read())
+                package_header = None
+            else:
+                if header is not None and header != package_header:
+                    raise PackageHeaderMismatch(f'{base_filename}: header is different from previous packages')
+                if header is None:
+                    output_file.write(package_header)
+                for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                    md5.update(chunk)
+                    output_file.write(chunk)
+        if md5.hexdigest() != resource['hash']:
+            raise PackageHashMismatch(f'{base_filename}: csv hash {md5.hexdigest()} != metadata hash {resource["hash"]}')
+    return (package_header or header), (num_rows or 0)
+
+
+def build_rollup(stats, rollup_type, period_date: datetime.date, inputs, verbose=False):
+    base_filename = get_rollup_base_filename(rollup_type, period_date)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.makedirs(os.path.join(tmpdir, 'package'))
+        header, num_rows = None, 0
+        with open(os.path.join(tmpdir, 'package', 'res_1.csv'), 'wb') as output_file:
+            for input_base_filename in inputs:
+                if verbose:
+                    print(f'Appending package {input_base_filename}')
+                zip_filename = os.path.join(tmpdir, 'input.zip')
+                download_file(get_rollup_input_package_path(rollup_type, input_base_filename), zip_filename)
+                header, input_num_rows = append_package(output_file, zip_filename, input_base_filename, header)
+                os.remove(zip_filename)
+                num_rows += input_num_rows
+                stats[f'{rollup_type}_rollup_input_packages'] += 1
+        field_names = next(csv.reader([header.decode('utf-8')])) if header else []
+        write_datapackage(os.path.join(tmpdir, 'package'), field_names, num_rows)
+        with open(os.path.join(tmpdir, 'package', 'datapackage.json')) as f:
+            package_hash = json.load(f)['hash']
+        url = upload_package(tmpdir, get_rollup_package_path(rollup_type, period_date), base_filename, verbose=verbose)
+    stats[f'{rollup_type}_rollup_rows'] += num_rows
+    return url, package_hash, num_rows
+
+
+def update_rollup(stats, rollup_type, period_date: datetime.date, month_etags, verbose=False):
+    """builds the rollup package from its input packages, only if the input packages changed since the last build,
+    month_etags are the ETags of the month input packages (hourly packages for daily rollups, daily rollups for monthly).
+    returns False if the rollup could not be built due to an input package hash or header mismatch"""
+    inputs = get_rollup_inputs(rollup_type, period_date, month_etags)
+    base_filename = get_rollup_base_filename(rollup_type, period_date)
+    if not inputs:
+        print(f'{rollup_type} rollup {base_filename}: no input packages')
+        stats[f'{rollup_type}_rollup_no_inputs'] += 1
+        return True
+    manifest_path = get_rollup_manifest_path(rollup_type, period_date)
+    manifest = download_json(manifest_path)
+    partial = is_rollup_partial(rollup_type, period_date)
+    if manifest and manifest['inputs'] == inputs and manifest.get('partial', False) == partial:
+        if verbose:
+            print(f'{rollup_type} rollup {base_filename}: input packages did not change')
+        stats[f'{rollup_type}_rollup_unchanged'] += 1
+        return True
+    print(f'{rollup_type} rollup {base_filename}: building from {len(inputs)} input packages')
+    try:
+        url, package_hash, num_rows = build_rollup(stats, rollup_type, period_date, inputs, verbose)
+    except PackageHashMismatch as e:
+        # the rollup is not uploaded and the manifest is not updated, so it will be retried on the next run
+        print(f'{rollup_type} rollup {base_filename}: {e}')
+        stats[f'{rollup_type}_rollup_hash_mismatch'] += 1
+        return False
+    except PackageHeaderMismatch as e:
+        print(f'{rollup_type} rollup {base_filename}: {e}')
+        stats[f'{rollup_type}_rollup_header_mismatch'] += 1
+        return False
+    upload_json({'inputs': inputs, 'hash': package_hash, 'num_rows': num_rows, 'partial': partial, 'updated_at': common.now().isoformat()}, manifest_path)
+    print(f'{rollup_type} rollup {base_filename}: uploaded {num_rows} rows{" (partial)" if partial else ""}: {url}')
+    stats[f'{rollup_type}_rollup_updated'] += 1
+    if partial:
+        stats[f'{rollup_type}_rollup_updated_partial'] += 1
+    return True
+
+
+def update_rollups(start_date=None, num_days=35, rollup_types=None, verbose=False):
+    """updates daily and monthly rollups of the hourly siri packages for num_days days up to start_date (default today),
+    monthly rollups are updated for all months which have a day in this range.
+    monthly rollups are built from the daily rollups, so when updating monthly rollups the daily rollups of all
+    the month days are updated first, a monthly rollup is skipped if one of its daily rollups failed.
+    rollups of periods which did not end yet (e.g. the current month) are marked as partial in the manifest"""
+    start_date = common.parse_date_str(start_date)
+    rollup_types = ROLLUP_TYPES if rollup_types is None else rollup_types
+    stats = defaultdict(int)
+    dates = [start_date - datetime.timedelta(days=i) for i in range(int(num_days))]
+    month_dates = sorted({date.replace(day=1) for date in dates}, reverse=True)
+    for month_date in month_dates:
+        month_etags = get_month_hourly_packages_etags(month_date)
+        daily_dates = set()
+        if ROLLUP_TYPE_DAILY in rollup_types:
+            daily_dates.update(date for date in dates if date.replace(day=1) == month_date)
+        if ROLLUP_TYPE_MONTHLY in rollup_types:
+            daily_dates.update(datetime.date.fromisoformat(base_filename[:10]) for base_filename in month_etags)
+        daily_rollups_ok = True
+        for date in sorted(daily_dates, reverse=True):
+            if not update_rollup(stats, ROLLUP_TYPE_DAILY, date, month_etags, verbose):
+                daily_rollups_ok = False
+        if ROLLUP_TYPE_MONTHLY in rollup_types:
+            if daily_rollups_ok:
+                update_rollup(stats, ROLLUP_TYPE_MONTHLY, month_date, get_month_daily_rollups_etags(month_date), verbose)
+            else:
+                print(f'{ROLLUP_TYPE_MONTHLY} rollup {get_rollup_base_filename(ROLLUP_TYPE_MONTHLY, month_date)}: skipped due to daily rollup errors')
+                stats[f'{ROLLUP_TYPE_MONTHLY}_rollup_skipped_daily_errors'] += 1
+        pprint(dict(stats))
+    print('OK')
@@ -9,6 +9,7 @@ from sqlalchemy.engine import ResultProxy, Row
 from open_bus_stride_db.db import session_decorator, Session
 from open_bus_stride_db.model import SiriRide
 from open_bus_stride_etl import common
+from open_bus_stride_etl.siri import watermarks
 
 
 # Number of siri_ride rows fetched and processed per batch. We must NOT load the
@@ -36,6 +37,24 @@ GET_FIRST_LAST_SQL_QUERY_TEMPLATE = dedent("""
     order by siri_vehicle_location.recorded_at_time {order_by} nulls last
 """)
 
+# batch mode - gets the first and last vehicle locations of all the rides in a batch with a single grouped query
+# the ordering is the same as in GET_FIRST_LAST_SQL_QUERY_TEMPLATE (asc / desc nulls last)
+GET_BATCH_FIRST_LAST_SQL_QUERY_TEMPLATE = dedent("""
+    select
+        siri_ride_stop.siri_ride_id,
+        (array_agg(siri_vehicle_location.id order by siri_vehicle_location.recorded_at_time asc nulls last))[1] first_id,
+        (array_agg(siri_vehicle_location.recorded_at_time order by siri_vehicle_location.recorded_at_time asc nulls last))[1] first_recorded_at_time,
+        (array_agg(siri_vehicle_location.id order by siri_vehicle_location.recorded_at_time desc nulls last))[1] last_id,
+        (array_agg(siri_vehicle_location.recorded_at_time order by siri_vehicle_location.recorded_at_time desc nulls last))[1] last_recorded_at_time
+    from siri_vehicle_location, siri_ride_stop
+    where siri_vehicle_location.siri_ride_stop_id = siri_ride_stop.id
+        and siri_ride_stop.siri_ride_id in ({siri_ride_ids})
+    group by siri_ride_stop.siri_ride_id
+""")
+
+MODE_BATCH = 'batch'
+MODE_PER_RIDE = 'per-ride'
+
 
 def get_first_last_row(session, siri_ride_id, order_by):
     result: ResultProxy = session.execute(GET_FIRST_LAST_SQL_QUERY_TEMPLATE.format(
@@ -48,6 +67,27 @@ def get_first_last_row(session, siri_ride_id, order_by):
     } if row else None
 
 
+def get_batch_first_last_rows(session, siri_ride_ids):
+    """returns a dict of siri_ride_id: (first_row, last_row) for all the given rides,
+    rides without vehicle locations are not included in the result"""
+    first_last_rows = {}
+    if siri_ride_ids:
+        for row in session.execute(GET_BATCH_FIRST_LAST_SQL_QUERY_TEMPLATE.format(
+            siri_ride_ids=','.join(str(int(siri_ride_id)) for siri_ride_id in siri_ride_ids)
+        )):
+            first_last_rows[row.siri_ride_id] = (
+                {
+                    'id': int(row.first_id) if row.first_id else None,
+                    'recorded_at_time': common.utc(row.first_recorded_at_time) if row.first_recorded_at_time else None
+                },
+                {
+                    'id': int(row.last_id) if row.last_id else None,
+                    'recorded_at_time': common.utc(row.last_recorded_at_time) if row.last_recorded_at_time else None
+                },
+            )
+    return first_last_rows
+
+
 def update_first_last_vehicle_locations(siri_ride, first_row, last_row, stats):
     is_updated = False
     if first_row and first_row['id'] != siri_ride.first_vehicle_location_id:
@@ -85,7 +125,7 @@ def update_duration_minutes(siri_ride, first_row, last_row, stats):
 
 
 def get_scheduled_start_time_filters(min_date, max_date, num_days):
-    """Return (orm_filters, sql_where) restricting siri_ride by scheduled_start_time.
+    """Return (orm_filters, sql_where, max_dt) restricting siri_ride by scheduled_start_time.
 
     Mirrors the other siri tasks: the window is always [min_date, max_date] via
     parse_min_max_date_strs (min_date defaults to today-num_days, max_date to today).
@@ -104,13 +144,18 @@ def get_scheduled_start_time_filters(min_date, max_date, num_days):
     min_dt = pytz.UTC.localize(datetime.datetime.combine(min_date, datetime.time.min))
     max_dt = pytz.UTC.localize(datetime.datetime.combine(max_date, datetime.time.min))
     return [SiriRide.scheduled_start_time >= min_dt, SiriRide.scheduled_start_time <= max_dt], \
-        "scheduled_start_time >= '{}' and scheduled_start_time <= '{}'".format(min_dt.isoformat(), max_dt.isoformat())
+        "scheduled_start_time >= '{}' and scheduled_start_time <= '{}'".format(min_dt.isoformat(), max_dt.isoformat()), \
+        max_dt
 
 
 @session_decorator
-def main(session: Session, min_date=None, max_date=None, num_days=4):
+def main(session: Session, min_date=None, max_date=None, num_days=4, mode=MODE_BATCH, incremental=False, full_sweep_hours=24):
+    mode = common.parse_None(mode) or MODE_BATCH
+    assert mode in (MODE_BATCH, MODE_PER_RIDE), 'invalid mode: {}'.format(mode)
+    print('mode={}'.format(mode))
+    watermark, full_sweep = watermarks.start_incremental_run('add-ride-durations', incremental, full_sweep_hours)
     stats = defaultdict(int)
-    sched_filters, sched_sql = get_scheduled_start_time_filters(min_date, max_date, num_days)
+    sched_filters, sched_sql, max_dt = get_scheduled_start_time_filters(min_date, max_date, num_days)
     # Find the TRUE id range of the window cheaply. A plain `min(id) WHERE
     # scheduled_start_time ...` makes the planner walk the pk index from the
     # bottom (scanning every older row), because the date filter and the pk are
@@ -127,6 +172,10 @@ def main(session: Session, min_date=None, max_date=None, num_days=4):
         return
     min_id, max_id = id_range.min_id, id_range.max_id
     print("Window id range: {}..{}".format(min_id, max_id))
+    # in incremental mode, all the rides below the watermark id were already processed by a previous run
+    if not full_sweep and watermark.get('siri_ride_id') and watermark['siri_ride_id'] > min_id:
+        min_id = watermark['siri_ride_id']
+        print("Incremental id range: {}..{}".format(min_id, max_id))
     # Keyset pagination over [min_id, max_id], fetching at most BATCH_SIZE rows per
     # batch so memory stays bounded regardless of how many rows match. Seeding
     # last_id at min_id-1 keeps the first batch from scanning all the older rows
@@ -135,6 +184,8 @@ def main(session: Session, min_date=None, max_date=None, num_days=4):
     # `id > last_id` bound guarantees forward progress, so there's no infinite loop
     # even for rows that legitimately stay updated_duration_minutes=NULL this run.
     last_id = min_id - 1
+    # lowest id of a ride which is still missing updated_duration_minutes, a future incremental run must start from it
+    min_pending_id = None
     siri_ride: SiriRide
     while True:
         rides = session.query(SiriRide).filter(
@@ -145,15 +196,38 @@ def main(session: Session, min_date=None, max_date=None, num_days=4):
         ).order_by(SiriRide.id).limit(BATCH_SIZE).all()
         if not rides:
             break
+        if mode == MODE_BATCH:
+            batch_first_last_rows = get_batch_first_last_rows(session, [siri_ride.id for siri_ride in rides])
+        else:
+            batch_first_last_rows = None
         for siri_ride in rides:
             last_id = siri_ride.id
-            first_row = get_first_last_row(session, siri_ride.id, 'asc')
-            last_row = get_first_last_row(session, siri_ride.id, 'desc')
+            if batch_first_last_rows is None:
+                first_row = get_first_last_row(session, siri_ride.id, 'asc')
+                last_row = get_first_last_row(session, siri_ride.id, 'desc')
+            else:
+                first_row, last_row = batch_first_last_rows.get(siri_ride.id, (None, None))
             update_first_last_vehicle_locations(siri_ride, first_row, last_row, stats)
             update_duration_minutes(siri_ride, first_row, last_row, stats)
+            if siri_ride.updated_duration_minutes is None and min_pending_id is None:
+                min_pending_id = siri_ride.id
             stats['num_rows'] += 1
         session.commit()
         pprint(dict(stats))
         print("Processed {} rows (up to id {})..".format(stats['num_rows'], last_id))
     pprint(dict(stats))
     print("Processed {} rows total".format(stats['num_rows']))
+    watermark_id = min_pending_id if min_pending_id is not None else max_id + 1
+    if incremental:
+        # ride ids are not ordered by scheduled_start_time (rides are created before their scheduled start),
+        # rides scheduled after the window with ids in the window id range were not processed by this run,
+        # so the watermark must not pass them
+        later_min_id = session.execute(dedent("""
+            with later_rows as materialized (
+                select id from siri_ride where scheduled_start_time > '{}'
+            )
+            select min(id) min_id from later_rows where id < {}
+        """).format(max_dt.isoformat(), watermark_id)).first().min_id
+        if later_min_id is not None:
+            watermark_id = later_min_id
+    watermarks.finish_incremental_run('add-ride-durations', incremental, watermark, full_sweep, siri_ride_id=watermark_id)
@@ -0,0 +1,106 @@
+import os
+import json
+import threading
+from collections import deque
+
+from .. import config
+from ..common import now
+from .common import iterate_siri_route_id_dates, count_siri_route_id_dates
+
+
+CHECKPOINTS_ROOTPATH = os.path.join(config.OPEN_BUS_SIRI_ETL_ROOTPATH, 'checkpoints')
+
+
+class Checkpoint:
+    """Persists the completed (date, siri_route_id) units of a siri task run to a local json file,
+    so that a run which was interrupted can be resumed from where it stopped.
+
+    The file keeps a watermark - the last unit such that all the units up to it were completed,
+    and the set of units after the watermark which were completed (units are processed out of order when using workers).
+    On resume the grouping query starts after the watermark and the completed units are skipped."""
+
+    def __init__(self, task_name, min_date, max_date, resume=False):
+        self.filename = os.path.join(CHECKPOINTS_ROOTPATH, task_name, '{}_{}.json'.format(min_date, max_date))
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self.start_time = now()
+        self.num_completed_this_run = 0
+        data = None
+        if os.path.exists(self.filename):
+            if resume:
+                with open(self.filename) as f:
+                    data = json.load(f)
+                print(f'Resuming from checkpoint {self.filename} (watermark={data["watermark"]}, completed units={data["num_completed"]})')
+            else:
+                print(f'Ignoring existing checkpoint {self.filename}')
+        elif resume:
+            print(f'No checkpoint found, starting from the beginning: {self.filename}')
+        if data:
+            self.watermark = tuple(data['watermark']) if data['watermark'] else None
+            self.completed = set(tuple(unit) for unit in data['completed'])
+            self.num_completed = data['num_completed']
+            self.total_units = data['total_units']
+        else:
+            self.watermark = None
+            self.completed = set()
+            self.num_completed = 0
+            self.total_units = None
+
+    def iterate_siri_route_id_dates(self, **kwargs):
+        """wraps siri.common.iterate_siri_route_id_dates - starts after the watermark, skips completed units
+        and tracks the yielded units, on the first run counts the total number of units for the progress report"""
+        if self.total_units is None:
+            self.total_units = count_siri_route_id_dates(
+                where_sql=kwargs.get('where_sql'), extra_from_sql=kwargs.get('extra_from_sql')
+            )
+            print(f'Total units: {self.total_units}')
+        for date, siri_route_ids in iterate_siri_route_id_dates(after_date_route_id=self.watermark, **kwargs):
+            with self._lock:
+                siri_route_ids = [siri_route_id for siri_route_id in siri_route_ids if (date, siri_route_id) not in self.completed]
+                self._pending.extend((date, siri_route_id) for siri_route_id in siri_route_ids)
+            if siri_route_ids:
+                yield date, siri_route_ids
+
+    def set_completed(self, date, siri_route_ids):
+        with self._lock:
+            for siri_route_id in siri_route_ids:
+                self.completed.add((date, siri_route_id))
+            self.num_completed += len(siri_route_ids)
+            self.num_completed_this_run += len(siri_route_ids)
+            while self._pending and self._pending[0] in self.completed:
+                self.watermark = self._pending.popleft()
+            if self.watermark:
+                self.completed = {unit for unit in self.completed if unit > self.watermark}
+            self._save()
+            print(self.get_progress_str())
+
+    def get_progress_str(self):
+        seconds = (now() - self.start_time).total_seconds()
+        units_per_second = self.num_completed_this_run / seconds if seconds else 0
+        progress_str = f'Completed {self.num_completed}'
+        if self.total_units:
+            progress_str += f' / {self.total_units} units ({self.num_completed / self.total_units * 100:.1f}%)'
+        else:
+            progress_str += ' units'
+        progress_str += f', {units_per_second:.2f} units/sec'
+        if self.total_units and units_per_second:
+            eta_seconds = max(self.total_units - self.num_completed, 0) / units_per_second
+            progress_str += f', ETA {eta_seconds / 60:.1f} minutes'
+        return progress_str
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump({
+                'watermark': self.watermark,
+                'completed': sorted(self.completed),
+                'num_completed': self.num_completed,
+                'total_units': self.total_units,
+            }, f)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def finish(self):
+        """the run completed successfully, the checkpoint is not needed anymore"""
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        print(f'Finished, {self.num_completed_this_run} units completed in this run')
@@ -11,6 +11,11 @@ def siri():
 @click.option('--min-date', help='Date string (%Y-%m-%d) specifying the min date to process. Defaults to today minus num_days if not provided.')
 @click.option('--max-date', help='Date string (%Y-%m-%d) specifying the max date to process. Defaults to today if not provided.')
 @click.option('--num-days', default=4, show_default=True, help='min_date defaults to today minus num_days if not provided')
+@click.option('--mode', type=click.Choice(['batch', 'per-ride']), default='batch', show_default=True,
+              help='batch - get first/last vehicle locations of each batch of rides with a single query, '
+                   'per-ride - run 2 queries per ride (the previous behavior)')
+@click.option('--incremental', is_flag=True, help='only process rides which were updated since the previous incremental run, with a periodic full sweep')
+@click.option('--full-sweep-hours', default=24, show_default=True, help='in incremental mode, run a full sweep if the last one is older than this number of hours')
 def add_ride_durations(**kwargs):
     """add duration of rides based on vehicle locations to siri_ride table"""
     from .add_ride_durations import main
@@ -21,6 +26,14 @@ def add_ride_durations(**kwargs):
 @click.option('--min-date', help='Date string (%Y-%m-%d) specifying the min date to process. Defaults to today minus num_days if not provided.')
 @click.option('--max-date', help='Date string (%Y-%m-%d) specifying the max date to process. Defaults to today if not provided.')
 @click.option('--num-days', default=1, show_default=True, help='min_date defaults to today minus num_days if not provided')
+@click.option('--workers', default=1, show_default=True, help='number of units to process concurrently, each with its own DB connection')
+@click.option('--mode', type=click.Choice(['chunks', 'per-route']), default='chunks', show_default=True,
+              help='chunks - update chunks of siri route ids of each date with set-based statements, '
+                   'per-route - update each siri route id with a separate statement (the previous behavior)')
+@click.option('--checkpoint', is_flag=True, help='record completed date / siri route id units to a local checkpoint file')
+@click.option('--resume', is_flag=True, help='resume from the checkpoint of a previous run with the same min/max date (implies --checkpoint)')
+@click.option('--incremental', is_flag=True, help='only process rides which were updated since the previous incremental run, with a periodic full sweep')
+@click.option('--full-sweep-hours', default=24, show_default=True, help='in incremental mode, run a full sweep if the last one is older than this number of hours')
 def update_ride_stops_gtfs(**kwargs):
     """update siri_ride_stop table with the related gtfs_stop data"""
     from .update_ride_stops_gtfs import main
@@ -31,16 +44,44 @@ def update_ride_stops_gtfs(**kwargs):
 @click.option('--min-date', help='Date string (%Y-%m-%d) specifying the min date to process. Defaults to today minus num_days if not provided.')
 @click.option('--max-date', help='Date string (%Y-%m-%d) specifying the max date to process. Defaults to today if not provided.')
 @click.option('--num-days', default=1, show_default=True, help='min_date defaults to today minus num_days if not provided')
+@click.option('--distance-accuracy', type=click.Choice(['geodesic', 'haversine']),
+              help='geodesic - geopy distance (the previous behavior), haversine - fast vectorized great circle distance. '
+                   'Defaults to geodesic for the python engine and haversine for the sql engine')
+@click.option('--engine', type=click.Choice(['python', 'sql']), default='python', show_default=True,
+              help='python - calculate distances in python, sql - calculate distances in the DB (supports only haversine distance accuracy)')
+@click.option('--workers', default=1, show_default=True, help='number of units to process concurrently, each with its own DB connection')
+@click.option('--checkpoint', is_flag=True, help='record completed date / siri route id units to a local checkpoint file')
+@click.option('--resume', is_flag=True, help='resume from the checkpoint of a previous run with the same min/max date (implies --checkpoint)')
+@click.option('--incremental', is_flag=True, help='only process rides which were updated since the previous incremental run, with a periodic full sweep')
+@click.option('--full-sweep-hours', default=24, show_default=True, help='in incremental mode, run a full sweep if the last one is older than this number of hours')
 def update_ride_stops_vehicle_locations(**kwargs):
     """update ride_stops with vehicle_location nearest each stop by gtfs lon/lat"""
     from .update_ride_stops_vehicle_locations import main
     main(**kwargs)
 
 
+@siri.command()
+@click.option('--num-rows', default=200000, show_default=True)
+@click.option('--rows-per-group', default=50, show_default=True, help='number of vehicle locations per ride stop')
+def benchmark_distances(**kwargs):
+    """compare the vectorized distance kernel with the geopy per-row implementation"""
+    from .distances import benchmark
+    benchmark(**kwargs)
+
+
 @siri.command()
 @click.option('--min-date', help='Date string (%Y-%m-%d) specifying the min date to process. Defaults to today minus num_days if not provided.')
 @click.option('--max-date', help='Date string (%Y-%m-%d) specifying the max date to process. Defaults to today if not provided.')
 @click.option('--num-days', default=1, show_default=True, help='min_date defaults to today minus num_days if not provided')
+@click.option('--workers', default=1, show_default=True, help='number of units to process concurrently, each with its own DB connection')
+@click.option('--incremental', is_flag=True, help='only process rides which were updated since the previous incremental run, with a periodic full sweep')
+@click.option('--full-sweep-hours', default=24, show_default=True, help='in incremental mode, run a full sweep if the last one is older than this number of hours')
+@click.option('--mode', type=click.Choice(['staged', 'per-strategy']), default='staged', show_default=True,
+              help='staged - build the candidate matches once per date in temporary tables, '
+                   'per-strategy - run a separate update with full joins for each match strategy (the previous behavior)')
+@click.option('--refresh-views', type=click.Choice(['always', 'if-changed', 'never']), default='if-changed', show_default=True,
+              help='refresh the gtfs_rides_agg materialized views: always, only if some siri rides were updated '
+                   'or on a full sweep (if-changed), or never')
 def update_rides_gtfs(**kwargs):
     """Update siri rides data with related gtfs data"""
     from .update_rides_gtfs import main
@@ -5,35 +5,73 @@ from .. import common
 from open_bus_stride_db import db
 
 
-def iterate_siri_route_id_dates(where_sql=None, extra_from_sql=None):
-    if where_sql:
-        where_sql = 'where {}'.format(where_sql)
+# default max number of siri_route_ids yielded at once by iterate_siri_route_id_dates
+SIRI_ROUTE_IDS_CHUNK_SIZE = 500
+
+
+def get_siri_route_id_dates_sql(where_sql=None, extra_from_sql=None, after_date_route_id=None):
+    where_sqls = [where_sql] if where_sql else []
+    if after_date_route_id:
+        after_date, after_siri_route_id = after_date_route_id
+        where_sqls.append(dedent("""
+            (
+                date_trunc('day', siri_ride.scheduled_start_time) > '{date}'
+                or (date_trunc('day', siri_ride.scheduled_start_time) = '{date}' and siri_ride.siri_route_id > {siri_route_id})
+            )
+        """).format(date=after_date, siri_route_id=int(after_siri_route_id)))
+    if where_sqls:
+        where_sql = 'where {}'.format(' and '.join('({})'.format(sql) for sql in where_sqls))
     else:
         where_sql = ''
     if extra_from_sql:
         extra_from_sql = ', {}'.format(extra_from_sql)
     else:
         extra_from_sql = ''
-    date_siri_route_ids = {}
-    with common.print_memory_usage("Getting siri_route_ids / dates..."):
-        with db.get_session() as session:
-            sql = dedent("""
-                select date_trunc('day', siri_ride.scheduled_start_time) scheduled_start_date, siri_ride.siri_route_id
-                from siri_ride {}
-                {}
-                group by date_trunc('day', siri_ride.scheduled_start_time), siri_ride.siri_route_id
-                order by date_trunc('day', siri_ride.scheduled_start_time), siri_ride.siri_route_id
-            """).format(extra_from_sql, where_sql)
-            print(sql)
-            for row in session.execute(sql):
-                date_siri_route_ids.setdefault(row.scheduled_start_date.strftime('%Y-%m-%d'), set()).add(row.siri_route_id)
-    if len(date_siri_route_ids) > 0:
-        print("Date: num siri route ids")
-        for date, siri_route_ids in date_siri_route_ids.items():
-            print("{}: {}".format(date, len(siri_route_ids)))
+    return dedent("""
+        select date_trunc('day', siri_ride.scheduled_start_time) scheduled_start_date, siri_ride.siri_route_id
+        from siri_ride {}
+        {}
+        group by date_trunc('day', siri_ride.scheduled_start_time), siri_ride.siri_route_id
+        order by date_trunc('day', siri_ride.scheduled_start_time), siri_ride.siri_route_id
+    """).format(extra_from_sql, where_sql)
+
+
+def count_siri_route_id_dates(**kwargs):
+    """returns the number of (date, siri_route_id) units, accepts the same arguments as get_siri_route_id_dates_sql"""
+    with db.get_session() as session:
+        return session.execute('select count(1) cnt from ({}) a'.format(get_siri_route_id_dates_sql(**kwargs))).one().cnt
+
+
+def iterate_siri_route_id_dates(where_sql=None, extra_from_sql=None, chunk_size=SIRI_ROUTE_IDS_CHUNK_SIZE, after_date_route_id=None):
+    """Yields (date, siri_route_ids) tuples ordered by date and siri_route_id.
+    The grouping query is streamed using a server-side cursor, so work can start as soon as the first rows arrive
+    and memory is bounded by chunk_size. Each date may be yielded multiple times, with up to chunk_size
+    siri_route_ids each time (if chunk_size is None - each date is yielded once with all its siri_route_ids).
+    if after_date_route_id is a (date, siri_route_id) tuple - only units after it are yielded (used to resume)."""
+    with db.get_session() as session:
+        sql = get_siri_route_id_dates_sql(where_sql, extra_from_sql, after_date_route_id)
+        print(sql)
         print("Iterating over date / siri route ids")
-        for date, siri_route_ids in date_siri_route_ids.items():
-            with common.print_memory_usage("Processing date {} ({} route ids)".format(date, len(siri_route_ids))):
-                yield date, siri_route_ids
-    else:
+        current_date, current_siri_route_ids, num_yielded = None, [], 0
+        for row in session.execute(sql, execution_options={'stream_results': True}):
+            date = row.scheduled_start_date.strftime('%Y-%m-%d')
+            if current_siri_route_ids and (date != current_date or (chunk_size and len(current_siri_route_ids) >= chunk_size)):
+                with common.print_memory_usage("Processing date {} ({} route ids)".format(current_date, len(current_siri_route_ids))):
+                    yield current_date, current_siri_route_ids
+                num_yielded += 1
+                current_siri_route_ids = []
+            current_date = date
+            current_siri_route_ids.append(row.siri_route_id)
+        if current_siri_route_ids:
+            with common.print_memory_usage("Processing date {} ({} route ids)".format(current_date, len(current_siri_route_ids))):
+                yield current_date, current_siri_route_ids
+            num_yielded += 1
+    if num_yielded == 0:
         print("No relevant date/siri route ids found")
+
+
+def iterate_siri_route_id_date_units(date_siri_route_ids):
+    """flattens the (date, siri_route_ids) tuples yielded by iterate_siri_route_id_dates to (date, siri_route_id) tuples"""
+    for date, siri_route_ids in date_siri_route_ids:
+        for siri_route_id in siri_route_ids:
+            yield date, siri_route_id
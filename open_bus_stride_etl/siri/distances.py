@@ -0,0 +1,122 @@
+import time
+import random
+import traceback
+
+import numpy as np
+from geopy.distance import distance
+
+
+ACCURACY_HAVERSINE = 'haversine'
+ACCURACY_GEODESIC = 'geodesic'
+ACCURACIES = [ACCURACY_HAVERSINE, ACCURACY_GEODESIC]
+
+# mean earth radius, same as used by geopy great_circle
+EARTH_RADIUS_METERS = 6371008.8
+
+
+def haversine_meters(lats1, lons1, lats2, lons2):
+    """vectorized great circle distance in meters between arrays of points (in degrees)"""
+    lats1, lons1, lats2, lons2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lats1, lons1, lats2, lons2))
+    a = np.sin((lats2 - lats1) / 2) ** 2 + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def get_haversine_meters_sql(lat1, lon1, lat2, lon2):
+    """returns an SQL expression which calculates the same distance as haversine_meters for the given column names"""
+    return (
+        f'2 * {EARTH_RADIUS_METERS} * asin(sqrt(least(1, '
+        f'power(sin(radians({lat2} - {lat1}) / 2), 2) '
+        f'+ cos(radians({lat1})) * cos(radians({lat2})) * power(sin(radians({lon2} - {lon1}) / 2), 2)'
+        f')))'
+    )
+
+
+def geodesic_meters(lats1, lons1, lats2, lons2):
+    """geodesic distance in meters using geopy, slow - calculated per point"""
+    res = np.full(len(lats1), np.nan)
+    for i, (lat1, lon1, lat2, lon2) in enumerate(zip(lats1, lons1, lats2, lons2)):
+        if not np.isnan(lat1) and not np.isnan(lon1) and not np.isnan(lat2) and not np.isnan(lon2):
+            res[i] = distance((lat1, lon1), (lat2, lon2)).m
+    return res
+
+
+def get_distances_meters(lats1, lons1, lats2, lons2, accuracy=ACCURACY_GEODESIC):
+    """returns an array of distances in meters, invalid coordinates get a nan distance"""
+    lats1, lons1, lats2, lons2 = (np.asarray(a, dtype=np.float64) for a in (lats1, lons1, lats2, lons2))
+    invalid = (np.abs(lats1) > 90) | (np.abs(lats2) > 90)
+    if accuracy == ACCURACY_HAVERSINE:
+        res = haversine_meters(lats1, lons1, lats2, lons2)
+    elif accuracy == ACCURACY_GEODESIC:
+        res = geodesic_meters(np.where(invalid, np.nan, lats1), lons1, np.where(invalid, np.nan, lats2), lons2)
+    else:
+        raise Exception('invalid accuracy: {}'.format(accuracy))
+    res[invalid] = np.nan
+    return res
+
+
+def get_nearest_per_group(group_ids, distances):
+    """grouped argmin - returns a tuple of (group_ids, indices) where indices are the index of the min distance
+    for each group, nan distances are ignored and ties are resolved by the first index (same as iterating in order)"""
+    group_ids, distances = np.asarray(group_ids), np.asarray(distances)
+    valid_indices = np.flatnonzero(~np.isnan(distances))
+    if len(valid_indices) == 0:
+        return group_ids[:0], valid_indices
+    order = valid_indices[np.lexsort((valid_indices, distances[valid_indices], group_ids[valid_indices]))]
+    sorted_group_ids = group_ids[order]
+    is_first = np.empty(len(order), dtype=bool)
+    is_first[0] = True
+    is_first[1:] = sorted_group_ids[1:] != sorted_group_ids[:-1]
+    return sorted_group_ids[is_first], order[is_first]
+
+
+def geopy_get_nearest_per_group(group_ids, lats1, lons1, lats2, lons2):
+    """the previous per-row implementation, used for benchmarking"""
+    group_nearest_distance, group_nearest_index = {}, {}
+    distances = []
+    for i, (group_id, lat1, lon1, lat2, lon2) in enumerate(zip(group_ids, lats1, lons1, lats2, lons2)):
+        try:
+            distance_meters = distance((lat1, lon1), (lat2, lon2)).m
+        except:
+            traceback.print_exc()
+            distance_meters = None
+        distances.append(distance_meters)
+        if distance_meters is not None:
+            if group_id not in group_nearest_distance or distance_meters < group_nearest_distance[group_id]:
+                group_nearest_distance[group_id] = distance_meters
+                group_nearest_index[group_id] = i
+    return distances, group_nearest_index
+
+
+def benchmark(num_rows=200000, rows_per_group=50, seed=1):
+    """compare the vectorized kernel with the geopy per-row implementation on random points in Israel,
+    the default sizes are similar to a busy route/date"""
+    rnd = random.Random(seed)
+    group_ids, lats1, lons1, lats2, lons2 = [], [], [], [], []
+    for i in range(num_rows):
+        group_id = i // rows_per_group
+        if i % rows_per_group == 0:
+            stop_lat, stop_lon = rnd.uniform(29.5, 33.3), rnd.uniform(34.3, 35.9)
+        group_ids.append(group_id)
+        lats2.append(stop_lat)
+        lons2.append(stop_lon)
+        lats1.append(stop_lat + rnd.uniform(-0.01, 0.01))
+        lons1.append(stop_lon + rnd.uniform(-0.01, 0.01))
+    print('Benchmarking {} rows ({} rows per group)'.format(num_rows, rows_per_group))
+    start_time = time.perf_counter()
+    geopy_distances, geopy_nearest = geopy_get_nearest_per_group(group_ids, lats1, lons1, lats2, lons2)
+    geopy_seconds = time.perf_counter() - start_time
+    print('geopy: {:.3f}s ({:.0f} rows/sec)'.format(geopy_seconds, num_rows / geopy_seconds))
+    geopy_distances = np.array(geopy_distances, dtype=np.float64)
+    for accuracy in ACCURACIES:
+        start_time = time.perf_counter()
+        distances = get_distances_meters(lats1, lons1, lats2, lons2, accuracy)
+        nearest_group_ids, nearest_indices = get_nearest_per_group(group_ids, distances)
+        seconds = time.perf_counter() - start_time
+        num_same_nearest = sum(
+            1 for group_id, i in zip(nearest_group_ids.tolist(), nearest_indices.tolist())
+            if geopy_nearest.get(group_id) == i
+        )
+        print('{}: {:.3f}s ({:.0f} rows/sec, x{:.1f}), max diff from geopy: {:.3f}m, same nearest: {}/{}'.format(
+            accuracy, seconds, num_rows / seconds, geopy_seconds / seconds,
+            np.nanmax(np.abs(distances - geopy_distances)), num_same_nearest, len(geopy_nearest)
+        ))
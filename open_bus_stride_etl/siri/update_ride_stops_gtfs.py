@@ -1,5 +1,4 @@
 import datetime
-from pprint import pprint
 from textwrap import dedent
 from collections import defaultdict
 
@@ -7,48 +6,108 @@ from sqlalchemy.engine import ResultProxy
 
 from open_bus_stride_db import db
 
-from .common import iterate_siri_route_id_dates
-from ..common import parse_min_max_date_strs, get_db_date_str
+from . import watermarks
+from .checkpoints import Checkpoint
+from .common import iterate_siri_route_id_dates, SIRI_ROUTE_IDS_CHUNK_SIZE
+from ..common import parse_min_max_date_strs, get_db_date_str, parse_date_str, iterate_chunks, now, process_units
 
 
-def main(min_date, max_date, num_days):
+# chunks - update all the routes of a date using set-based statements, each for a chunk of SIRI_ROUTE_IDS_CHUNK_SIZE siri_route_ids
+# per-route - update each siri_route_id using a separate statement and session (the previous behavior)
+MODE_CHUNKS = 'chunks'
+MODE_PER_ROUTE = 'per-route'
+MODES = [MODE_CHUNKS, MODE_PER_ROUTE]
+
+UPDATE_SQL_TEMPLATE = dedent("""
+    set local synchronous_commit to off;
+    update siri_ride_stop
+    set gtfs_stop_id = gtfs_stop.id
+    from siri_stop, siri_ride, gtfs_stop
+    where siri_ride_stop.siri_stop_id = siri_stop.id
+    and siri_ride_stop.siri_ride_id = siri_ride.id
+    and siri_ride.updated_duration_minutes is not null
+    and siri_ride_stop.gtfs_stop_id is null
+    and gtfs_stop.code = siri_stop.code
+    and gtfs_stop.date = '{date}'
+    and siri_ride.scheduled_start_time >= '{date}'
+    and siri_ride.scheduled_start_time < '{next_date}'
+    and {siri_route_id_where}
+    {incremental_where};
+""")
+
+
+def process_route_ids(date, siri_route_ids, stats, checkpoint=None, incremental_where_sql=None):
+    start_time = now()
+    if len(siri_route_ids) == 1:
+        siri_route_id_where = 'siri_ride.siri_route_id = {}'.format(int(siri_route_ids[0]))
+    else:
+        siri_route_id_where = 'siri_ride.siri_route_id = any(array[{}])'.format(','.join(str(int(siri_route_id)) for siri_route_id in siri_route_ids))
+    with db.get_session() as session:
+        res: ResultProxy = session.execute(UPDATE_SQL_TEMPLATE.format(
+            date=date, next_date=get_db_date_str(parse_date_str(date) + datetime.timedelta(days=1)),
+            siri_route_id_where=siri_route_id_where,
+            incremental_where=f'and {incremental_where_sql}' if incremental_where_sql else ''
+        ))
+        stats['updated_ride_stops'] += res.rowcount
+        session.commit()
+    stats['updated_siri_routes'] += len(siri_route_ids)
+    stats['update_statements'] += 1
+    stats['update_seconds'] += (now() - start_time).total_seconds()
+    if checkpoint:
+        checkpoint.set_completed(date, siri_route_ids)
+
+
+def iterate_units(date_siri_route_ids, mode):
+    for date, siri_route_ids in date_siri_route_ids:
+        if mode == MODE_CHUNKS:
+            for siri_route_ids_chunk in iterate_chunks(siri_route_ids, SIRI_ROUTE_IDS_CHUNK_SIZE):
+                yield date, siri_route_ids_chunk
+        else:
+            for siri_route_id in siri_route_ids:
+                yield date, [siri_route_id]
+
+
+def main(min_date, max_date, num_days, workers=1, mode=MODE_CHUNKS, checkpoint=False, resume=False,
+         incremental=False, full_sweep_hours=24):
     min_date, max_date = parse_min_max_date_strs(min_date, max_date, num_days)
     print(f'min_date={min_date}')
     print(f'max_date={max_date}')
-    # the query is optimized only for a single day
-    assert (max_date - min_date) == datetime.timedelta(days=1)
+    print(f'mode={mode}')
+    assert mode in MODES, f'invalid mode: {mode}'
     stats = defaultdict(int)
-    for date, siri_route_ids in iterate_siri_route_id_dates(
-        extra_from_sql='gtfs_stop, siri_stop, siri_ride_stop',
-        where_sql=dedent("""
-            siri_ride_stop.siri_stop_id = siri_stop.id
-            and siri_ride_stop.siri_ride_id = siri_ride.id
-            -- if we have updated_duration_minutes it means we updated the duration of the ride
-            -- so we have all the ride stops data which we must ensure before making these updates
-            and siri_ride.updated_duration_minutes is not null
-            and siri_ride_stop.gtfs_stop_id is null
-            and gtfs_stop.code = siri_stop.code
-            and gtfs_stop.date = '{min_date}'
-            and siri_ride.scheduled_start_time >= '{min_date}'
-            and siri_ride.scheduled_start_time < '{max_date}'
-        """).format(min_date=get_db_date_str(min_date), max_date=get_db_date_str(max_date))
-    ):
-        for siri_route_id in siri_route_ids:
-            stats['updated_siri_routes'] += 1
-            with db.get_session() as session:
-                res: ResultProxy = session.execute(dedent("""
-                    set local synchronous_commit to off;
-                    update siri_ride_stop
-                    set gtfs_stop_id = gtfs_stop.id
-                    from siri_stop, siri_ride, gtfs_stop
-                    where siri_ride_stop.siri_stop_id = siri_stop.id
-                    and siri_ride_stop.siri_ride_id = siri_ride.id
-                    and siri_ride.updated_duration_minutes is not null
-                    and siri_ride_stop.gtfs_stop_id is null
-                    and gtfs_stop.code = siri_stop.code
-                    and gtfs_stop.date = '{}'
-                    and siri_ride.siri_route_id = {};
-                """).format(date, siri_route_id))
-                stats['updated_ride_stops'] += res.rowcount
-                session.commit()
-                pprint(dict(stats))
+    start_time = now()
+    watermark, full_sweep = watermarks.start_incremental_run('update-ride-stops-gtfs', incremental, full_sweep_hours)
+    incremental_where_sql = watermarks.get_updated_duration_minutes_where_sql(watermark, full_sweep)
+    checkpoint = Checkpoint('update-ride-stops-gtfs', min_date, max_date, resume) if checkpoint or resume else None
+    process_units(
+        iterate_units((checkpoint.iterate_siri_route_id_dates if checkpoint else iterate_siri_route_id_dates)(
+            extra_from_sql='gtfs_stop, siri_stop, siri_ride_stop',
+            where_sql=dedent("""
+                siri_ride_stop.siri_stop_id = siri_stop.id
+                and siri_ride_stop.siri_ride_id = siri_ride.id
+                -- if we have updated_duration_minutes it means we updated the duration of the ride
+                -- so we have all the ride stops data which we must ensure before making these updates
+                and siri_ride.updated_duration_minutes is not null
+                and siri_ride_stop.gtfs_stop_id is null
+                and gtfs_stop.code = siri_stop.code
+                and gtfs_stop.date = date_trunc('day', siri_ride.scheduled_start_time)::date
+                and siri_ride.scheduled_start_time >= '{min_date}'
+                and siri_ride.scheduled_start_time < '{max_date}'
+                {incremental_where}
+            """).format(
+                min_date=get_db_date_str(min_date), max_date=get_db_date_str(max_date),
+                incremental_where=f'and {incremental_where_sql}' if incremental_where_sql else ''
+            )
+        ), mode),
+        lambda unit, stats_: process_route_ids(*unit, stats_, checkpoint, incremental_where_sql),
+        stats, workers
+    )
+    if checkpoint:
+        checkpoint.finish()
+    watermarks.finish_incremental_run(
+        'update-ride-stops-gtfs', incremental, watermark, full_sweep,
+        updated_duration_minutes=start_time.isoformat()
+    )
+    print('Total {} mode: {} update statements, {:.2f}s in update statements, {:.2f}s total'.format(
+        mode, stats['update_statements'], stats['update_seconds'], (now() - start_time).total_seconds()
+    ))
@@ -1,103 +1,249 @@
-import traceback
-from pprint import pprint
 from textwrap import dedent
 from collections import defaultdict
 
-from geopy.distance import distance
+import numpy as np
 
 from open_bus_stride_db import db
 
-from .common import iterate_siri_route_id_dates
-from ..common import parse_min_max_date_strs, get_db_date_str
+from . import distances, watermarks
+from .checkpoints import Checkpoint
+from .common import iterate_siri_route_id_dates, iterate_siri_route_id_date_units
+from ..common import parse_min_max_date_strs, get_db_date_str, iterate_chunks, now, process_units, parse_None
 
 
-def process_ride_rows(rows, session, stats):
-    vehicle_location_distance = {}
-    ride_stop_nearest_distance = {}
-    ride_stop_nearest_vehicle_location = {}
+# max number of rows in the VALUES list of a single bulk update statement
+BULK_UPDATE_CHUNK_SIZE = 5000
+
+# python - stream the rows and calculate distances in python, then write the results with bulk updates
+# sql - calculate distances and nearest vehicle locations in the DB without moving the rows over the wire
+ENGINE_PYTHON = 'python'
+ENGINE_SQL = 'sql'
+ENGINES = [ENGINE_PYTHON, ENGINE_SQL]
+
+ROUTE_DATE_ROWS_SQL_TEMPLATE = dedent("""
+    select siri_ride.id siri_ride_id,
+        siri_ride_stop.id siri_ride_stop_id,
+        siri_vehicle_location.id siri_vehicle_location_id,
+        siri_vehicle_location.lon siri_vehicle_location_lon,
+        siri_vehicle_location.lat siri_vehicle_location_lat,
+        gtfs_stop.lon gtfs_stop_lon,
+        gtfs_stop.lat gtfs_stop_lat
+    from siri_ride, siri_ride_stop, siri_vehicle_location, gtfs_stop
+    where siri_ride.siri_route_id = {siri_route_id}
+    and date_trunc('day', siri_ride.scheduled_start_time) = '{date}'
+    and siri_ride_stop.siri_ride_id = siri_ride.id
+    and siri_vehicle_location.siri_ride_stop_id = siri_ride_stop.id
+    and gtfs_stop.id = siri_ride_stop.gtfs_stop_id
+    order by siri_ride.id, siri_vehicle_location.recorded_at_time
+""")
+
+# rows with invalid coordinates are skipped, same as the python engine
+SQL_VALID_COORDINATES_WHERE = dedent("""
+    and siri_vehicle_location.lat is not null and siri_vehicle_location.lon is not null
+    and gtfs_stop.lat is not null and gtfs_stop.lon is not null
+    and abs(siri_vehicle_location.lat) <= 90 and abs(gtfs_stop.lat) <= 90
+""")
+
+SQL_DISTANCE_METERS = distances.get_haversine_meters_sql(
+    'siri_vehicle_location.lat', 'siri_vehicle_location.lon', 'gtfs_stop.lat', 'gtfs_stop.lon'
+)
+
+SQL_UPDATE_VEHICLE_LOCATIONS_DISTANCE_TEMPLATE = dedent("""
+    update siri_vehicle_location
+    set distance_from_siri_ride_stop_meters = round({distance_meters})
+    from siri_ride, siri_ride_stop, gtfs_stop
+    where siri_ride.siri_route_id = {siri_route_id}
+    and date_trunc('day', siri_ride.scheduled_start_time) = '{date}'
+    and siri_ride_stop.siri_ride_id = siri_ride.id
+    and siri_vehicle_location.siri_ride_stop_id = siri_ride_stop.id
+    and gtfs_stop.id = siri_ride_stop.gtfs_stop_id
+    {valid_coordinates_where}
+""")
+
+# the nearest vehicle location is chosen by the unrounded distance and ties are resolved by recorded_at_time,
+# same as the python engine which iterates the rows ordered by recorded_at_time
+SQL_SELECT_RIDE_STOPS_NEAREST_VEHICLE_LOCATION_TEMPLATE = dedent("""
+    select distinct on (siri_ride_stop.id)
+        siri_ride_stop.id siri_ride_stop_id,
+        siri_vehicle_location.id siri_vehicle_location_id
+    from siri_ride, siri_ride_stop, siri_vehicle_location, gtfs_stop
+    where siri_ride.siri_route_id = {siri_route_id}
+    and date_trunc('day', siri_ride.scheduled_start_time) = '{date}'
+    and siri_ride_stop.siri_ride_id = siri_ride.id
+    and siri_vehicle_location.siri_ride_stop_id = siri_ride_stop.id
+    and gtfs_stop.id = siri_ride_stop.gtfs_stop_id
+    {valid_coordinates_where}
+    order by siri_ride_stop.id, {distance_meters}, siri_vehicle_location.recorded_at_time
+""")
+
+SQL_UPDATE_RIDE_STOPS_NEAREST_VEHICLE_LOCATION_TEMPLATE = dedent("""
+    update siri_ride_stop
+    set nearest_siri_vehicle_location_id = nearest.siri_vehicle_location_id
+    from ({select_nearest_sql}) nearest
+    where siri_ride_stop.id = nearest.siri_ride_stop_id
+""")
+
+
+def get_rows_distances(rows, accuracy=distances.ACCURACY_GEODESIC):
+    """returns a tuple of (vehicle_location_distance, ride_stop_nearest_vehicle_location) dicts:
+        vehicle_location_distance: siri_vehicle_location_id -> distance in meters from the gtfs stop
+        ride_stop_nearest_vehicle_location: siri_ride_stop_id -> nearest siri_vehicle_location_id
+    distances are calculated for all the rows together using the vectorized kernel from siri.distances
+    """
+    ride_stop_ids, vehicle_location_ids = [], []
+    vehicle_location_lats, vehicle_location_lons, gtfs_stop_lats, gtfs_stop_lons = [], [], [], []
     for row in rows:
-        try:
-            distance_meters = distance(
-                (row.siri_vehicle_location_lat, row.siri_vehicle_location_lon),
-                (row.gtfs_stop_lat, row.gtfs_stop_lon)
-            ).m
-        except:
-            print("Failed to calculate distance: {},{} -> {},{}".format(
-                row.siri_vehicle_location_lat, row.siri_vehicle_location_lon,
-                row.gtfs_stop_lat, row.gtfs_stop_lon
-            ))
-            traceback.print_exc()
-            distance_meters = None
-        if distance_meters is not None:
-            vehicle_location_distance[row.siri_vehicle_location_id] = distance_meters
-            if (
-                row.siri_ride_stop_id not in ride_stop_nearest_distance
-                or distance_meters < ride_stop_nearest_distance[row.siri_ride_stop_id]
-            ):
-                ride_stop_nearest_distance[row.siri_ride_stop_id] = distance_meters
-                ride_stop_nearest_vehicle_location[row.siri_ride_stop_id] = row.siri_vehicle_location_id
-    updates = [
-        'set local synchronous_commit to off;'
-    ]
-    for vehicle_location_id, distance_meters in vehicle_location_distance.items():
-        stats['updated_vehicle_locations'] += 1
-        updates.append(dedent("""
-            update siri_vehicle_location 
-            set distance_from_siri_ride_stop_meters={}
-            where id={}
-        """).format(round(distance_meters), vehicle_location_id))
-    for ride_stop_id, vehicle_location_id in ride_stop_nearest_vehicle_location.items():
-        stats['updated_ride_stops'] += 1
-        updates.append(dedent("""
+        ride_stop_ids.append(row.siri_ride_stop_id)
+        vehicle_location_ids.append(row.siri_vehicle_location_id)
+        vehicle_location_lats.append(row.siri_vehicle_location_lat)
+        vehicle_location_lons.append(row.siri_vehicle_location_lon)
+        gtfs_stop_lats.append(row.gtfs_stop_lat)
+        gtfs_stop_lons.append(row.gtfs_stop_lon)
+    if not ride_stop_ids:
+        return {}, {}
+    ride_stop_ids = np.array(ride_stop_ids, dtype=np.int64)
+    vehicle_location_ids = np.array(vehicle_location_ids, dtype=np.int64)
+    distances_meters = distances.get_distances_meters(
+        vehicle_location_lats, vehicle_location_lons, gtfs_stop_lats, gtfs_stop_lons, accuracy
+    )
+    is_valid = ~np.isnan(distances_meters)
+    if not is_valid.all():
+        print("Failed to calculate distance for {} rows".format(int((~is_valid).sum())))
+    vehicle_location_distance = dict(zip(
+        vehicle_location_ids[is_valid].tolist(), distances_meters[is_valid].tolist()
+    ))
+    nearest_ride_stop_ids, nearest_indices = distances.get_nearest_per_group(ride_stop_ids, distances_meters)
+    ride_stop_nearest_vehicle_location = dict(zip(
+        nearest_ride_stop_ids.tolist(), vehicle_location_ids[nearest_indices].tolist()
+    ))
+    return vehicle_location_distance, ride_stop_nearest_vehicle_location
+
+
+def bulk_update(session, vehicle_location_distance, ride_stop_nearest_vehicle_location, stats):
+    """writes all the results using a small number of set-based UPDATE ... FROM (VALUES ...) statements"""
+    start_time = now()
+    session.execute('set local synchronous_commit to off')
+    for chunk in iterate_chunks(vehicle_location_distance.items(), BULK_UPDATE_CHUNK_SIZE):
+        session.execute(dedent("""
+            update siri_vehicle_location
+            set distance_from_siri_ride_stop_meters = v.distance_meters
+            from (values {}) as v(id, distance_meters)
+            where siri_vehicle_location.id = v.id
+        """).format(','.join('({},{})'.format(int(vehicle_location_id), round(distance_meters))
+                             for vehicle_location_id, distance_meters in chunk)))
+        stats['updated_vehicle_locations'] += len(chunk)
+        stats['bulk_update_statements'] += 1
+    for chunk in iterate_chunks(ride_stop_nearest_vehicle_location.items(), BULK_UPDATE_CHUNK_SIZE):
+        session.execute(dedent("""
             update siri_ride_stop
-            set nearest_siri_vehicle_location_id={}
-            where id={}
-        """).format(vehicle_location_id, ride_stop_id))
-    session.execute(";\n".join(updates))
+            set nearest_siri_vehicle_location_id = v.nearest_siri_vehicle_location_id
+            from (values {}) as v(id, nearest_siri_vehicle_location_id)
+            where siri_ride_stop.id = v.id
+        """).format(','.join('({},{})'.format(int(ride_stop_id), int(vehicle_location_id))
+                             for ride_stop_id, vehicle_location_id in chunk)))
+        stats['updated_ride_stops'] += len(chunk)
+        stats['bulk_update_statements'] += 1
+    num_rows = len(vehicle_location_distance) + len(ride_stop_nearest_vehicle_location)
+    seconds = (now() - start_time).total_seconds()
+    stats['bulk_update_rows'] += num_rows
+    stats['bulk_update_seconds'] += seconds
+    print('Wrote {} rows in {:.2f}s ({:.0f} rows/sec)'.format(num_rows, seconds, num_rows / seconds if seconds else 0))
 
 
-def main(min_date, max_date, num_days):
+def get_sql_format_kwargs(date, siri_route_id):
+    return dict(
+        date=date, siri_route_id=int(siri_route_id),
+        valid_coordinates_where=SQL_VALID_COORDINATES_WHERE,
+        distance_meters=SQL_DISTANCE_METERS,
+    )
+
+
+def process_route_date_python(session, date, siri_route_id, distance_accuracy, stats):
+    vehicle_location_distance, ride_stop_nearest_vehicle_location = get_rows_distances(session.execute(
+        ROUTE_DATE_ROWS_SQL_TEMPLATE.format(siri_route_id=int(siri_route_id), date=date)
+    ), distance_accuracy)
+    bulk_update(session, vehicle_location_distance, ride_stop_nearest_vehicle_location, stats)
+
+
+def process_route_date_sql(session, date, siri_route_id, stats):
+    start_time = now()
+    format_kwargs = get_sql_format_kwargs(date, siri_route_id)
+    session.execute('set local synchronous_commit to off')
+    updated_vehicle_locations = session.execute(
+        SQL_UPDATE_VEHICLE_LOCATIONS_DISTANCE_TEMPLATE.format(**format_kwargs)
+    ).rowcount
+    updated_ride_stops = session.execute(SQL_UPDATE_RIDE_STOPS_NEAREST_VEHICLE_LOCATION_TEMPLATE.format(
+        select_nearest_sql=SQL_SELECT_RIDE_STOPS_NEAREST_VEHICLE_LOCATION_TEMPLATE.format(**format_kwargs)
+    )).rowcount
+    num_rows = updated_vehicle_locations + updated_ride_stops
+    seconds = (now() - start_time).total_seconds()
+    stats['updated_vehicle_locations'] += updated_vehicle_locations
+    stats['updated_ride_stops'] += updated_ride_stops
+    stats['bulk_update_rows'] += num_rows
+    stats['bulk_update_seconds'] += seconds
+    print('Wrote {} rows in {:.2f}s ({:.0f} rows/sec)'.format(num_rows, seconds, num_rows / seconds if seconds else 0))
+
+
+def process_route_date(session, date, siri_route_id, engine, distance_accuracy, stats):
+    if engine == ENGINE_SQL:
+        process_route_date_sql(session, date, siri_route_id, stats)
+    else:
+        process_route_date_python(session, date, siri_route_id, distance_accuracy, stats)
+
+
+def process_route_date_session(date, siri_route_id, engine, distance_accuracy, stats, checkpoint=None):
+    with db.get_session() as session:
+        process_route_date(session, date, siri_route_id, engine, distance_accuracy, stats)
+        session.commit()
+    if checkpoint:
+        checkpoint.set_completed(date, [siri_route_id])
+
+
+def main(min_date, max_date, num_days, distance_accuracy=None, engine=ENGINE_PYTHON, workers=1,
+         checkpoint=False, resume=False, incremental=False, full_sweep_hours=24):
+    """distance_accuracy defaults to geodesic for the python engine and haversine for the sql engine"""
     min_date, max_date = parse_min_max_date_strs(min_date, max_date, num_days)
+    distance_accuracy = parse_None(distance_accuracy)
+    if not distance_accuracy:
+        distance_accuracy = distances.ACCURACY_HAVERSINE if engine == ENGINE_SQL else distances.ACCURACY_GEODESIC
     print(f'min_date={min_date}')
     print(f'max_date={max_date}')
+    print(f'engine={engine}')
+    print(f'distance_accuracy={distance_accuracy}')
+    assert engine in ENGINES, f'invalid engine: {engine}'
+    assert engine != ENGINE_SQL or distance_accuracy == distances.ACCURACY_HAVERSINE, 'sql engine supports only haversine distance accuracy'
     stats = defaultdict(int)
-    for date, siri_route_ids in iterate_siri_route_id_dates(
-        extra_from_sql='siri_ride_stop',
-        where_sql=dedent("""
-            siri_ride.id = siri_ride_stop.siri_ride_id
-            and siri_ride_stop.nearest_siri_vehicle_location_id is null
-            and siri_ride_stop.gtfs_stop_id is not null
-            and siri_ride.scheduled_start_time >= '{min_date}'
-            and siri_ride.scheduled_start_time <= '{max_date}'
-        """).format(min_date=get_db_date_str(min_date), max_date=get_db_date_str(max_date))
-    ):
-        for siri_route_id in siri_route_ids:
-            with db.get_session() as session:
-                current_ride = {}
-                for row in session.execute(dedent("""
-                    select siri_ride.id siri_ride_id, 
-                        siri_ride_stop.id siri_ride_stop_id,
-                        siri_vehicle_location.id siri_vehicle_location_id,
-                        siri_vehicle_location.lon siri_vehicle_location_lon, 
-                        siri_vehicle_location.lat siri_vehicle_location_lat, 
-                        gtfs_stop.lon gtfs_stop_lon, 
-                        gtfs_stop.lat gtfs_stop_lat
-                    from siri_ride, siri_ride_stop, siri_vehicle_location, gtfs_stop
-                    where siri_ride.siri_route_id = {}
-                    and date_trunc('day', siri_ride.scheduled_start_time) = '{}'
-                    and siri_ride_stop.siri_ride_id = siri_ride.id
-                    and siri_vehicle_location.siri_ride_stop_id = siri_ride_stop.id
-                    and gtfs_stop.id = siri_ride_stop.gtfs_stop_id
-                    order by siri_ride.id, siri_vehicle_location.recorded_at_time
-                """.format(siri_route_id, date))):
-                    if current_ride.get('id') == row.siri_ride_id:
-                        current_ride['rows'].append(row)
-                    else:
-                        if current_ride.get('rows'):
-                            process_ride_rows(current_ride['rows'], session, stats)
-                        current_ride['id'] = row.siri_ride_id
-                        current_ride['rows'] = []
-                if current_ride.get('rows'):
-                    process_ride_rows(current_ride['rows'], session, stats)
-                session.commit()
-            pprint(dict(stats))
+    start_time = now()
+    watermark, full_sweep = watermarks.start_incremental_run('update-ride-stops-vehicle-locations', incremental, full_sweep_hours)
+    incremental_where_sql = watermarks.get_updated_duration_minutes_where_sql(watermark, full_sweep)
+    checkpoint = Checkpoint('update-ride-stops-vehicle-locations', min_date, max_date, resume) if checkpoint or resume else None
+    process_units(
+        iterate_siri_route_id_date_units((checkpoint.iterate_siri_route_id_dates if checkpoint else iterate_siri_route_id_dates)(
+            extra_from_sql='siri_ride_stop',
+            where_sql=dedent("""
+                siri_ride.id = siri_ride_stop.siri_ride_id
+                and siri_ride_stop.nearest_siri_vehicle_location_id is null
+                and siri_ride_stop.gtfs_stop_id is not null
+                and siri_ride.scheduled_start_time >= '{min_date}'
+                and siri_ride.scheduled_start_time <= '{max_date}'
+                {incremental_where}
+            """).format(
+                min_date=get_db_date_str(min_date), max_date=get_db_date_str(max_date),
+                incremental_where=f'and {incremental_where_sql}' if incremental_where_sql else ''
+            )
+        )),
+        lambda unit, stats_: process_route_date_session(*unit, engine, distance_accuracy, stats_, checkpoint),
+        stats, workers
+    )
+    if checkpoint:
+        checkpoint.finish()
+    watermarks.finish_incremental_run(
+        'update-ride-stops-vehicle-locations', incremental, watermark, full_sweep,
+        updated_duration_minutes=start_time.isoformat()
+    )
+    if stats['bulk_update_seconds']:
+        print('Total: wrote {} rows in {:.2f}s ({:.0f} rows/sec)'.format(
+            stats['bulk_update_rows'], stats['bulk_update_seconds'],
+            stats['bulk_update_rows'] / stats['bulk_update_seconds']
+        ))
+
@@ -1,14 +1,18 @@
 import datetime
-from pprint import pprint
 from textwrap import dedent
+from functools import partial
+from pprint import pprint
 from collections import defaultdict
 
 from open_bus_stride_db import db
 
+from . import watermarks
 from .common import iterate_siri_route_id_dates
-from ..common import parse_min_max_date_strs, get_db_date_str
+from ..common import parse_min_max_date_strs, get_db_date_str, now, process_units
 
 GTFS_ROTE_DATE_FORMAT = "%Y-%m-%d"
+# all the update statements only update rows whose value changes (is distinct from), so the rides are not rewritten
+# on each run and the update rowcounts are the number of actually changed rides (used by the if-changed views refresh)
 UPDATE_ROUTE_GTFS_RIDE_SQL_TEMPLATE = dedent("""
     update siri_ride
     set route_gtfs_ride_id = gtfs_ride.id
@@ -21,10 +25,12 @@ UPDATE_ROUTE_GTFS_RIDE_SQL_TEMPLATE = dedent("""
     and gtfs_route.date = '{date}'
     and siri_ride.scheduled_start_time > gtfs_ride.start_time - '{minutes} minutes'::interval
     and siri_ride.scheduled_start_time < gtfs_ride.start_time + '{minutes} minutes'::interval
+    and siri_ride.route_gtfs_ride_id is distinct from gtfs_ride.id
     -- if we have updated_duration_minutes it means we updated the duration of the ride
     -- so we have all the ride stops data which we must ensure before making these updates
     and siri_ride.updated_duration_minutes is not null
     {extra_where}
+    {incremental_where}
 """)
 
 UPDATE_SCHEDULED_GTFS_RIDE_SQL_TEMPLATE = dedent("""
@@ -38,17 +44,319 @@ UPDATE_SCHEDULED_GTFS_RIDE_SQL_TEMPLATE = dedent("""
     and siri_route.id = siri_ride.siri_route_id
     and gtfs_route.date between '{start_date}' and '{end_date}' 
     and siri_ride.scheduled_start_time = gtfs_ride.start_time
+    and siri_ride.scheduled_time_gtfs_ride_id is distinct from gtfs_ride.id
+    -- if we have updated_duration_minutes it means we updated the duration of the ride
+    -- so we have all the ride stops data which we must ensure before making these updates
+    and siri_ride.updated_duration_minutes is not null
+    {incremental_where}
+""")
+
+# staged mode - the gtfs rides of the date and the siri/gtfs ride candidate pairs are built once per date
+# in temporary tables and all the match strategies are resolved from them
+STAGED_CREATE_TEMP_TABLES_SQL_TEMPLATE = dedent("""
+    create temporary table staged_gtfs_ride on commit drop as
+    select gtfs_ride.id, gtfs_ride.start_time, gtfs_ride.journey_ref,
+        gtfs_route.operator_ref, gtfs_route.line_ref, gtfs_route.date
+    from gtfs_ride, gtfs_route
+    where gtfs_route.id = gtfs_ride.gtfs_route_id
+    and gtfs_route.date between '{date}' and '{next_date}';
+    create index on staged_gtfs_ride (id);
+    create index on staged_gtfs_ride (journey_ref);
+    analyze staged_gtfs_ride;
+    -- candidate pairs for the route match (up to 5 minutes difference) and the scheduled time match (exact time)
+    create temporary table staged_candidate on commit drop as
+    select siri_ride.id siri_ride_id, staged_gtfs_ride.id gtfs_ride_id, staged_gtfs_ride.date gtfs_date,
+        abs(extract(epoch from siri_ride.scheduled_start_time - staged_gtfs_ride.start_time)) diff_seconds
+    from staged_gtfs_ride, siri_route, siri_ride
+    where siri_route.operator_ref = staged_gtfs_ride.operator_ref
+    and siri_route.line_ref = staged_gtfs_ride.line_ref
+    and siri_ride.siri_route_id = siri_route.id
+    and siri_ride.scheduled_start_time > staged_gtfs_ride.start_time - '5 minutes'::interval
+    and siri_ride.scheduled_start_time < staged_gtfs_ride.start_time + '5 minutes'::interval
+    -- if we have updated_duration_minutes it means we updated the duration of the ride
+    -- so we have all the ride stops data which we must ensure before making these updates
+    and siri_ride.updated_duration_minutes is not null
+    {incremental_where};
+    create index on staged_candidate (siri_ride_id);
+    analyze staged_candidate;
+""")
+
+# converts a siri journey_ref (e.g. 2022-03-15-12345678) to a gtfs journey_ref (e.g. 12345678_150322)
+SIRI_TO_GTFS_JOURNEY_REF_SQL = "split_part(siri_ride.journey_ref, '-', 4) || '_' || split_part(siri_ride.journey_ref, '-', 3) || split_part(siri_ride.journey_ref, '-', 2) || substr(split_part(siri_ride.journey_ref, '-', 1), 3)"
+
+# the gtfs journey key is computed only for the siri rides scheduled around the date (using the scheduled_start_time index)
+# instead of for all the siri rides in each run, the siri journey_ref contains the date so rides outside this range can't match
+STAGED_CREATE_SIRI_RIDE_JOURNEY_SQL_TEMPLATE = dedent("""
+    create temporary table staged_siri_ride_journey on commit drop as
+    select siri_ride.id siri_ride_id, {siri_to_gtfs_journey_ref} gtfs_journey_ref
+    from siri_ride
+    where siri_ride.scheduled_start_time >= '{date}'::date - 1
+    and siri_ride.scheduled_start_time < '{next_date}'::date + 1
+    and siri_ride.journey_ref is not null
     -- if we have updated_duration_minutes it means we updated the duration of the ride
     -- so we have all the ride stops data which we must ensure before making these updates
     and siri_ride.updated_duration_minutes is not null
+    {incremental_where};
+    create index on staged_siri_ride_journey (gtfs_journey_ref);
+    analyze staged_siri_ride_journey;
+""")
+
+STAGED_UPDATE_JOURNEY_GTFS_RIDE_SQL_TEMPLATE = dedent("""
+    update siri_ride
+    set journey_gtfs_ride_id = staged_gtfs_ride.id
+    from staged_siri_ride_journey, staged_gtfs_ride
+    where siri_ride.id = staged_siri_ride_journey.siri_ride_id
+    and staged_gtfs_ride.journey_ref = staged_siri_ride_journey.gtfs_journey_ref
+    and staged_gtfs_ride.date = '{date}'
+    and siri_ride.journey_gtfs_ride_id is distinct from staged_gtfs_ride.id
 """)
 
-def main(min_date, max_date, num_days):
+# same as the 3 passes of UPDATE_ROUTE_GTFS_RIDE_SQL_TEMPLATE: a match within 1 minute always updates,
+# a match within 5 minutes updates only if there is no route_gtfs_ride_id yet, the nearest gtfs ride is used
+STAGED_UPDATE_ROUTE_GTFS_RIDE_SQL_TEMPLATE = dedent("""
+    update siri_ride
+    set route_gtfs_ride_id = nearest.gtfs_ride_id
+    from (
+        select distinct on (siri_ride_id) siri_ride_id, gtfs_ride_id, diff_seconds
+        from staged_candidate
+        where gtfs_date = '{date}'
+        order by siri_ride_id, diff_seconds, gtfs_ride_id
+    ) nearest
+    where siri_ride.id = nearest.siri_ride_id
+    and (nearest.diff_seconds < 60 or (siri_ride.route_gtfs_ride_id is null and nearest.diff_seconds < 300))
+    and siri_ride.route_gtfs_ride_id is distinct from nearest.gtfs_ride_id
+""")
+
+STAGED_UPDATE_GTFS_RIDE_BY_ROUTE_SQL_TEMPLATE = dedent("""
+    update siri_ride
+    set gtfs_ride_id = staged_gtfs_ride.id
+    from staged_gtfs_ride
+    where staged_gtfs_ride.id = siri_ride.route_gtfs_ride_id
+    and staged_gtfs_ride.date = '{date}'
+    and siri_ride.journey_gtfs_ride_id is null
+    and siri_ride.gtfs_ride_id is distinct from staged_gtfs_ride.id
+    {incremental_where}
+""")
+
+STAGED_UPDATE_GTFS_RIDE_BY_JOURNEY_SQL_TEMPLATE = dedent("""
+    update siri_ride
+    set gtfs_ride_id = staged_gtfs_ride.id
+    from staged_gtfs_ride
+    where staged_gtfs_ride.id = siri_ride.journey_gtfs_ride_id
+    and staged_gtfs_ride.date = '{date}'
+    and siri_ride.gtfs_ride_id is distinct from staged_gtfs_ride.id
+    {incremental_where}
+""")
+
+STAGED_UPDATE_SCHEDULED_GTFS_RIDE_SQL = dedent("""
+    update siri_ride
+    set scheduled_time_gtfs_ride_id = exact.gtfs_ride_id
+    from (
+        select distinct on (siri_ride_id) siri_ride_id, gtfs_ride_id
+        from staged_candidate
+        where diff_seconds = 0
+        order by siri_ride_id, gtfs_ride_id
+    ) exact
+    where siri_ride.id = exact.siri_ride_id
+    and siri_ride.scheduled_time_gtfs_ride_id is distinct from exact.gtfs_ride_id
+""")
+
+# staged - build the candidates once per date in temporary tables and resolve all the match strategies from them
+# per-strategy - run a separate update statement with the full joins for each match strategy (the previous behavior)
+MODE_STAGED = 'staged'
+MODE_PER_STRATEGY = 'per-strategy'
+MODES = [MODE_STAGED, MODE_PER_STRATEGY]
+
+REFRESH_VIEWS_ALWAYS = 'always'
+REFRESH_VIEWS_IF_CHANGED = 'if-changed'
+REFRESH_VIEWS_NEVER = 'never'
+REFRESH_VIEWS = [REFRESH_VIEWS_ALWAYS, REFRESH_VIEWS_IF_CHANGED, REFRESH_VIEWS_NEVER]
+
+MATERIALIZED_VIEWS = ['gtfs_rides_agg', 'gtfs_rides_agg_by_hour']
+
+# number of waves of dates processed concurrently, see iterate_dates_waves
+DATES_WAVES = 3
+
+UPDATED_STATS_KEYS = [
+    'updated_route_gtfs_ride_ids', 'updated_journey_gtfs_ride_ids',
+    'updated_gtfs_ride_ids_by_journey', 'updated_gtfs_ride_ids_by_route',
+]
+
+
+def update_date_stats(stats, updated_route_gtfs_ride_ids, updated_journey_gtfs_ride_ids,
+                      updated_gtfs_ride_ids_by_journey, updated_gtfs_ride_ids_by_route):
+    print(f"Updated route gtfs ride ids: {updated_route_gtfs_ride_ids}")
+    print(f"Updated journey gtfs ride ids: {updated_journey_gtfs_ride_ids}")
+    print(f"Updated gtfs ride ids by journey: {updated_gtfs_ride_ids_by_journey}")
+    print(f"Updated gtfs ride ids by route: {updated_gtfs_ride_ids_by_route}")
+    stats['updated_route_gtfs_ride_ids'] += updated_route_gtfs_ride_ids
+    stats['updated_journey_gtfs_ride_ids'] += updated_journey_gtfs_ride_ids
+    stats['updated_gtfs_ride_ids_by_journey'] += updated_gtfs_ride_ids_by_journey
+    stats['updated_gtfs_ride_ids_by_route'] += updated_gtfs_ride_ids_by_route
+
+
+def get_incremental_where(incremental_where_sql):
+    return f'and {incremental_where_sql}' if incremental_where_sql else ''
+
+
+def process_date_staged(date, stats, incremental_where_sql=None):
+    """in incremental mode the siri rides are limited to the updated rides also in the temporary tables and the update statements"""
+    start_time = now()
+    incremental_where = get_incremental_where(incremental_where_sql)
+    with db.get_session() as session:
+        session.execute('set local synchronous_commit to off')
+        session.execute(STAGED_CREATE_TEMP_TABLES_SQL_TEMPLATE.format(
+            date=date, next_date=get_tommorow_date(date), incremental_where=incremental_where
+        ))
+        journey_start_time = now()
+        session.execute(STAGED_CREATE_SIRI_RIDE_JOURNEY_SQL_TEMPLATE.format(
+            date=date, next_date=get_tommorow_date(date), siri_to_gtfs_journey_ref=SIRI_TO_GTFS_JOURNEY_REF_SQL,
+            incremental_where=incremental_where
+        ))
+        updated_journey_gtfs_ride_ids = session.execute(STAGED_UPDATE_JOURNEY_GTFS_RIDE_SQL_TEMPLATE.format(date=date)).rowcount
+        stats['journey_match_seconds'] += (now() - journey_start_time).total_seconds()
+        updated_route_gtfs_ride_ids = session.execute(STAGED_UPDATE_ROUTE_GTFS_RIDE_SQL_TEMPLATE.format(date=date)).rowcount
+        updated_gtfs_ride_ids_by_route = session.execute(STAGED_UPDATE_GTFS_RIDE_BY_ROUTE_SQL_TEMPLATE.format(
+            date=date, incremental_where=incremental_where
+        )).rowcount
+        updated_gtfs_ride_ids_by_journey = session.execute(STAGED_UPDATE_GTFS_RIDE_BY_JOURNEY_SQL_TEMPLATE.format(
+            date=date, incremental_where=incremental_where
+        )).rowcount
+        session.execute(STAGED_UPDATE_SCHEDULED_GTFS_RIDE_SQL)
+        session.commit()
+    update_date_stats(stats, updated_route_gtfs_ride_ids, updated_journey_gtfs_ride_ids,
+                      updated_gtfs_ride_ids_by_journey, updated_gtfs_ride_ids_by_route)
+    stats['process_date_seconds'] += (now() - start_time).total_seconds()
+
+
+def process_date_per_strategy(date, stats, incremental_where_sql=None):
+    start_time = now()
+    incremental_where = get_incremental_where(incremental_where_sql)
+    updated_journey_gtfs_ride_ids = 0
+    updated_route_gtfs_ride_ids = 0
+    updated_scheduled_gtfs_ride_ids = 0
+    updated_gtfs_ride_ids_by_route = 0
+    updated_gtfs_ride_ids_by_journey = 0
+    with db.get_session() as session:
+        journey_start_time = now()
+        res = session.execute(dedent("""
+            set local synchronous_commit to off;
+            update siri_ride
+            set journey_gtfs_ride_id = gtfs_ride.id
+            from gtfs_ride, gtfs_route
+            where gtfs_ride.journey_ref = {}
+            and gtfs_route.id = gtfs_ride.gtfs_route_id
+            and gtfs_route.date = '{}'
+            and siri_ride.journey_gtfs_ride_id is distinct from gtfs_ride.id
+            -- if we have updated_duration_minutes it means we updated the duration of the ride
+            -- so we have all the ride stops data which we must ensure before making these updates
+            and siri_ride.updated_duration_minutes is not null
+            {};
+        """).format(SIRI_TO_GTFS_JOURNEY_REF_SQL, date, incremental_where))
+        updated_journey_gtfs_ride_ids += res.rowcount
+        stats['journey_match_seconds'] += (now() - journey_start_time).total_seconds()
+        updated_route_gtfs_ride_ids += session.execute(
+            UPDATE_ROUTE_GTFS_RIDE_SQL_TEMPLATE.format(
+                date=date, minutes='1',
+                extra_where='', incremental_where=incremental_where
+            )
+        ).rowcount
+        updated_route_gtfs_ride_ids += session.execute(
+            UPDATE_ROUTE_GTFS_RIDE_SQL_TEMPLATE.format(
+                date=date, minutes='3',
+                extra_where='and siri_ride.route_gtfs_ride_id is null', incremental_where=incremental_where
+            )
+        ).rowcount
+        updated_route_gtfs_ride_ids += session.execute(
+            UPDATE_ROUTE_GTFS_RIDE_SQL_TEMPLATE.format(
+                date=date, minutes='5',
+                extra_where='and siri_ride.route_gtfs_ride_id is null', incremental_where=incremental_where
+            )
+        ).rowcount
+        updated_gtfs_ride_ids_by_route += session.execute(dedent("""
+            update siri_ride
+            set gtfs_ride_id = gtfs_ride.id
+            from gtfs_ride, gtfs_route
+            where gtfs_ride.id = siri_ride.route_gtfs_ride_id
+            and gtfs_route.id = gtfs_ride.gtfs_route_id
+            and gtfs_route.date = '{}'
+            and siri_ride.journey_gtfs_ride_id is null
+            and siri_ride.gtfs_ride_id is distinct from gtfs_ride.id
+            {}
+        """).format(date, incremental_where)).rowcount
+        updated_gtfs_ride_ids_by_journey += session.execute(dedent("""
+            update siri_ride
+            set gtfs_ride_id = gtfs_ride.id
+            from gtfs_ride, gtfs_route
+            where gtfs_ride.id = siri_ride.journey_gtfs_ride_id
+            and gtfs_route.id = gtfs_ride.gtfs_route_id
+            and gtfs_route.date = '{}'
+            and siri_ride.gtfs_ride_id is distinct from gtfs_ride.id
+            {}
+        """).format(date, incremental_where)).rowcount
+        updated_scheduled_gtfs_ride_ids += session.execute(
+            UPDATE_SCHEDULED_GTFS_RIDE_SQL_TEMPLATE.format(
+                start_date=date, end_date=get_tommorow_date(date), incremental_where=incremental_where
+            )
+        ).rowcount
+        session.commit()
+    update_date_stats(stats, updated_route_gtfs_ride_ids, updated_journey_gtfs_ride_ids,
+                      updated_gtfs_ride_ids_by_journey, updated_gtfs_ride_ids_by_route)
+    stats['process_date_seconds'] += (now() - start_time).total_seconds()
+
+
+def iterate_dates_waves(dates, workers):
+    """the unit of a date updates siri rides matched to the gtfs rides of the date and the next date,
+    so units of adjacent dates update the same siri rides and must not run concurrently.
+    with more than one worker the dates are processed in waves, the dates of a wave are at least DATES_WAVES days apart"""
+    if int(workers) <= 1:
+        yield dates
+    else:
+        dates = list(dates)
+        for wave in range(DATES_WAVES):
+            dates_wave = [date for date in dates if datetime.datetime.strptime(date, GTFS_ROTE_DATE_FORMAT).toordinal() % DATES_WAVES == wave]
+            if dates_wave:
+                print(f'Processing dates wave {wave + 1}/{DATES_WAVES}: {len(dates_wave)} dates')
+                yield dates_wave
+
+
+def is_refresh_views_required(refresh_views, stats, full_sweep):
+    """with if-changed, the views are refreshed only if the gtfs ride ids of some siri rides changed in this run
+    (the update statements skip rides whose value didn't change, so their rowcounts are the changed rides),
+    or on a full sweep so that other changes (e.g. newly loaded gtfs data) are eventually included"""
+    assert refresh_views in REFRESH_VIEWS, f'invalid refresh_views: {refresh_views}'
+    if refresh_views == REFRESH_VIEWS_ALWAYS:
+        return True
+    elif refresh_views == REFRESH_VIEWS_NEVER:
+        return False
+    else:
+        return full_sweep or sum(stats[k] for k in UPDATED_STATS_KEYS) > 0
+
+
+def refresh_materialized_views(stats):
+    for view_name in MATERIALIZED_VIEWS:
+        print(f"Refreshing {view_name} materialized view")
+        start_time = now()
+        with db.get_session() as session:
+            session.execute(f"refresh materialized view concurrently {view_name}")
+            session.commit()
+        seconds = (now() - start_time).total_seconds()
+        print(f'Refreshed {view_name} in {seconds} seconds')
+        stats[f'refresh_{view_name}_seconds'] += seconds
+
+
+def main(min_date, max_date, num_days, workers=1, incremental=False, full_sweep_hours=24, mode=MODE_STAGED,
+         refresh_views=REFRESH_VIEWS_IF_CHANGED):
     min_date, max_date = parse_min_max_date_strs(min_date, max_date, num_days)
     print(f'min_date={min_date}')
     print(f'max_date={max_date}')
+    print(f'mode={mode}')
+    assert mode in MODES, f'invalid mode: {mode}'
     stats = defaultdict(int)
-    for date, siri_route_ids in iterate_siri_route_id_dates(
+    start_time = now()
+    watermark, full_sweep = watermarks.start_incremental_run('update-rides-gtfs', incremental, full_sweep_hours)
+    incremental_where_sql = watermarks.get_updated_duration_minutes_where_sql(watermark, full_sweep)
+    dates = (date for date, _ in iterate_siri_route_id_dates(
         where_sql=dedent("""
             siri_ride.gtfs_ride_id is null
             and siri_ride.scheduled_start_time >= '{min_date}'
@@ -56,85 +364,30 @@ def main(min_date, max_date, num_days):
             -- if we have updated_duration_minutes it means we updated the duration of the ride
             -- so we have all the ride stops data which we must ensure before making these updates
             and siri_ride.updated_duration_minutes is not null
-        """).format(min_date=get_db_date_str(min_date), max_date=get_db_date_str(max_date))
-    ):
-        updated_journey_gtfs_ride_ids = 0
-        updated_route_gtfs_ride_ids = 0
-        updated_scheduled_gtfs_ride_ids = 0
-        updated_gtfs_ride_ids_by_route = 0
-        updated_gtfs_ride_ids_by_journey = 0
-        with db.get_session() as session:
-            res = session.execute(dedent("""
-                set local synchronous_commit to off;
-                update siri_ride
-                set journey_gtfs_ride_id = gtfs_ride.id
-                from gtfs_ride, gtfs_route
-                where gtfs_ride.journey_ref = split_part(siri_ride.journey_ref, '-', 4) || '_' || split_part(siri_ride.journey_ref, '-', 3) || split_part(siri_ride.journey_ref, '-', 2) || substr(split_part(siri_ride.journey_ref, '-', 1), 3)
-                and gtfs_route.id = gtfs_ride.gtfs_route_id
-                and gtfs_route.date = '{}'
-                -- if we have updated_duration_minutes it means we updated the duration of the ride
-                -- so we have all the ride stops data which we must ensure before making these updates
-                and siri_ride.updated_duration_minutes is not null;
-            """).format(date))
-            updated_journey_gtfs_ride_ids += res.rowcount
-            updated_route_gtfs_ride_ids += session.execute(
-                UPDATE_ROUTE_GTFS_RIDE_SQL_TEMPLATE.format(
-                    date=date, minutes='1',
-                    extra_where=''
-                )
-            ).rowcount
-            updated_route_gtfs_ride_ids += session.execute(
-                UPDATE_ROUTE_GTFS_RIDE_SQL_TEMPLATE.format(
-                    date=date, minutes='3',
-                    extra_where='and siri_ride.route_gtfs_ride_id is null'
-                )
-            ).rowcount
-            updated_route_gtfs_ride_ids += session.execute(
-                UPDATE_ROUTE_GTFS_RIDE_SQL_TEMPLATE.format(
-                    date=date, minutes='5',
-                    extra_where='and siri_ride.route_gtfs_ride_id is null'
-                )
-            ).rowcount
-            updated_gtfs_ride_ids_by_route += session.execute(dedent("""
-                update siri_ride
-                set gtfs_ride_id = gtfs_ride.id
-                from gtfs_ride, gtfs_route
-                where gtfs_ride.id = siri_ride.route_gtfs_ride_id
-                and gtfs_route.id = gtfs_ride.gtfs_route_id
-                and gtfs_route.date = '{}'
-                and siri_ride.journey_gtfs_ride_id is null
-            """).format(date)).rowcount
-            updated_gtfs_ride_ids_by_journey += session.execute(dedent("""
-                update siri_ride
-                set gtfs_ride_id = gtfs_ride.id
-                from gtfs_ride, gtfs_route
-                where gtfs_ride.id = siri_ride.journey_gtfs_ride_id
-                and gtfs_route.id = gtfs_ride.gtfs_route_id
-                and gtfs_route.date = '{}'
-            """).format(date)).rowcount
-            updated_scheduled_gtfs_ride_ids += session.execute(
-                UPDATE_SCHEDULED_GTFS_RIDE_SQL_TEMPLATE.format(
-                    start_date=date, end_date=get_tommorow_date(date),
-                )
-            ).rowcount
-            session.commit()
-        print(f"Updated route gtfs ride ids: {updated_route_gtfs_ride_ids}")
-        print(f"Updated journey gtfs ride ids: {updated_journey_gtfs_ride_ids}")
-        print(f"Updated gtfs ride ids by journey: {updated_gtfs_ride_ids_by_journey}")
-        print(f"Updated gtfs ride ids by route: {updated_gtfs_ride_ids_by_route}")
-        stats['updated_route_gtfs_ride_ids'] += updated_route_gtfs_ride_ids
-        stats['updated_journey_gtfs_ride_ids'] += updated_journey_gtfs_ride_ids
-        stats['updated_gtfs_ride_ids_by_journey'] += updated_gtfs_ride_ids_by_journey
-        stats['updated_gtfs_ride_ids_by_route'] += updated_gtfs_ride_ids_by_route
-        pprint(dict(stats))
-    print("Refreshing gtfs_rides_agg materialized view")
-    with db.get_session() as session:
-        session.execute("refresh materialized view concurrently gtfs_rides_agg")
-        session.commit()
-    print("Refreshing gtfs_rides_agg_by_hour materialized view")
-    with db.get_session() as session:
-        session.execute("refresh materialized view concurrently gtfs_rides_agg_by_hour")
-        session.commit()
+            {incremental_where}
+        """).format(
+            min_date=get_db_date_str(min_date), max_date=get_db_date_str(max_date),
+            incremental_where=get_incremental_where(incremental_where_sql)
+        ),
+        chunk_size=None
+    ))
+    for dates_wave in iterate_dates_waves(dates, workers):
+        process_units(
+            dates_wave,
+            partial(process_date_staged if mode == MODE_STAGED else process_date_per_strategy, incremental_where_sql=incremental_where_sql),
+            stats, workers
+        )
+    if is_refresh_views_required(refresh_views, stats, full_sweep):
+        refresh_materialized_views(stats)
+    else:
+        print(f'Skipping materialized views refresh (refresh_views={refresh_views})')
+        stats['skipped_refresh_views'] += 1
+    pprint(dict(stats))
+    watermarks.finish_incremental_run(
+        'update-rides-gtfs', incremental, watermark, full_sweep,
+        updated_duration_minutes=start_time.isoformat()
+    )
+
 
 def get_tommorow_date(date: str) -> str:
     date = datetime.datetime.strptime(date, GTFS_ROTE_DATE_FORMAT)
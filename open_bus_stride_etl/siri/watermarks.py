@@ -0,0 +1,94 @@
+import os
+import json
+import datetime
+import tempfile
+
+from .. import config
+from ..common import now
+
+
+# watermarks are local files, OPEN_BUS_SIRI_STORAGE_ROOTPATH must be a persistent volume which is shared by all the runs,
+# otherwise each run starts without a watermark and runs a full sweep
+WATERMARKS_ROOTPATH = os.path.join(config.OPEN_BUS_SIRI_ETL_ROOTPATH, 'watermarks')
+
+# rides get their updated_duration_minutes timestamp before the add_ride_durations batch is committed,
+# so incremental runs also look at rides updated a bit before the previous run started
+UPDATED_DURATION_MINUTES_OVERLAP = datetime.timedelta(hours=1)
+
+
+def get_filename(task_name):
+    return os.path.join(WATERMARKS_ROOTPATH, f'{task_name}.json')
+
+
+def get_watermark(task_name):
+    filename = get_filename(task_name)
+    if os.path.exists(filename):
+        with open(filename) as f:
+            return json.load(f)
+    else:
+        return {}
+
+
+def set_watermark(task_name, watermark):
+    """the watermark is written to a unique temporary file which atomically replaces the watermark file,
+    so concurrent runs never read a partially written watermark or overwrite each other's temporary file"""
+    filename = get_filename(task_name)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(filename), prefix=f'{task_name}.', suffix='.tmp', delete=False) as f:
+        json.dump(watermark, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f.name, filename)
+
+
+def get_max_watermark_value(value, other_value):
+    """watermark values are ints (ids) or isoformat datetime strings"""
+    if value is None or other_value is None:
+        return other_value if value is None else value
+    elif isinstance(value, str):
+        return max(value, other_value, key=datetime.datetime.fromisoformat)
+    else:
+        return max(value, other_value)
+
+
+def is_full_sweep(watermark, full_sweep_hours):
+    """a full sweep runs if there is no watermark or if the last full sweep is older than full_sweep_hours"""
+    last_full_sweep = watermark.get('last_full_sweep')
+    return not last_full_sweep or datetime.datetime.fromisoformat(last_full_sweep) < now() - datetime.timedelta(hours=int(full_sweep_hours))
+
+
+def start_incremental_run(task_name, incremental, full_sweep_hours):
+    """returns a tuple of (watermark, is_full_sweep) for the current run, if incremental is False - always a full sweep"""
+    watermark = get_watermark(task_name) if incremental else {}
+    full_sweep = not incremental or is_full_sweep(watermark, full_sweep_hours)
+    if incremental:
+        if not watermark:
+            print(f'No watermark found at {get_filename(task_name)}, if this happens on every run, '
+                  f'OPEN_BUS_SIRI_STORAGE_ROOTPATH is probably not on a persistent volume')
+        print(f'incremental run: watermark={watermark} full_sweep={full_sweep}')
+    return watermark, full_sweep
+
+
+def finish_incremental_run(task_name, incremental, watermark, full_sweep, **values):
+    """should be called only after a successful run to store the new watermark values.
+    another run of the task may have stored a newer watermark since this run started (e.g. overlapping runs),
+    so the stored values only move forward, a lost update between concurrent runs only causes some extra work"""
+    if incremental:
+        watermark = {**watermark, **values}
+        if full_sweep:
+            watermark['last_full_sweep'] = now().isoformat()
+        stored_watermark = get_watermark(task_name)
+        watermark = {
+            key: get_max_watermark_value(stored_watermark.get(key), watermark.get(key))
+            for key in {**stored_watermark, **watermark}
+        }
+        print(f'new watermark: {watermark}')
+        set_watermark(task_name, watermark)
+
+
+def get_updated_duration_minutes_where_sql(watermark, full_sweep):
+    """returns an sql condition to limit siri rides to those which got updated_duration_minutes since the last run"""
+    if full_sweep or not watermark.get('updated_duration_minutes'):
+        return None
+    min_updated_duration_minutes = datetime.datetime.fromisoformat(watermark['updated_duration_minutes']) - UPDATED_DURATION_MINUTES_OVERLAP
+    return f"siri_ride.updated_duration_minutes > '{min_updated_duration_minutes.isoformat()}'"
@@ -0,0 +1,71 @@
+import pytest
+
+pytest.importorskip('open_bus_stride_db')
+
+from open_bus_stride_etl.siri import checkpoints
+
+
+DATE_SIRI_ROUTE_IDS = [('2023-01-01', [1, 2, 3]), ('2023-01-02', [1, 4])]
+
+
+@pytest.fixture
+def checkpoint_units(monkeypatch, tmp_path):
+    """patches the DB queries with DATE_SIRI_ROUTE_IDS, returns the after_date_route_id of each iteration"""
+    after_date_route_ids = []
+
+    def iterate_siri_route_id_dates(after_date_route_id=None, **kwargs):
+        after_date_route_ids.append(after_date_route_id)
+        for date, siri_route_ids in DATE_SIRI_ROUTE_IDS:
+            siri_route_ids = [siri_route_id for siri_route_id in siri_route_ids
+                              if not after_date_route_id or (date, siri_route_id) > after_date_route_id]
+            if siri_route_ids:
+                yield date, siri_route_ids
+
+    monkeypatch.setattr(checkpoints, 'CHECKPOINTS_ROOTPATH', str(tmp_path))
+    monkeypatch.setattr(checkpoints, 'iterate_siri_route_id_dates', iterate_siri_route_id_dates)
+    monkeypatch.setattr(checkpoints, 'count_siri_route_id_dates', lambda **kwargs: 5)
+    return after_date_route_ids
+
+
+def test_checkpoint_watermark(checkpoint_units):
+    checkpoint = checkpoints.Checkpoint('task', '2023-01-01', '2023-01-02')
+    assert list(checkpoint.iterate_siri_route_id_dates()) == DATE_SIRI_ROUTE_IDS
+    assert checkpoint.total_units == 5
+    # completed out of order - the watermark stays before the first unit which was not completed
+    checkpoint.set_completed('2023-01-01', [1, 3])
+    assert checkpoint.watermark == ('2023-01-01', 1)
+    assert checkpoint.completed == {('2023-01-01', 3)}
+    checkpoint.set_completed('2023-01-01', [2])
+    assert checkpoint.watermark == ('2023-01-01', 3)
+    assert checkpoint.completed == set()
+    assert checkpoint.num_completed == 3
+
+
+def test_checkpoint_resume(checkpoint_units):
+    checkpoint = checkpoints.Checkpoint('task', '2023-01-01', '2023-01-02')
+    list(checkpoint.iterate_siri_route_id_dates())
+    checkpoint.set_completed('2023-01-01', [1])
+    checkpoint.set_completed('2023-01-02', [1])
+    resumed_checkpoint = checkpoints.Checkpoint('task', '2023-01-01', '2023-01-02', resume=True)
+    assert resumed_checkpoint.num_completed == 2
+    assert resumed_checkpoint.total_units == 5
+    assert list(resumed_checkpoint.iterate_siri_route_id_dates()) == [('2023-01-01', [2, 3]), ('2023-01-02', [4])]
+    assert checkpoint_units[-1] == ('2023-01-01', 1)
+
+
+def test_checkpoint_not_resumed(checkpoint_units):
+    checkpoint = checkpoints.Checkpoint('task', '2023-01-01', '2023-01-02')
+    list(checkpoint.iterate_siri_route_id_dates())
+    checkpoint.set_completed('2023-01-01', [1])
+    new_checkpoint = checkpoints.Checkpoint('task', '2023-01-01', '2023-01-02')
+    assert new_checkpoint.watermark is None
+    assert list(new_checkpoint.iterate_siri_route_id_dates()) == DATE_SIRI_ROUTE_IDS
+
+
+def test_checkpoint_finish(checkpoint_units, tmp_path):
+    checkpoint = checkpoints.Checkpoint('task', '2023-01-01', '2023-01-02')
+    list(checkpoint.iterate_siri_route_id_dates())
+    checkpoint.set_completed('2023-01-01', [1])
+    assert (tmp_path / 'task' / '2023-01-01_2023-01-02.json').exists()
+    checkpoint.finish()
+    assert not (tmp_path / 'task' / '2023-01-01_2023-01-02.json').exists()
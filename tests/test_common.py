@@ -0,0 +1,67 @@
+import threading
+from collections import defaultdict
+
+from open_bus_stride_etl import common
+
+
+def test_iterate_chunks():
+    assert list(common.iterate_chunks(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(common.iterate_chunks(range(6), 3)) == [[0, 1, 2], [3, 4, 5]]
+    assert list(common.iterate_chunks([], 3)) == []
+
+
+def _process_unit(unit, stats):
+    stats['units'] += 1
+    stats['sum'] += unit
+    stats[f'thread_{threading.get_ident()}'] += 1
+
+
+def _get_stats(units, workers):
+    stats = defaultdict(int)
+    common.process_units(units, _process_unit, stats, workers)
+    return stats
+
+
+def test_process_units_single_worker():
+    stats = _get_stats(range(10), 1)
+    assert stats['units'] == 10
+    assert stats['sum'] == 45
+    assert len([k for k in stats if k.startswith('thread_')]) == 1
+
+
+def test_process_units_merges_workers_stats():
+    stats = _get_stats(range(100), 4)
+    assert stats['units'] == 100
+    assert stats['sum'] == 4950
+    assert sum(v for k, v in stats.items() if k.startswith('thread_')) == 100
+
+
+def test_process_units_bounded_queue():
+    consumed, max_queued = [], []
+    lock = threading.Lock()
+    processed = [0]
+
+    def iterate_units():
+        for unit in range(50):
+            consumed.append(unit)
+            with lock:
+                max_queued.append(len(consumed) - processed[0])
+            yield unit
+
+    def process_unit(unit, stats):
+        with lock:
+            processed[0] += 1
+        stats['units'] += 1
+
+    stats = defaultdict(int)
+    common.process_units(iterate_units(), process_unit, stats, 2)
+    assert stats['units'] == 50
+    # at most workers * 2 units are queued, plus the one which was just consumed
+    assert max(max_queued) <= 2 * 2 + 1
+
+
+def test_process_units_max_workers(capsys):
+    stats = defaultdict(int)
+    common.process_units(range(3), _process_unit, stats, common.MAX_WORKERS + 1)
+    assert stats['units'] == 3
+    assert f'Limiting workers from {common.MAX_WORKERS + 1} to {common.MAX_WORKERS}' in capsys.readouterr().out
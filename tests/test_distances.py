@@ -0,0 +1,65 @@
+import numpy as np
+from geopy.distance import distance, great_circle
+
+from open_bus_stride_etl.siri import distances
+
+
+# (lat1, lon1, lat2, lon2) - Tel Aviv -> Jerusalem, a short distance near a stop, and same point
+POINTS = [
+    (32.0853, 34.7818, 31.7683, 35.2137),
+    (32.0853, 34.7818, 32.0855, 34.7820),
+    (31.5, 35.0, 31.5, 35.0),
+]
+
+
+def test_haversine_meters():
+    lats1, lons1, lats2, lons2 = zip(*POINTS)
+    res = distances.haversine_meters(lats1, lons1, lats2, lons2)
+    for (lat1, lon1, lat2, lon2), meters in zip(POINTS, res):
+        # geopy great_circle uses a different formula with the same earth radius
+        assert abs(meters - great_circle((lat1, lon1), (lat2, lon2)).m) < 0.01
+    assert res[2] == 0
+
+
+def test_get_distances_meters_accuracies():
+    lats1, lons1, lats2, lons2 = zip(*POINTS)
+    geodesic = distances.get_distances_meters(lats1, lons1, lats2, lons2, distances.ACCURACY_GEODESIC)
+    haversine = distances.get_distances_meters(lats1, lons1, lats2, lons2, distances.ACCURACY_HAVERSINE)
+    for (lat1, lon1, lat2, lon2), meters in zip(POINTS, geodesic):
+        assert abs(meters - distance((lat1, lon1), (lat2, lon2)).m) < 1e-6
+    # haversine differs from geodesic by up to ~0.5%
+    assert np.all(np.abs(haversine - geodesic) <= geodesic * 0.005)
+    assert haversine[0] != geodesic[0]
+
+
+def test_get_distances_meters_invalid():
+    for accuracy in distances.ACCURACIES:
+        res = distances.get_distances_meters([32, 91, 32], [34.8, 34.8, 34.8], [32, 32, -91], [34.8, 34.8, 34.8], accuracy)
+        assert res[0] == 0
+        assert np.isnan(res[1]) and np.isnan(res[2])
+
+
+def test_get_nearest_per_group():
+    group_ids = [1, 1, 1, 2, 2, 3, 4, 4]
+    group_distances = [5.0, 2.0, 2.0, np.nan, 7.0, np.nan, 3.0, 1.0]
+    nearest_group_ids, nearest_indices = distances.get_nearest_per_group(group_ids, group_distances)
+    # ties are resolved by the first index, nan distances are ignored and groups without valid distances are omitted
+    assert nearest_group_ids.tolist() == [1, 2, 4]
+    assert nearest_indices.tolist() == [1, 4, 7]
+
+
+def test_get_nearest_per_group_empty():
+    nearest_group_ids, nearest_indices = distances.get_nearest_per_group([1, 2], [np.nan, np.nan])
+    assert nearest_group_ids.tolist() == [] and nearest_indices.tolist() == []
+
+
+def test_get_nearest_per_group_same_as_per_row():
+    group_ids = [i // 5 for i in range(50)]
+    lats1 = [32 + (i % 7) * 0.001 for i in range(50)]
+    lons1 = [34.8 + (i % 3) * 0.001 for i in range(50)]
+    lats2, lons2 = [32.002] * 50, [34.801] * 50
+    _, geopy_nearest = distances.geopy_get_nearest_per_group(group_ids, lats1, lons1, lats2, lons2)
+    nearest_group_ids, nearest_indices = distances.get_nearest_per_group(
+        group_ids, distances.get_distances_meters(lats1, lons1, lats2, lons2, distances.ACCURACY_GEODESIC)
+    )
+    assert dict(zip(nearest_group_ids.tolist(), nearest_indices.tolist())) == geopy_nearest
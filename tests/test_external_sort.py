@@ -0,0 +1,60 @@
+import random
+
+from open_bus_stride_etl.packagers import external_sort
+
+
+def get_records(num_records, seed=1):
+    rnd = random.Random(seed)
+    return [
+        (f'{rnd.randint(0, 10000):05d}_{i}', rnd.choice([None, '', 'שלום', str(rnd.random())]), str(i))
+        for i in range(num_records)
+    ]
+
+
+def test_encode_decode_record():
+    record = ('key', None, '', 'שלום')
+    encoded = external_sort.encode_record(record)
+    assert external_sort.RECORD_LENGTH.unpack(encoded[:external_sort.RECORD_LENGTH.size])[0] == len(encoded) - external_sort.RECORD_LENGTH.size
+    assert external_sort.decode_record(encoded[external_sort.RECORD_LENGTH.size:]) == record
+
+
+def test_external_sorter_in_memory(tmp_path):
+    records = get_records(1000)
+    sorter = external_sort.ExternalSorter(str(tmp_path))
+    for record in records:
+        sorter.add(record)
+    assert list(sorter.iterate()) == sorted(records, key=lambda record: record[0])
+    assert sorter.run_filenames == []
+
+
+def test_external_sorter_runs(tmp_path):
+    records = get_records(1000)
+    sorter = external_sort.ExternalSorter(str(tmp_path), run_size=64)
+    for record in records:
+        sorter.add(record)
+    assert sorter.num_records == 1000
+    assert list(sorter.iterate()) == sorted(records, key=lambda record: record[0])
+    assert len(sorter.run_filenames) == 16
+    assert sorter.get_disk_usage_bytes() > 0
+
+
+def test_iterate_key_ranges():
+    records = [(key,) for key in ['a', 'b1', 'b2', 'c', 'd1', 'e', 'f1', 'f2', 'g']]
+    ranges = [('b', 'c'), ('d', 'e'), ('e', 'f'), ('f', 'g')]
+    assert [
+        (key_range, [record[0] for record in range_records])
+        for key_range, range_records in external_sort.iterate_key_ranges(records, ranges)
+    ] == [
+        (('b', 'c'), ['b1', 'b2']),
+        (('d', 'e'), ['d1']),
+        (('e', 'f'), ['e']),
+        (('f', 'g'), ['f1', 'f2']),
+    ]
+
+
+def test_iterate_key_ranges_unconsumed():
+    records = [(key,) for key in ['a1', 'a2', 'b1', 'b2']]
+    key_ranges_records = []
+    for key_range, range_records in external_sort.iterate_key_ranges(records, [('a', 'b'), ('b', 'c')]):
+        key_ranges_records.append((key_range, next(range_records)[0]))
+    assert key_ranges_records == [(('a', 'b'), 'a1'), (('b', 'c'), 'b1')]
@@ -0,0 +1,83 @@
+import datetime
+
+from open_bus_stride_etl.packagers import legacy_planner
+
+
+def get_hour(i):
+    return datetime.datetime(2020, 6, 1) + datetime.timedelta(hours=i)
+
+
+def get_hour_keys(keys_hours):
+    hour_keys = {}
+    for key, hours in keys_hours.items():
+        for hour in hours:
+            hour_keys.setdefault(get_hour(hour), set()).add(key)
+    return hour_keys
+
+
+def test_union_find():
+    union_find = legacy_planner.UnionFind()
+    union_find.union('a', 'b')
+    union_find.union('c', 'd')
+    union_find.union('b', 'd')
+    union_find.find('e')
+    assert union_find.find('a') == union_find.find('d')
+    assert union_find.find('e') != union_find.find('a')
+    assert sorted(sorted(group) for group in union_find.iterate_groups()) == [['a', 'b', 'c', 'd'], ['e']]
+
+
+def test_get_components():
+    hour_keys = get_hour_keys({
+        'k1': [0, 1], 'k2': [1, 2], 'k3': [5], 'k4': [5, 6], 'k5': [9],
+    })
+    assert legacy_planner.get_components(hour_keys) == [
+        ({get_hour(0), get_hour(1), get_hour(2)}, {'k1', 'k2'}),
+        ({get_hour(5), get_hour(6)}, {'k3', 'k4'}),
+        ({get_hour(9)}, {'k5'}),
+    ]
+
+
+def assert_valid_plan(batches, hour_keys):
+    planned_hours = [hour for batch in batches for hour in batch.hours]
+    # each hour is created by exactly one batch
+    assert sorted(planned_hours) == sorted(hour_keys)
+    for batch in batches:
+        for hour in batch.hours:
+            # each batch loads all the keys which have rows in its hours
+            assert hour_keys[hour] <= batch.keys
+
+
+def test_plan_batches_merges_small_components():
+    hour_keys = get_hour_keys({'k1': [0, 1], 'k2': [1, 2], 'k3': [5], 'k4': [5, 6], 'k5': [9]})
+    keys_num_rows = {'k1': 10, 'k2': 10, 'k3': 10, 'k4': 10, 'k5': 10}
+    batches = legacy_planner.plan_batches(hour_keys, keys_num_rows, 40)
+    assert_valid_plan(batches, hour_keys)
+    assert [(len(batch.hours), batch.estimated_rows) for batch in batches] == [(5, 40), (1, 10)]
+
+
+def test_plan_batches_splits_large_components():
+    keys_hours = {f'k{i}': [i, i + 1] for i in range(10)}
+    hour_keys = get_hour_keys(keys_hours)
+    keys_num_rows = {key: 10 for key in keys_hours}
+    batches = legacy_planner.plan_batches(hour_keys, keys_num_rows, 30)
+    assert_valid_plan(batches, hour_keys)
+    assert len(batches) > 1
+    assert all(batch.estimated_rows <= 30 for batch in batches)
+    # keys on the split boundaries are loaded by both batches
+    assert sum(len(batch.keys) for batch in batches) > len(keys_hours)
+
+
+def test_plan_batches_single_hour_over_max_rows():
+    hour_keys = get_hour_keys({'k1': [0], 'k2': [0], 'k3': [1]})
+    keys_num_rows = {'k1': 100, 'k2': 100, 'k3': 100}
+    batches = legacy_planner.plan_batches(hour_keys, keys_num_rows, 50)
+    assert_valid_plan(batches, hour_keys)
+    assert [batch.estimated_rows for batch in batches] == [200, 100]
+
+
+def test_plan_batches_stable_ids():
+    hour_keys = get_hour_keys({'k1': [0, 1], 'k2': [1, 2], 'k3': [5]})
+    keys_num_rows = {'k1': 10, 'k2': 10, 'k3': 10}
+    batch_ids = [batch.batch_id for batch in legacy_planner.plan_batches(hour_keys, keys_num_rows, 20)]
+    assert batch_ids == [batch.batch_id for batch in legacy_planner.plan_batches(dict(reversed(list(hour_keys.items()))), keys_num_rows, 20)]
+    assert batch_ids == ['2020060100-2020060102-3', '2020060105-2020060105-1']
@@ -0,0 +1,61 @@
+import threading
+from collections import defaultdict
+
+import pytest
+
+from open_bus_stride_etl.packagers import common
+
+
+@pytest.fixture
+def s3_env(monkeypatch):
+    monkeypatch.setenv('WASABI_ACCESS_KEY_ID', 'test')
+    monkeypatch.setenv('WASABI_SECRET_ACCESS_KEY', 'test')
+    monkeypatch.setattr(common, '_thread_local', threading.local())
+
+
+def test_get_s3_per_thread(s3_env):
+    s3 = common.get_s3()
+    assert common.get_s3() is s3
+    thread_clients = []
+    threads = [threading.Thread(target=lambda: thread_clients.append(common.get_s3())) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(client) for client in [s3, *thread_clients]}) == 3
+
+
+class FakeSession:
+
+    def client(self, *args, **kwargs):
+        return FakeS3()
+
+
+class FakeS3:
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+
+    def _check_thread(self):
+        assert threading.current_thread() is self.thread
+
+    def head_object(self, Bucket, Key):
+        self._check_thread()
+        return {'ContentLength': 10}
+
+    def download_file(self, bucket_name, key, filename):
+        self._check_thread()
+        with open(filename, 'w') as f:
+            f.write(key)
+
+
+def test_iterate_prefetched_legacy_files_thread_clients(s3_env, monkeypatch, tmp_path):
+    monkeypatch.setattr(common.boto3.session, 'Session', FakeSession)
+    stats = defaultdict(int)
+    keys = [(i, f'key{i}') for i in range(6)]
+    res = []
+    for key_id, key, filename, downloaded in common.iterate_prefetched_legacy_files('bucket', keys, str(tmp_path), stats, workers=2, retries=1):
+        with open(filename) as f:
+            res.append((key_id, f.read(), downloaded))
+    assert res == [(i, f'key{i}', True) for i in range(6)]
+    assert stats['legacy_keys'] == 6
@@ -0,0 +1,110 @@
+import os
+import gzip
+import json
+import datetime
+
+import pytest
+import pytz
+
+pytest.importorskip('open_bus_stride_db')
+
+from open_bus_stride_etl.packagers import siri
+
+
+def iterate_datetimes(start_datetime, num_hours, minutes=17):
+    dt = start_datetime
+    while dt < start_datetime + datetime.timedelta(hours=num_hours):
+        yield dt
+        dt += datetime.timedelta(minutes=minutes, seconds=13, microseconds=1001)
+
+
+@pytest.mark.parametrize('start_datetime', [
+    # Israel DST start and end in 2023 (UTC)
+    datetime.datetime(2023, 3, 23, 12),
+    datetime.datetime(2023, 10, 28, 12),
+])
+def test_israel_datetime_formatter(start_datetime):
+    formatter = siri.IsraelDatetimeFormatter()
+    for dt in iterate_datetimes(start_datetime, 24):
+        expected = siri.get_row({'value': dt})['value']
+        assert formatter(dt) == expected
+        assert formatter(dt.replace(tzinfo=pytz.UTC)) == expected
+    assert formatter(None) == ''
+
+
+def read_package(path):
+    with open(os.path.join(path, 'res_1.csv'), encoding='utf-8') as f:
+        csv_content = f.read()
+    with open(os.path.join(path, 'datapackage.json')) as f:
+        return csv_content, siri.get_package_resource_hash(json.load(f))
+
+
+def test_typed_and_dataflows_engines_write_identical_packages(tmp_path):
+    field_names, rows = siri.get_benchmark_rows(3000)
+    siri.DF.Flow(
+        (siri.get_row(dict(zip(field_names, row))) for row in rows),
+        siri.DF.dump_to_path(str(tmp_path / siri.ENGINE_DATAFLOWS)),
+    ).process()
+    formatters = siri.get_field_formatters(field_names)
+    num_rows = siri.write_package(str(tmp_path / siri.ENGINE_TYPED), field_names, (
+        siri.format_rows(formatters, rows[i:i + 1000]) for i in range(0, len(rows), 1000)
+    ))
+    assert num_rows == 3000
+    dataflows_csv, dataflows_hash = read_package(str(tmp_path / siri.ENGINE_DATAFLOWS))
+    typed_csv, typed_hash = read_package(str(tmp_path / siri.ENGINE_TYPED))
+    assert typed_csv == dataflows_csv
+    assert typed_hash == dataflows_hash
+
+
+@pytest.mark.parametrize('row', [
+    {'date': '2023-03-24', 'time_recorded': '01:59:59'},
+    {'date': '2023-03-24', 'time_recorded': '03:00:00'},
+    {'date': '2023-10-29', 'time_recorded': '01:30:00'},
+    {'date': '2023-10-29', 'time_recorded': '03:30:00'},
+    {'date_recorded': '2020-06-16', 'date': '2020-06-15', 'time_recorded': '23:59:59'},
+    {'date': '2020-06-16', 'time_recorded': '9:05:00'},
+    {'date': '2020-06-16', 'time_recorded': '09:05'},
+    {'date': '2020-06-16', 'time_recorded': '24:00:00'},
+    {'date': '2020-06-16', 'time_recorded': '12:60:00'},
+    {'date': '2020-13-16', 'time_recorded': '12:00:00'},
+    {'date': '2020-06-16', 'time_recorded': ''},
+    {'date': '', 'time_recorded': '12:00:00'},
+])
+def test_legacy_datetime_decoder(row):
+    decoder = siri.LegacyDatetimeDecoder()
+    args = (row, ['date_recorded', 'date'], ['time_recorded'])
+    try:
+        expected = siri.legacy_get_datetime_field(*args)
+    except Exception as e:
+        with pytest.raises(type(e)):
+            decoder(*args)
+    else:
+        assert decoder(*args) == expected
+        # second call uses the cached offset
+        assert decoder(*args) == expected
+
+
+def get_processed_rows(filename, decoder):
+    return list(siri.legacy_iterate_file_processed_rows(filename, '1', filename, decoder))
+
+
+def test_legacy_decoders_generated_file(tmp_path):
+    filename = str(tmp_path / 'legacy.csv.gz')
+    siri.write_legacy_benchmark_file(filename, 3000)
+    fast_rows = get_processed_rows(filename, siri.LEGACY_DECODER_FAST)
+    assert len(fast_rows) > 2900
+    assert fast_rows == get_processed_rows(filename, siri.LEGACY_DECODER_DATAFLOWS)
+
+
+def test_legacy_decoders_stripped_and_short_rows(tmp_path):
+    filename = str(tmp_path / 'legacy.csv.gz')
+    with gzip.open(filename, 'wt', encoding='utf-8', newline='') as f:
+        f.write(','.join(f' {field_name} ' for field_name in siri.LEGACY_BENCHMARK_FIELD_NAMES) + '\r\n')
+        f.write(' 2020-06-16 ,2020-06-16, 10:00:00 ,5,1234,12, 555 ,2020-06-16,09:30:00,7654321,2020-06-16,11:00:00,34.8,32.1, 12345 ,2\r\n')
+        f.write('2020-06-16,2020-06-16,10:00:01,5,1234,12,,2020-06-16,09:30:00,7654321,2020-06-16,11:00:00,34.8,32.1\r\n')
+    fast_rows = get_processed_rows(filename, siri.LEGACY_DECODER_FAST)
+    assert len(fast_rows) == 2
+    assert fast_rows[0]['siri_journey_ref'] == '2020-06-16-555'
+    assert fast_rows[0]['siri_stop_code'] == '12345'
+    assert fast_rows[1]['siri_stop_code'] == ''
+    assert fast_rows == get_processed_rows(filename, siri.LEGACY_DECODER_DATAFLOWS)
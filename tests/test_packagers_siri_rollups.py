@@ -0,0 +1,54 @@
+import io
+import json
+import hashlib
+import zipfile
+import datetime
+
+import pytest
+
+pytest.importorskip('open_bus_stride_db')
+
+from open_bus_stride_etl.packagers import siri_rollups
+
+
+def write_package(zip_filename, base_filename, csv_data):
+    with zipfile.ZipFile(zip_filename, 'w') as zf:
+        zf.writestr(f'{base_filename}-metadata.json', json.dumps({
+            'count_of_rows': csv_data.count(b'\n') - 1,
+            'resources': [{'hash': hashlib.md5(csv_data).hexdigest()}],
+        }))
+        zf.writestr(f'{base_filename}.csv', csv_data)
+
+
+def test_append_package(tmp_path):
+    write_package(tmp_path / 'a.zip', '2023-01-15.08', b'id,lat\n1,32.1\n')
+    write_package(tmp_path / 'b.zip', '2023-01-15.09', b'id,lat\n2,32.2\n3,32.3\n')
+    output_file = io.BytesIO()
+    header, num_rows = siri_rollups.append_package(output_file, tmp_path / 'a.zip', '2023-01-15.08', None)
+    assert (header, num_rows) == (b'id,lat\n', 1)
+    header, num_rows = siri_rollups.append_package(output_file, tmp_path / 'b.zip', '2023-01-15.09', header)
+    assert (header, num_rows) == (b'id,lat\n', 2)
+    assert output_file.getvalue() == b'id,lat\n1,32.1\n2,32.2\n3,32.3\n'
+
+
+def test_append_package_header_mismatch(tmp_path):
+    write_package(tmp_path / 'a.zip', '2023-01-15.08', b'id,lon\n1,34.8\n')
+    output_file = io.BytesIO()
+    with pytest.raises(siri_rollups.PackageHeaderMismatch):
+        siri_rollups.append_package(output_file, tmp_path / 'a.zip', '2023-01-15.08', b'id,lat\n')
+    assert output_file.getvalue() == b''
+
+
+@pytest.mark.parametrize('rollup_type, period_date, partial', [
+    (siri_rollups.ROLLUP_TYPE_DAILY, datetime.date(2023, 1, 14), False),
+    (siri_rollups.ROLLUP_TYPE_DAILY, datetime.date(2023, 1, 15), True),
+    (siri_rollups.ROLLUP_TYPE_MONTHLY, datetime.date(2022, 12, 1), False),
+    (siri_rollups.ROLLUP_TYPE_MONTHLY, datetime.date(2023, 1, 1), True),
+])
+def test_is_rollup_partial(rollup_type, period_date, partial):
+    assert siri_rollups.is_rollup_partial(rollup_type, period_date, today=datetime.date(2023, 1, 15)) == partial
+
+
+def test_is_rollup_partial_month_end():
+    assert not siri_rollups.is_rollup_partial(siri_rollups.ROLLUP_TYPE_MONTHLY, datetime.date(2023, 1, 1), today=datetime.date(2023, 2, 1))
+    assert siri_rollups.is_rollup_partial(siri_rollups.ROLLUP_TYPE_MONTHLY, datetime.date(2023, 1, 1), today=datetime.date(2023, 1, 31))
@@ -0,0 +1,114 @@
+import os
+import uuid
+from collections import defaultdict
+
+import pytest
+
+pytest.importorskip('open_bus_stride_db')
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from open_bus_stride_etl.siri import distances, update_ride_stops_vehicle_locations
+
+
+# the test creates its tables in a temporary schema, it should point to a local Postgres DB
+TEST_SQLALCHEMY_URL = os.environ.get('OPEN_BUS_STRIDE_ETL_TEST_SQLALCHEMY_URL')
+
+DATE = '2023-06-01'
+SIRI_ROUTE_ID = 1
+
+SCHEMA_SQL = """
+    create table gtfs_stop (id integer primary key, lat double precision, lon double precision);
+    create table siri_ride (id integer primary key, siri_route_id integer, scheduled_start_time timestamp);
+    create table siri_ride_stop (
+        id integer primary key, siri_ride_id integer, gtfs_stop_id integer, nearest_siri_vehicle_location_id integer
+    );
+    create table siri_vehicle_location (
+        id integer primary key, siri_ride_stop_id integer, lat double precision, lon double precision,
+        recorded_at_time timestamp, distance_from_siri_ride_stop_meters integer
+    );
+"""
+
+FIXTURE_SQL = """
+    insert into gtfs_stop (id, lat, lon) values (100, 32.0, 34.8), (101, 32.01, 34.81), (102, 95, 34.8), (103, 32.0, 34.8);
+    insert into siri_ride (id, siri_route_id, scheduled_start_time) values
+        (1, 1, '2023-06-01 08:00:00'), (2, 2, '2023-06-01 08:00:00'), (3, 1, '2023-06-02 08:00:00');
+    insert into siri_ride_stop (id, siri_ride_id, gtfs_stop_id) values (10, 1, 100), (11, 1, 101), (12, 1, 102), (13, 2, 103), (14, 3, 103);
+    insert into siri_vehicle_location (id, siri_ride_stop_id, lat, lon, recorded_at_time) values
+        -- nearest by geodesic distance is 1000, nearest by haversine distance is 1001
+        (1000, 10, 32.0009, 34.8, '2023-06-01 08:01:00'),
+        (1001, 10, 32.0, 34.80106, '2023-06-01 08:02:00'),
+        -- same distance, the first recorded is the nearest even though it has a higher id
+        (1004, 11, 32.0120, 34.81, '2023-06-01 08:04:00'),
+        (1003, 11, 32.0105, 34.81, '2023-06-01 08:05:00'),
+        (1002, 11, 32.0105, 34.81, '2023-06-01 08:06:00'),
+        -- invalid gtfs stop coordinates
+        (1005, 12, 32.0, 34.8, '2023-06-01 08:07:00'),
+        -- other route and other date
+        (1006, 13, 32.0, 34.8, '2023-06-01 08:08:00'),
+        (1007, 14, 32.0, 34.8, '2023-06-02 08:08:00');
+"""
+
+
+@pytest.fixture(scope='module')
+def session():
+    if not TEST_SQLALCHEMY_URL:
+        pytest.skip('OPEN_BUS_STRIDE_ETL_TEST_SQLALCHEMY_URL is not set')
+    engine = create_engine(TEST_SQLALCHEMY_URL)
+    schema = f'test_{uuid.uuid4().hex}'
+    with engine.connect() as connection:
+        session = Session(bind=connection)
+        session.execute(f'create schema {schema}')
+        session.execute(f'set search_path to {schema}')
+        session.execute(SCHEMA_SQL)
+        session.execute(FIXTURE_SQL)
+        session.commit()
+        try:
+            yield session
+        finally:
+            session.rollback()
+            session.execute(f'drop schema {schema} cascade')
+            session.commit()
+            session.close()
+
+
+def get_engine_results(session, engine, distance_accuracy):
+    """runs the engine for the route/date and returns the updated values, the changes are rolled back"""
+    update_ride_stops_vehicle_locations.process_route_date(session, DATE, SIRI_ROUTE_ID, engine, distance_accuracy, defaultdict(int))
+    vehicle_location_distances = dict(session.execute(
+        'select id, distance_from_siri_ride_stop_meters from siri_vehicle_location order by id'
+    ).fetchall())
+    ride_stop_nearest_vehicle_locations = dict(session.execute(
+        'select id, nearest_siri_vehicle_location_id from siri_ride_stop order by id'
+    ).fetchall())
+    session.rollback()
+    return vehicle_location_distances, ride_stop_nearest_vehicle_locations
+
+
+def test_fixture_nearest_depends_on_distance_accuracy():
+    args = ([32.0009, 32.0], [34.8, 34.80106], [32.0, 32.0], [34.8, 34.8])
+    haversine = distances.get_distances_meters(*args, distances.ACCURACY_HAVERSINE)
+    geodesic = distances.get_distances_meters(*args, distances.ACCURACY_GEODESIC)
+    assert haversine[0] > haversine[1]
+    assert geodesic[0] < geodesic[1]
+
+
+def test_engines_parity(session):
+    python_results = get_engine_results(session, update_ride_stops_vehicle_locations.ENGINE_PYTHON, distances.ACCURACY_HAVERSINE)
+    sql_results = get_engine_results(session, update_ride_stops_vehicle_locations.ENGINE_SQL, distances.ACCURACY_HAVERSINE)
+    assert python_results == sql_results
+    vehicle_location_distances, ride_stop_nearest_vehicle_locations = sql_results
+    assert ride_stop_nearest_vehicle_locations == {10: 1001, 11: 1003, 12: None, 13: None, 14: None}
+    assert vehicle_location_distances[1000] == vehicle_location_distances[1001] == 100
+    assert vehicle_location_distances[1002] == vehicle_location_distances[1003]
+    assert vehicle_location_distances[1005] is None
+    assert vehicle_location_distances[1006] is None
+    assert vehicle_location_distances[1007] is None
+
+
+def test_python_engine_geodesic(session):
+    vehicle_location_distances, ride_stop_nearest_vehicle_locations = get_engine_results(
+        session, update_ride_stops_vehicle_locations.ENGINE_PYTHON, distances.ACCURACY_GEODESIC
+    )
+    assert ride_stop_nearest_vehicle_locations == {10: 1000, 11: 1003, 12: None, 13: None, 14: None}
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from open_bus_stride_etl.siri import watermarks
+
+
+@pytest.fixture(autouse=True)
+def watermarks_rootpath(monkeypatch, tmp_path):
+    monkeypatch.setattr(watermarks, 'WATERMARKS_ROOTPATH', str(tmp_path))
+    return tmp_path
+
+
+def test_incremental_runs(watermarks_rootpath):
+    watermark, full_sweep = watermarks.start_incremental_run('task', True, 24)
+    assert watermark == {} and full_sweep
+    watermarks.finish_incremental_run('task', True, watermark, full_sweep, updated_duration_minutes='2023-06-01T08:00:00+00:00')
+    watermark, full_sweep = watermarks.start_incremental_run('task', True, 24)
+    assert watermark['updated_duration_minutes'] == '2023-06-01T08:00:00+00:00'
+    assert not full_sweep
+    assert watermarks.get_updated_duration_minutes_where_sql(watermark, full_sweep) == \
+        "siri_ride.updated_duration_minutes > '2023-06-01T07:00:00+00:00'"
+    assert os.listdir(str(watermarks_rootpath)) == ['task.json']
+
+
+def test_not_incremental():
+    watermark, full_sweep = watermarks.start_incremental_run('task', False, 24)
+    assert watermark == {} and full_sweep
+    watermarks.finish_incremental_run('task', False, watermark, full_sweep, siri_ride_id=5)
+    assert watermarks.get_watermark('task') == {}
+
+
+def test_overlapping_runs_only_move_forward():
+    watermark, full_sweep = watermarks.start_incremental_run('task', True, 24)
+    # a later run which started after this one finished first
+    watermarks.set_watermark('task', {'siri_ride_id': 200, 'updated_duration_minutes': '2023-06-01T09:00:00+03:00'})
+    watermarks.finish_incremental_run('task', True, watermark, full_sweep, siri_ride_id=100,
+                                      updated_duration_minutes='2023-06-01T07:00:00+00:00')
+    watermark = watermarks.get_watermark('task')
+    assert watermark['siri_ride_id'] == 200
+    assert watermark['updated_duration_minutes'] == '2023-06-01T07:00:00+00:00'
+    assert watermark['last_full_sweep']